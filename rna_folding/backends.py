@@ -0,0 +1,296 @@
+"""Batch mapping backends. A backend maps a batch of genotypes (sequences
+or genotype IDs) at once with map_batch and returns the phenotypes as ragged
+arrays of phenotype IDs, so that batching, vectorization and pooled
+resources (e.g. one ViennaRNA backend and energy cache for all genotypes)
+are possible behind one interface. Backends are also batch mapping functions
+(list of genotypes -> list of phenotype lists), so they can be passed to
+gp_mapper directly. Backends are registered by name, see get_backend.
+
+"""
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+from rna_folding.base_pairing import BasePairing
+from rna_folding.energy_cache import PhenotypeEnergyCache
+from rna_folding.mapping_functions import nussinov, nussinov_canonical_fe, \
+    nussinov_mfe, nussinov_prefix_sharing, viennaRNA_mfe_batch
+from rna_folding.vienna import ViennaRNABackend
+
+
+BACKENDS = {}
+
+
+def register_backend(name: str):
+    """Class decorator that registers a MappingBackend under name"""
+    def register(cls):
+        BACKENDS[name] = cls
+        return cls
+    return register
+
+
+def get_backend(name: str, **kwargs):
+    """Create a registered backend
+
+    Args:
+        name (str): Name of the backend, e.g. "nussinov"
+        **kwargs: Arguments of the backend class
+
+    Returns:
+        MappingBackend: The backend
+
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend {name}, choose one of "
+                         f"{sorted(BACKENDS)}")
+    return BACKENDS[name](**kwargs)
+
+
+class MappingBackend(ABC):
+    """Base class of batch mapping backends. Subclasses implement
+    map_sequences. Phenotypes get IDs in the order they are first found,
+    phenotypes[ph_id] is the phenotype of an ID.
+
+    """
+    def __init__(self, alphabet: str = None, length: int = None,
+                 batch_size: int = 256):
+        """Initialize backend
+
+        Args:
+            alphabet (str): Bases of genotype IDs, e.g. "AUGC". Only needed
+                            to map genotype IDs. Default = None
+            length (int): Length of the genotypes of genotype IDs. Only
+                          needed to map genotype IDs. Default = None
+            batch_size (int): Batch size used by gp_mapper. Default = 256
+
+        """
+        self.alphabet = alphabet
+        self.length = length
+        self.batch_size = batch_size
+        self.phenotypes = []
+        self._ph_ids = {}
+
+    @abstractmethod
+    def map_sequences(self, sequences: list) -> list:
+        """Map genotypes to phenotypes
+
+        Args:
+            sequences (list): Genotypes (str)
+
+        Returns:
+            list: One list of phenotypes (str) per genotype
+
+        """
+
+    def map_batch(self, genotypes) -> tuple:
+        """Map a batch of genotypes to phenotype IDs
+
+        Args:
+            genotypes (list or np.ndarray): Genotypes (str) or genotype IDs
+                                            (int, position in the complete
+                                            genotype space, see sequences)
+
+        Returns:
+            (tuple): (ph_ids, offsets), phenotype IDs of genotype k are
+                     ph_ids[offsets[k]:offsets[k+1]]
+
+        """
+        phenotypes = self.map_sequences(self.sequences(genotypes))
+        offsets = np.zeros(len(phenotypes) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(phenotypes_)
+                                 for phenotypes_ in phenotypes])
+        ph_ids = np.fromiter((self.phenotype_id(ph)
+                              for phenotypes_ in phenotypes
+                              for ph in phenotypes_),
+                             dtype=np.int64, count=offsets[-1])
+        return ph_ids, offsets
+
+    def phenotype_id(self, ph: str) -> int:
+        """ID of a phenotype, new phenotypes get the next free ID"""
+        ph_id = self._ph_ids.get(ph)
+        if ph_id is None:
+            ph_id = self._ph_ids[ph] = len(self.phenotypes)
+            self.phenotypes.append(ph)
+        return ph_id
+
+    def unpack(self, ph_ids: np.ndarray, offsets: np.ndarray) -> list:
+        """Phenotype lists of the ragged arrays returned by map_batch"""
+        return [[self.phenotypes[ph_id] for ph_id in ph_ids[start:end]]
+                for start, end in zip(offsets[:-1], offsets[1:])]
+
+    def sequences(self, genotypes) -> list:
+        """Genotype sequences of genotypes given as sequences or as IDs. The
+        ID of a genotype is its position in the complete genotype space in
+        the order of combinatorically_complete_genotypes, i.e. its bases are
+        the base-len(alphabet) digits of the ID (most significant first).
+
+        Args:
+            genotypes (list or np.ndarray): Genotypes (str) or genotype IDs
+
+        Returns:
+            list: Genotypes (str)
+
+        """
+        if len(genotypes) == 0 or isinstance(genotypes[0], str):
+            return list(genotypes)
+        if self.alphabet is None or self.length is None:
+            raise ValueError("Mapping genotype IDs needs the alphabet and "
+                             "length of the genotypes")
+        a = len(self.alphabet)
+        ids = np.asarray(genotypes, dtype=np.int64)
+        digits = ids[:, None] // a**np.arange(self.length - 1, -1, -1) % a
+        bases = np.array(list(self.alphabet))[digits]
+        return ["".join(row) for row in bases]
+
+    def __call__(self, genotypes: list) -> list:
+        """Batch mapping function for gp_mapper, see map_sequences"""
+        return self.map_sequences(self.sequences(genotypes))
+
+
+@register_backend("legacy")
+class LegacyMappingBackend(MappingBackend):
+    """Adapter for single-genotype mapping functions"""
+    def __init__(self, mapping_function, **kwargs):
+        """Initialize backend
+
+        Args:
+            mapping_function (function): Takes a genotype (str) as single
+                                         positional argument and returns a
+                                         list of phenotypes (str)
+            **kwargs: see MappingBackend
+
+        """
+        super().__init__(**kwargs)
+        self.mapping_function = mapping_function
+
+    def map_sequences(self, sequences: list) -> list:
+        return [self.mapping_function(seq) for seq in sequences]
+
+
+@register_backend("nussinov")
+class NussinovBackend(MappingBackend):
+    """Nussinov mapping, the Nussinov matrix columns of the prefix shared
+    with the previous genotype of the batch are reused (see 
+    nussinov_prefix_sharing) unless options of nussinov other than max_span
+    are given
+
+    """
+    def __init__(self, base_pairing: BasePairing, min_loop_size: int,
+                 suboptimal: int, structures_max: int, alphabet: str = None,
+                 length: int = None, batch_size: int = 4096, **options):
+        """Initialize backend
+
+        Args:
+            base_pairing, min_loop_size, suboptimal, structures_max: see
+            nussinov
+            alphabet, length, batch_size: see MappingBackend, batch_size
+            defaults to 4096 as larger batches share more prefixes
+            **options: Further arguments of nussinov, e.g. max_span
+
+        """
+        super().__init__(alphabet=alphabet, length=length,
+                         batch_size=batch_size)
+        self.params = dict(base_pairing=base_pairing,
+                           min_loop_size=min_loop_size,
+                           suboptimal=suboptimal,
+                           structures_max=structures_max)
+        self.options = options
+
+    def map_sequences(self, sequences: list) -> list:
+        if set(self.options) <= {"max_span"}:
+            return nussinov_prefix_sharing(sequences, **self.params,
+                                           **self.options)
+        return [nussinov(seq, **self.params, **self.options)
+                for seq in sequences]
+
+
+@register_backend("nussinov_mfe")
+class NussinovMFEBackend(MappingBackend):
+    """Nussinov + mfe ranking, all genotypes share one ViennaRNA backend and
+    one phenotype energy cache
+
+    """
+    def __init__(self, base_pairing: BasePairing, min_loop_size: int,
+                 suboptimal: int, structures_max: int, seed: int = None,
+                 base_pair: str = "GC", deterministic: bool = False,
+                 alphabet: str = None, length: int = None,
+                 batch_size: int = 256, **options):
+        """Initialize backend
+
+        Args:
+            base_pairing, min_loop_size, suboptimal, structures_max, seed,
+            base_pair, deterministic: see nussinov_mfe
+            alphabet, length, batch_size: see MappingBackend
+            **options: Further arguments of nussinov_mfe, e.g. prefilter.
+            Default energy_cache and backend are shared by all genotypes.
+
+        """
+        super().__init__(alphabet=alphabet, length=length,
+                         batch_size=batch_size)
+        if options.get("energy_cache") is None \
+                and (seed is not None or not deterministic):
+            options["energy_cache"] = PhenotypeEnergyCache(
+                base_pair=base_pair, deterministic=deterministic, seed=seed)
+        if options.get("backend") is None:
+            options["backend"] = ViennaRNABackend()
+        self.params = dict(base_pairing=base_pairing,
+                           min_loop_size=min_loop_size,
+                           suboptimal=suboptimal,
+                           structures_max=structures_max, seed=seed,
+                           base_pair=base_pair, deterministic=deterministic,
+                           **options)
+
+    def map_sequences(self, sequences: list) -> list:
+        return [nussinov_mfe(seq, **self.params) for seq in sequences]
+
+
+@register_backend("nussinov_canonical_fe")
+class NussinovCanonicalFEBackend(MappingBackend):
+    """Nussinov + free energies, all genotypes share one ViennaRNA backend"""
+    def __init__(self, base_pairing: BasePairing, min_loop_size: int,
+                 suboptimal: int, structures_max: int,
+                 prefilter: int = None, backend: ViennaRNABackend = None,
+                 alphabet: str = None, length: int = None,
+                 batch_size: int = 256):
+        """Initialize backend
+
+        Args:
+            base_pairing, min_loop_size, suboptimal, structures_max,
+            prefilter, backend: see nussinov_canonical_fe
+            alphabet, length, batch_size: see MappingBackend
+
+        """
+        super().__init__(alphabet=alphabet, length=length,
+                         batch_size=batch_size)
+        self.params = dict(base_pairing=base_pairing,
+                           min_loop_size=min_loop_size,
+                           suboptimal=suboptimal,
+                           structures_max=structures_max, prefilter=prefilter,
+                           backend=ViennaRNABackend() if backend is None
+                           else backend)
+
+    def map_sequences(self, sequences: list) -> list:
+        return [nussinov_canonical_fe(seq, **self.params)
+                for seq in sequences]
+
+
+@register_backend("viennaRNA_mfe")
+class ViennaRNAMFEBackend(MappingBackend):
+    """ViennaRNA mfe structures, see viennaRNA_mfe_batch"""
+    def __init__(self, backend: ViennaRNABackend = None,
+                 alphabet: str = None, length: int = None,
+                 batch_size: int = 256):
+        """Initialize backend
+
+        Args:
+            backend (ViennaRNABackend): Backend used to fold. Default = None
+                                        (ViennaRNA default model details)
+            alphabet, length, batch_size: see MappingBackend
+
+        """
+        super().__init__(alphabet=alphabet, length=length,
+                         batch_size=batch_size)
+        self.backend = ViennaRNABackend() if backend is None else backend
+
+    def map_sequences(self, sequences: list) -> list:
+        return viennaRNA_mfe_batch(sequences, backend=self.backend)
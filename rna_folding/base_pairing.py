@@ -7,6 +7,7 @@ http://users.cecs.anu.edu.au/~bdm/data/graphs.html
 """
 
 import numpy as np
+from itertools import permutations
 from rna_folding.utils import canonical_adjacency_matrix
 
 
@@ -74,3 +75,45 @@ class BasePairing:
         b = self.bases_to_id[B]
         return self.A[a, b]
 
+    def encode(self, seq):
+        """Translate a sequence into an array of base ids (positions in
+        self.bases), e.g. "AUGC" -> [0, 1, 2, 3] for bases "AUGC"
+
+        Args:
+            seq (str): The sequence
+
+        Returns:
+            (np.ndarray): 1D integer array of base ids
+
+        """
+        return np.fromiter((self.bases_to_id[b] for b in seq), dtype=int,
+                           count=len(seq))
+
+    def pairing_mask(self, seq):
+        """Returns the LxL pairing mask of a sequence of length L, where
+        entry [a, b] is True if the bases at (0-based) positions a and b can
+        pair according to the adjacency matrix
+
+        Args:
+            seq (str): The sequence
+
+        Returns:
+            (np.ndarray): LxL boolean array
+
+        """
+        ids = self.encode(seq)
+        return self.A[ids[:, None], ids[None, :]].astype(bool)
+
+    def automorphisms(self):
+        """All relabelings of the bases that leave the base-pairing graph
+        unchanged, i.e. permutations p of the base ids with 
+        A[p[a], p[b]] == A[a, b] for all bases a, b. Relabeling a sequence
+        with an automorphism leaves its pairing mask and thus its Nussinov
+        structures unchanged. Includes the identity.
+
+        Returns:
+            (list): Permutations as tuples of base ids
+
+        """
+        return [p for p in permutations(range(self.n))
+                if np.array_equal(self.A[np.ix_(p, p)], self.A)]
@@ -0,0 +1,102 @@
+"""Command line arguments shared by the gp_mapping scripts for how gp_mapper
+maps the genotypes (parallel chunks, streaming to disk, checkpoints and the
+persistent result cache), as opposed to what they are mapped to.
+
+"""
+import argparse
+
+from rna_folding.result_cache import SQLiteResultCache
+
+
+def add_mapping_arguments(parser: argparse.ArgumentParser,
+                          chunk_seed: bool = False):
+    """Add the gp_mapper arguments to a parser, see mapping_kwargs
+
+    Args:
+        parser (argparse.ArgumentParser): Parser of a gp_mapping script
+        chunk_seed (bool): Also add --chunk_seed, for random mappings.
+                           Default = False
+
+    """
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="Map chunks of genotypes in this many processes "
+                             "in parallel")
+    parser.add_argument("--chunk_size", type=int, default=None,
+                        help="Number of genotypes per chunk with -j "
+                             "(default 4096)")
+    if chunk_seed:
+        parser.add_argument("--chunk_seed", type=int, default=None,
+                            help="Reseed the random number generators with "
+                                 "this seed plus the chunk number before each "
+                                 "chunk, so results of random mappings do not "
+                                 "depend on -j")
+    parser.add_argument("--buffer_size", type=int, default=None,
+                        help="Stream the g-p map to disk, holding at most this "
+                             "many (phenotype, genotype) records in memory, "
+                             "instead of collecting the complete map in "
+                             "memory")
+    parser.add_argument("--tmp_dir", type=str, default=None,
+                        help="Directory for records spilled to disk with "
+                             "--buffer_size (default: next to -o)")
+    parser.add_argument("--checkpoint_interval", type=float, default=None,
+                        help="Save the progress to '<output>.checkpoint' "
+                             "every this many seconds (default 600 with "
+                             "--resume), so an interrupted run can be "
+                             "continued with --resume")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue from the checkpoint of an interrupted "
+                             "run with the same arguments, if there is one")
+    parser.add_argument("--result_cache", type=str, default=None,
+                        help="SQLite file with the phenotypes of genotypes "
+                             "mapped before with the same settings (also by "
+                             "other runs), only genotypes not in it are "
+                             "mapped and then added to it")
+    parser.add_argument("--result_cache_size", type=int, default=None,
+                        help="Maximum number of results kept in "
+                             "--result_cache, least recently used are "
+                             "evicted")
+
+
+def uses_checkpoint(args: argparse.Namespace) -> bool:
+    """True if the progress is checkpointed, see add_mapping_arguments"""
+    return args.checkpoint_interval is not None or args.resume
+
+
+def mapping_kwargs(args: argparse.Namespace, output: str) -> dict:
+    """Keyword arguments of gp_mapper or gp_mapper_multi from the arguments
+    added by add_mapping_arguments (except the result cache, see
+    open_result_cache)
+
+    Args:
+        args (argparse.Namespace): Parsed arguments
+        output (str): Output file, the checkpoint is '<output>.checkpoint'
+
+    Returns:
+        dict: workers, chunk_size, seed, buffer_size, tmp_dir, checkpoint,
+              checkpoint_interval and resume
+
+    """
+    checkpoint_interval = args.checkpoint_interval \
+        if args.checkpoint_interval is not None else 600
+    return dict(workers=args.workers, chunk_size=args.chunk_size,
+                seed=getattr(args, "chunk_seed", None),
+                buffer_size=args.buffer_size, tmp_dir=args.tmp_dir,
+                checkpoint=str(output) + ".checkpoint"
+                if uses_checkpoint(args) else None,
+                checkpoint_interval=checkpoint_interval, resume=args.resume)
+
+
+def open_result_cache(args: argparse.Namespace) -> SQLiteResultCache:
+    """Result cache of --result_cache, to be closed by the caller
+
+    Args:
+        args (argparse.Namespace): Parsed arguments
+
+    Returns:
+        SQLiteResultCache: The cache, or None without --result_cache
+
+    """
+    if not args.result_cache:
+        return None
+    return SQLiteResultCache(args.result_cache,
+                             max_entries=args.result_cache_size)
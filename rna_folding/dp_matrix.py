@@ -0,0 +1,255 @@
+"""Compact storage for dynamic programming matrices of RNA folding algorithms.
+Only cells [i, j] with i <= j are stored, cells below the diagonal read as 0.
+
+"""
+import numpy as np
+
+
+def smallest_uint_dtype(max_value: int) -> type:
+    """Smallest unsigned integer dtype that can hold max_value
+
+    Args:
+        max_value (int): Largest value to be stored
+
+    Returns:
+        (type): np.uint8, np.uint16, np.uint32 or np.uint64
+
+    """
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if max_value <= np.iinfo(dtype).max:
+            return dtype
+    return np.uint64
+
+
+class TriangularMatrix:
+    """Upper triangle (including the diagonal) of a (n+1)x(n+1) matrix packed diagonal by diagonal into a flat array,
+    i.e. cells [i, i+k] for i = 0, ..., n-k are stored next to each other. The flat array has one extra slot at the
+    end that is always 0 and stands in for all cells below the diagonal.
+
+    Buffers are kept in a pool per matrix size, so that repeatedly creating and releasing matrices of the same size
+    does not allocate new memory.
+
+    """
+    _pool = {}  # maps (n, dtype) to list of free buffers
+    pool_size = 16  # maximum number of free buffers kept per (n, dtype)
+
+    def __init__(self, n: int, dtype: type = None):
+        """Take a zeroed buffer from the pool or allocate a new one
+
+        Args:
+            n (int): Matrix is (n+1)x(n+1), e.g. n is the sequence length
+            dtype (type): Integer dtype of the cells. Default = smallest
+                          unsigned dtype that holds n//2, i.e. the maximum
+                          number of base-pairs of a sequence of length n
+
+        """
+        self._n = n
+        self.dtype = dtype if dtype else smallest_uint_dtype(n // 2)
+        free = TriangularMatrix._pool.get((n, self.dtype))
+        if free:
+            self._data = free.pop()
+            self._data.fill(0)
+        else:
+            self._data = np.zeros((n+1)*(n+2)//2 + 1, dtype=self.dtype)
+
+    @property
+    def data(self) -> np.ndarray:
+        return self._data
+
+    @property
+    def shape(self) -> tuple:
+        return (self._n+1, self._n+1)
+
+    def release(self):
+        """Return the buffer to the pool, the matrix must not be used afterwards"""
+        free = TriangularMatrix._pool.setdefault((self._n, self.dtype), [])
+        if len(free) < TriangularMatrix.pool_size:
+            free.append(self._data)
+        self._data = None
+
+    @staticmethod
+    def flat_index(i, j, n: int):
+        """Position of cell [i, j] of a (n+1)x(n+1) matrix in the flat array, works with ints and arrays
+
+        Args:
+            i (int or np.ndarray): Row(s)
+            j (int or np.ndarray): Column(s), negative columns count from the end as for numpy arrays
+
+        Returns:
+            (int or np.ndarray): Flat index, cells below the diagonal point to the last slot (always 0)
+
+        """
+        j = np.where(j < 0, j + n + 1, j) if isinstance(j, np.ndarray) else (j + n + 1 if j < 0 else j)
+        k = j - i
+        index = k*(n+1) - k*(k-1)//2 + i
+        if isinstance(index, np.ndarray):
+            return np.where(k < 0, (n+1)*(n+2)//2, index)
+        return (n+1)*(n+2)//2 if k < 0 else index
+
+    def __getitem__(self, key):
+        i, j = key
+        if isinstance(i, (np.ndarray, list)) or isinstance(j, (np.ndarray, list)):
+            return self._data[self.flat_index(np.asarray(i), np.asarray(j), self._n)]
+        return int(self._data[self.flat_index(i, j, self._n)])  # python int to avoid unsigned overflow downstream
+
+    def __setitem__(self, key, value):
+        i, j = key
+        if isinstance(i, (np.ndarray, list)) or isinstance(j, (np.ndarray, list)):
+            i, j = np.broadcast_arrays(np.asarray(i), np.asarray(j))
+            if np.any(j - i < 0):
+                raise IndexError("Cannot set cells below the diagonal of a TriangularMatrix")
+            self._data[self.flat_index(i, j, self._n)] = value
+        else:
+            index = self.flat_index(i, j, self._n)
+            if index == (self._n+1)*(self._n+2)//2:
+                raise IndexError("Cannot set cells below the diagonal of a TriangularMatrix")
+            self._data[index] = value
+
+    def tolist(self) -> list:
+        """Rows of the matrix as lists for fast scalar access as P[i][j], read from the packed diagonals"""
+        values = self._data[_upper_triangle(self._n)[2]].tolist()  # row by row
+        rows, start = [], 0
+        for i_ in range(self._n + 1):
+            end = start + self._n + 1 - i_
+            rows.append([0]*i_ + values[start:end])
+            start = end
+        return rows
+
+    def __array__(self, dtype=None, copy=None):
+        """Dense (n+1)x(n+1) copy of the matrix"""
+        i, j, index = _upper_triangle(self._n)
+        dense = np.zeros(self.shape, dtype=dtype if dtype else self.dtype)
+        dense[i, j] = self._data[index]
+        return dense
+
+
+_upper_triangle_cache = {}
+
+
+def _upper_triangle(n: int) -> tuple:
+    """Rows, columns and flat TriangularMatrix indices of the cells [i, j], i <= j, of a (n+1)x(n+1) matrix in row
+    major order, computed once per n"""
+    if n not in _upper_triangle_cache:
+        i, j = np.triu_indices(n + 1)
+        _upper_triangle_cache[n] = (i, j, TriangularMatrix.flat_index(i, j, n))
+    return _upper_triangle_cache[n]
+
+
+class BandedMatrix:
+    """Band of a (n+1)x(n+1) matrix for local folding with maximum base-pair span W, i.e. cells [i, j] with
+    0 <= j - i <= W, plus the complete row 1 (the exterior loop of the whole sequence). Takes O(n*W) memory.
+    Band and row are stored in one flat array [band | row 1 | 0], where the last slot is always 0 and stands in
+    for all cells below the diagonal. Cells outside the band (except for row 1) can not be accessed.
+
+    """
+    def __init__(self, n: int, max_span: int, dtype: type = None):
+        """Allocate a zeroed band
+
+        Args:
+            n (int): Matrix is (n+1)x(n+1), e.g. n is the sequence length
+            max_span (int): Width W of the band
+            dtype (type): Integer dtype of the cells. Default = smallest
+                          unsigned dtype that holds n//2
+
+        """
+        self._n = n
+        self._w = max_span
+        self.dtype = dtype if dtype else smallest_uint_dtype(n // 2)
+        self._data = np.zeros((n+1)*(max_span+1) + n+1 + 1, dtype=self.dtype)
+
+    @property
+    def data(self) -> np.ndarray:
+        return self._data
+
+    @property
+    def shape(self) -> tuple:
+        return (self._n+1, self._n+1)
+
+    @property
+    def max_span(self) -> int:
+        return self._w
+
+    def release(self):
+        self._data = None
+
+    @staticmethod
+    def flat_index(i, j, n: int, max_span: int):
+        """Position of cell [i, j] in the flat array, works with ints and arrays
+
+        Args:
+            i (int or np.ndarray): Row(s)
+            j (int or np.ndarray): Column(s), negative columns count from the end as for numpy arrays
+            n (int): Matrix is (n+1)x(n+1)
+            max_span (int): Width of the band
+
+        Returns:
+            (int or np.ndarray): Flat index, cells below the diagonal point to the last slot (always 0)
+
+        Raises:
+            IndexError: If a cell outside of the band and row 1 is accessed
+
+        """
+        row_offset, zero = (n+1)*(max_span+1), (n+1)*(max_span+1) + n+1
+        if isinstance(i, np.ndarray) or isinstance(j, np.ndarray):
+            i, j = np.broadcast_arrays(np.asarray(i), np.asarray(j))
+            j = np.where(j < 0, j + n + 1, j)
+            if np.any((j - i > max_span) & (i != 1)):
+                raise IndexError(f"Cell outside of band of width {max_span}")
+            index = np.where(i == 1, row_offset + j, i*(max_span+1) + j - i)
+            return np.where(j < i, zero, index)
+        j = j + n + 1 if j < 0 else j
+        if j < i:
+            return zero
+        if i == 1:
+            return row_offset + j
+        if j - i > max_span:
+            raise IndexError(f"Cell [{i}, {j}] outside of band of width {max_span}")
+        return i*(max_span+1) + j - i
+
+    def __getitem__(self, key):
+        i, j = key
+        if isinstance(i, (np.ndarray, list)) or isinstance(j, (np.ndarray, list)):
+            return self._data[self.flat_index(np.asarray(i), np.asarray(j), self._n, self._w)]
+        return int(self._data[self.flat_index(i, j, self._n, self._w)])
+
+    def __setitem__(self, key, value):
+        i, j = key
+        if isinstance(i, (np.ndarray, list)) or isinstance(j, (np.ndarray, list)):
+            i, j = np.broadcast_arrays(np.asarray(i), np.asarray(j))
+            if np.any(j - i < 0):
+                raise IndexError("Cannot set cells below the diagonal of a BandedMatrix")
+            self._data[self.flat_index(i, j, self._n, self._w)] = value
+        else:
+            index = self.flat_index(i, j, self._n, self._w)
+            if index == self._data.size - 1:
+                raise IndexError("Cannot set cells below the diagonal of a BandedMatrix")
+            self._data[index] = value
+
+    def tolist(self) -> list:
+        """Rows of the matrix for fast scalar access as P[i][j], row 1 is a list, all other rows are BandedRows"""
+        band = self._data[:(self._n+1)*(self._w+1)].reshape(self._n+1, self._w+1).tolist()
+        rows = [BandedRow(i, values) for i, values in enumerate(band)]
+        if self._n >= 1:
+            rows[1] = self._data[(self._n+1)*(self._w+1):-1].tolist()
+        return rows
+
+    def __array__(self, dtype=None, copy=None):
+        """Dense (n+1)x(n+1) copy of the matrix, cells outside of the band are 0"""
+        dense = np.zeros(self.shape, dtype=dtype if dtype else self.dtype)
+        i, j = np.indices(self.shape)
+        inside = (j - i <= self._w) | (i == 1)
+        dense[inside] = self._data[self.flat_index(i[inside], j[inside], self._n, self._w)]
+        return dense
+
+
+class BandedRow:
+    """Row i of a BandedMatrix as list-like object, holds cells [i, i], ..., [i, i+W]"""
+    __slots__ = ("_i", "_values")
+
+    def __init__(self, i: int, values: list):
+        self._i = i
+        self._values = values
+
+    def __getitem__(self, j: int) -> int:
+        k = j - self._i
+        return 0 if k < 0 else self._values[k]
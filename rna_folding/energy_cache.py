@@ -0,0 +1,144 @@
+"""Memoized free energies of phenotypes for Nussinov + mfe ranking. The
+energy of a phenotype is computed on a canonical genotype made from the
+phenotype alone (see dotbracket_to_genotype), so it does not depend on the
+genotype the phenotype was found for and only has to be computed once per
+distinct phenotype.
+
+"""
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+import RNA
+from rna_folding.utils import dotbracket_to_genotype
+
+
+class PhenotypeEnergyCache:
+    """Maps phenotypes (dot-bracket) to the free energy of the phenotype on
+    its canonical genotype, as computed by nussinov_mfe. Holds at most maxsize
+    energies in least recently used order. Can be saved to and loaded from a
+    "{ph} {energy}" text file, and backed by a shared mapping (e.g. a
+    multiprocessing.Manager().dict()) to share energies between processes.
+
+    """
+    def __init__(self, base_pair: str = "GC", deterministic: bool = False,
+                 seed: int = None, maxsize: int = None,
+                 store: MutableMapping = None, path: str = None):
+        """Initialize an empty cache, or load one from file
+
+        Args:
+            base_pair (str): Which base-pair is used for MFE calc., either
+                             "GC" or "AU". Default = "GC"
+            deterministic (bool): As in nussinov_mfe. Default = False
+            seed (int): As in nussinov_mfe. Required if deterministic is True,
+                        since otherwise the canonical genotype of a
+                        phenotype is drawn anew on every call.
+            maxsize (int): Maximum number of energies held in memory.
+                           Default = None (unbounded)
+            store (MutableMapping): Shared mapping that energies are looked
+                                    up in and written to after the local
+                                    cache. Default = None
+            path (str): File written by save to load energies from.
+                        Default = None
+
+        """
+        if deterministic and seed is None:
+            raise ValueError("Energies can only be cached if the canonical "
+                             "genotype is reproducible, give a seed")
+        self.base_pair = base_pair
+        self.deterministic = deterministic
+        self.seed = seed
+        self.maxsize = maxsize
+        self.store = store
+        self._energies = OrderedDict()
+        self.hits, self.misses = 0, 0
+        if path is not None:
+            self.load(path)
+
+    def matches(self, base_pair: str, deterministic: bool, seed: int) -> bool:
+        """True if the cache holds energies for these nussinov_mfe arguments"""
+        return (self.base_pair == base_pair
+                and self.deterministic == deterministic
+                and (self.seed == seed or not deterministic))
+
+    def genotype(self, ph: str) -> str:
+        """Canonical genotype of phenotype ph that energies are computed on
+
+        Args:
+            ph (str): Phenotype in dot-bracket notation
+
+        Returns:
+            str: Canonical genotype, see dotbracket_to_genotype
+
+        """
+        return dotbracket_to_genotype(dotbracket=ph, base_pair=self.base_pair,
+                                      random=self.deterministic,
+                                      seed=self.seed)
+
+    def energy(self, ph: str, seq_canon: str = None) -> float:
+        """Free energy of phenotype ph on its canonical genotype
+
+        Args:
+            ph (str): Phenotype in dot-bracket notation
+            seq_canon (str): Canonical genotype of ph if already known (see
+                             genotype), used if the energy is not cached.
+                             Default = None
+
+        Returns:
+            float: Free energy in kcal/mol
+
+        """
+        fe = self._energies.get(ph)
+        if fe is not None:
+            self._energies.move_to_end(ph)
+            self.hits += 1
+            return fe
+        if self.store is not None:
+            fe = self.store.get(ph)
+        if fe is None:
+            self.misses += 1
+            if seq_canon is None:
+                seq_canon = self.genotype(ph)
+            fe = RNA.eval_structure_simple(seq_canon, ph)
+            if self.store is not None:
+                self.store[ph] = fe
+        else:
+            self.hits += 1
+        self._add(ph, fe)
+        return fe
+
+    def _add(self, ph: str, fe: float):
+        self._energies[ph] = fe
+        if self.maxsize is not None and len(self._energies) > self.maxsize:
+            self._energies.popitem(last=False)  # least recently used
+
+    def __len__(self):
+        return len(self._energies)
+
+    def __contains__(self, ph: str) -> bool:
+        return ph in self._energies
+
+    def save(self, path: str):
+        """Write all energies held in memory (and in store) to a text file,
+        one "{ph} {energy}" line per phenotype
+
+        Args:
+            path (str): Output file
+
+        """
+        energies = dict(self.store) if self.store is not None else {}
+        energies.update(self._energies)
+        with open(path, "w") as file_out:
+            for ph, fe in energies.items():
+                file_out.write(f"{ph} {fe!r}\n")
+
+    def load(self, path: str):
+        """Add the energies of a file written by save
+
+        Args:
+            path (str): Input file
+
+        """
+        with open(path, "r") as file_in:
+            for line in file_in:
+                ph, fe = line.split()
+                self._add(ph, float(fe))
@@ -0,0 +1,128 @@
+"""Simplified nearest-neighbor energy model to score many candidate
+structures at once with NumPy, e.g. to prefilter Nussinov suboptimals before
+evaluating the best few with ViennaRNA. Energies are the sum of
+- Turner 2004 stacking energies of stacked base-pairs,
+- Turner 2004 hairpin initiation energies by hairpin size and a flat terminal
+  mismatch bonus for hairpins with more than 3 bases,
+- a flat penalty for every other loop (bulge, interior and multiloops)
+  closed by a base-pair,
+- flat dangle bonuses for unpaired bases next to the outer side of a helix.
+Sequence dependence of mismatches and dangles and loop asymmetry are ignored,
+so energies only approximate ViennaRNA's (the flat terms were chosen to best
+pick ViennaRNA's minimum among Nussinov suboptimals of canonical genotypes).
+
+"""
+import numpy as np
+
+
+PAIRS = ["CG", "GC", "GU", "UG", "AU", "UA"]  # pair types 1..6, 0 is no pair
+
+# stacking energies (kcal/mol) STACK[type of (i, j), type of (j-1, i+1)],
+# Turner 2004 as in ViennaRNA's rna_turner2004.par
+STACK = np.zeros((7, 7))
+STACK[1:, 1:] = np.array([[-2.4, -3.3, -2.1, -1.4, -2.1, -2.1],
+                          [-3.3, -3.4, -2.5, -1.5, -2.2, -2.4],
+                          [-2.1, -2.5,  1.3, -0.5, -1.4, -1.3],
+                          [-1.4, -1.5, -0.5,  0.3, -0.6, -1.0],
+                          [-2.1, -2.2, -1.4, -0.6, -1.1, -0.9],
+                          [-2.1, -2.4, -1.3, -1.0, -0.9, -1.3]])
+
+# hairpin initiation energies (kcal/mol) by number of unpaired bases up to 9,
+# larger sizes are extrapolated with 1.75 RT ln(size/9)
+HAIRPIN = np.array([np.inf, np.inf, np.inf, 5.4, 5.6, 5.7, 5.4, 6.0, 5.5, 6.4])
+
+HAIRPIN_MISMATCH = -1.5  # terminal mismatch of hairpins with more than 3 bases
+LOOP_PENALTY = 1.5  # flat energy of bulges, interior loops and multiloops
+DANGLE5, DANGLE3 = -0.3, -0.8  # unpaired base 5' of i / 3' of j of a helix end
+
+_BASE_IDS = {"A": 0, "C": 1, "G": 2, "U": 3}
+_PAIR_TYPE = np.zeros((5, 5), dtype=int)  # base ids to pair type, 4 = other
+for t, (a, b) in enumerate(PAIRS, start=1):
+    _PAIR_TYPE[_BASE_IDS[a], _BASE_IDS[b]] = t
+
+
+def pair_tables(structures: list) -> np.ndarray:
+    """Pair tables of structures of equal length L in ViennaRNA convention
+
+    Args:
+        structures (list): Structures in dot-bracket notation (str)
+
+    Returns:
+        (np.ndarray): Kx(L+1) integer array pt, pt[k, 0] = L and pt[k, i] = j
+                      if i and j are paired in structure k and 0 otherwise
+
+    """
+    L = len(structures[0]) if structures else 0
+    pt = np.zeros((len(structures), L + 1), dtype=int)
+    pt[:, 0] = L
+    for k, db in enumerate(structures):
+        stack = []
+        for i, c in enumerate(db, start=1):
+            if c == "(":
+                stack.append(i)
+            elif c == ")":
+                l = stack.pop()
+                pt[k, i], pt[k, l] = l, i
+    return pt
+
+
+def stacking_energies(seqs, structures, loop_penalty: float = LOOP_PENALTY
+                      ) -> np.ndarray:
+    """Approximate free energies of K structures in one vectorized pass
+
+    Args:
+        seqs (str or list): One sequence for all structures or one sequence
+                            per structure, bases other than A, C, G, U never
+                            stack.
+        structures (list or np.ndarray): Structures in dot-bracket notation or
+                                         their pair tables (see pair_tables)
+        loop_penalty (float): Energy of each loop that is neither a stack
+                              nor a hairpin. Default = LOOP_PENALTY
+
+    Returns:
+        (np.ndarray): Free energy per structure (kcal/mol), structures with a
+                      hairpin of less than 3 bases get np.inf
+
+    """
+    pt = structures if isinstance(structures, np.ndarray) \
+        else pair_tables(structures)
+    K, L = pt.shape[0], pt.shape[1] - 1
+    if K == 0:
+        return np.zeros(0)
+    if isinstance(seqs, str):
+        seqs = [seqs]
+    ids = np.array([[_BASE_IDS.get(b, 4) for b in seq] for seq in seqs])
+    ids = np.broadcast_to(np.hstack([np.full((ids.shape[0], 1), 4), ids]),
+                          (K, L + 1))  # 1-based like pt
+
+    k, i = np.nonzero(pt[:, 1:] > np.arange(1, L + 1)[None, :])  # pairs i < j
+    i = i + 1
+    j = pt[k, i]
+    energy = np.zeros(K)
+
+    # (i, j) stacks on (i+1, j-1)
+    stacked = pt[k, i + 1] == j - 1
+    outer = _PAIR_TYPE[ids[k, i], ids[k, j]]
+    inner = _PAIR_TYPE[ids[k, j - 1], ids[k, i + 1]]
+    np.add.at(energy, k[stacked], STACK[outer[stacked], inner[stacked]])
+
+    # (i, j) closes a hairpin if no site between i and j is paired
+    paired = np.cumsum(pt > 0, axis=1)
+    hairpin = ~stacked & (paired[k, j - 1] == paired[k, i])
+    size = (j - i - 1)[hairpin]
+    np.add.at(energy, k[hairpin], 
+              np.where(size < len(HAIRPIN), 
+                       HAIRPIN[np.minimum(size, len(HAIRPIN) - 1)],
+                       HAIRPIN[-1] + 1.07856 * np.log(np.maximum(size, 1) / 9))
+              + np.where(size > 3, HAIRPIN_MISMATCH, 0))
+
+    other = ~stacked & ~hairpin
+    np.add.at(energy, k[other], loop_penalty)
+
+    # (i, j) is a helix end unless (i-1, j+1) is a pair, unpaired neighbors dangle
+    i5, j3 = np.maximum(i - 1, 0), np.minimum(j + 1, L)
+    end = ~((i > 1) & (j < L) & (pt[k, i5] == j + 1))
+    dangles = DANGLE5 * ((i > 1) & (pt[k, i5] == 0)) \
+        + DANGLE3 * ((j < L) & (pt[k, j3] == 0))
+    np.add.at(energy, k[end], dangles[end])
+    return energy
@@ -0,0 +1,159 @@
+"""Streaming writer for g-p map files. Instead of holding the complete
+{ph: [gt_id, ...]} dict in memory, (phenotype ID, genotype ID) records are
+buffered in compact arrays and spilled to disk as sorted runs whenever the
+buffer is full. Closing the writer merges the runs into the same file that
+dict_to_gpmap writes for the dict, so memory is bounded by the buffer size
+(plus the distinct phenotype strings) regardless of the size of the map.
+
+"""
+import heapq
+import os
+import shutil
+import tempfile
+from array import array
+
+import numpy as np
+
+
+class GPMapWriter:
+    """Collects the phenotypes of genotypes and writes them as g-p map with
+    lines "{ph} {gt_id} {gt_id} ...". Phenotypes appear in the order they
+    were first added, genotype IDs in the order they were added.
+
+    """
+    def __init__(self, output: str, buffer_size: int = 2**22,
+                 tmp_dir: str = None):
+        """Initialize an empty writer
+
+        Args:
+            output (str): Path to output file, written by close.
+            buffer_size (int): Number of (phenotype, genotype) records held in
+                               memory before they are spilled to disk.
+                               Default = 4194304 (64 MB)
+            tmp_dir (str): Directory for the spilled runs. Default = None
+                           (a temporary directory next to output)
+
+        """
+        self.output = str(output)
+        self.buffer_size = buffer_size
+        self.tmp_dir = tmp_dir
+        self.phenotypes = []  # phenotype ID to phenotype
+        self._ph_ids = {}
+        self._ph_buffer, self._gt_buffer = array("q"), array("q")
+        self.runs = []  # paths of spilled runs
+        self._run_dir = None
+
+    def add(self, gt_id: int, phenotypes: list):
+        """Add the phenotypes a genotype maps to
+
+        Args:
+            gt_id (int): Genotype ID
+            phenotypes (list): Phenotypes (str) of the genotype
+
+        """
+        for ph in phenotypes:
+            ph_id = self._ph_ids.get(ph)
+            if ph_id is None:
+                ph_id = self._ph_ids[ph] = len(self.phenotypes)
+                self.phenotypes.append(ph)
+            self._ph_buffer.append(ph_id)
+            self._gt_buffer.append(gt_id)
+        if len(self._ph_buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Spill the buffered records to disk as a run sorted by phenotype
+        ID (and genotype ID within phenotypes)"""
+        if not self._ph_buffer:
+            return
+        if self._run_dir is None:
+            self._run_dir = tempfile.mkdtemp(
+                prefix="gpmap_runs_", dir=self.tmp_dir if self.tmp_dir
+                else os.path.dirname(os.path.abspath(self.output)))
+        records = np.stack([np.frombuffer(self._ph_buffer, dtype=np.int64),
+                            np.frombuffer(self._gt_buffer, dtype=np.int64)],
+                           axis=1)
+        records = records[np.argsort(records[:, 0], kind="stable")]
+        path = os.path.join(self._run_dir, f"run{len(self.runs)}.npy")
+        np.save(path, records)
+        self.runs.append(path)
+        self._ph_buffer, self._gt_buffer = array("q"), array("q")
+
+    def state(self) -> dict:
+        """Flush the buffer and return everything needed to continue 
+        writing later (see from_state), e.g. from a checkpoint"""
+        self.flush()
+        return {"phenotypes": list(self.phenotypes), "runs": list(self.runs),
+                "run_dir": self._run_dir}
+
+    @classmethod
+    def from_state(cls, output: str, state: dict, buffer_size: int = 2**22,
+                   tmp_dir: str = None):
+        """Writer that continues from a state returned by state. Runs 
+        spilled after the state was taken are overwritten.
+
+        Args:
+            output (str): see __init__
+            state (dict): Return value of state
+            buffer_size (int): see __init__
+            tmp_dir (str): see __init__
+
+        Returns:
+            GPMapWriter: writer with the phenotypes and runs of the state
+
+        """
+        writer = cls(output=output, buffer_size=buffer_size, tmp_dir=tmp_dir)
+        writer.phenotypes = list(state["phenotypes"])
+        writer._ph_ids = {ph: k for k, ph in enumerate(writer.phenotypes)}
+        writer.runs = list(state["runs"])
+        writer._run_dir = state["run_dir"]
+        return writer
+
+    def write(self):
+        """Merge all runs into the output file, keeping the runs"""
+        self.flush()
+        groups = heapq.merge(*[_run_groups(path) for path in self.runs],
+                             key=lambda group: group[0])
+        with open(self.output, "w") as file_out:
+            current = None
+            for ph_id, gt_ids in groups:
+                if ph_id != current:
+                    if current is not None:
+                        file_out.write("\n")
+                    file_out.write(self.phenotypes[ph_id])
+                    current = ph_id
+                file_out.write(" " + " ".join(map(str, gt_ids.tolist())))
+            if current is not None:
+                file_out.write("\n")
+
+    def discard(self):
+        """Remove the spilled runs (and any buffered records)"""
+        if self._run_dir is not None:
+            shutil.rmtree(self._run_dir)
+        self.runs, self._run_dir = [], None
+        self._ph_buffer, self._gt_buffer = array("q"), array("q")
+
+    def close(self):
+        """Merge all runs into the output file and remove them"""
+        self.write()
+        self.discard()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+def _run_groups(path: str, block: int = 2**16):
+    """Yield (phenotype ID, genotype IDs) of a run, block records at a time.
+    A phenotype spanning several blocks is yielded once per block."""
+    records = np.load(path, mmap_mode="r")
+    for start in range(0, len(records), block):
+        chunk = np.asarray(records[start:start + block])
+        bounds = np.flatnonzero(np.diff(chunk[:, 0])) + 1
+        for ids in np.split(chunk, bounds):
+            yield int(ids[0, 0]), ids[:, 1]
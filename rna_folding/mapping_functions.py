@@ -3,16 +3,38 @@ All function should take a single sequence as input and output a list
 of phenotypes (can be of size one as well)
 
 """
+import itertools
+import multiprocessing
+import os
+import pickle
+import random
+import shutil
+import time
+from collections import deque
+
 import numpy as np
 from typing import Callable
 
 from rna_folding.base_pairing import BasePairing
-from rna_folding.nussinov import BasePairMatrixNussinov
+from rna_folding.energy_cache import PhenotypeEnergyCache
+from rna_folding.gpmap_writer import GPMapWriter
+from rna_folding.energy_model import stacking_energies
+from rna_folding.vienna import ViennaRNABackend
+from rna_folding.result_cache import MaskResultCache, SQLiteResultCache, mask_signature
+from rna_folding.nussinov import BasePairMatrixNussinov, BatchBasePairMatrixNussinov
 from rna_folding.utils import bp_to_dotbracket, dotbracket_to_genotype, dotbracket_to_genotype_random, dict_to_gpmap
+from rna_folding.utils import symmetry_orbits, mirror_dotbracket, dotbracket_to_bp
+from rna_folding.utils import combinatorically_complete_genotypes
 import RNA
 
 
-def gp_mapper(input: str, output: str, mapping_function: Callable):
+def gp_mapper(input: str, output: str, mapping_function: Callable,
+              batch_size: int = None, workers: int = None, 
+              chunk_size: int = None, seed: int = None, 
+              buffer_size: int = None, tmp_dir: str = None,
+              checkpoint: str = None, checkpoint_interval: float = 600,
+              resume: bool = False, result_cache: SQLiteResultCache = None,
+              cache_config: str = None):
     """Takes file with genotypes, maps them to phenotypes and saves them in
     output file
 
@@ -21,34 +43,422 @@ def gp_mapper(input: str, output: str, mapping_function: Callable):
         output (str): Path to output file.
         mapping_function (function): A function takes a genotype (str) as 
         single positional argument and returns a list of phenotypes (str).
+        If batch_size is given, it takes a list of genotypes instead and 
+        returns one list of phenotypes per genotype. Batch backends (see 
+        backends.MappingBackend) are batch mapping functions.
+        batch_size (int): Number of genotypes passed to mapping_function at
+        once. Default = None (one genotype at a time, or the batch_size of 
+        a backend)
+        workers (int): Number of processes that map chunks of genotypes in
+        parallel. Default = None (map in this process)
+        chunk_size (int): Number of genotypes per chunk. Default = None 
+        (4096, rounded up to a multiple of batch_size)
+        seed (int): If given, the random number generators of numpy and 
+        random are seeded with seed + chunk number before each chunk, so 
+        results do not depend on the number of workers. Default = None
+        buffer_size (int): If given, stream the map through a GPMapWriter 
+        that holds at most buffer_size (phenotype, genotype) records in 
+        memory and spills the rest to disk. Default = None (collect the 
+        complete map in memory)
+        tmp_dir (str): Directory for records spilled to disk. Default = None
+        (next to the output file)
+        checkpoint (str): If given, the map is streamed to disk (with 
+        buffer_size, default 4194304) and the progress is saved to this file
+        every checkpoint_interval seconds, at the end of a chunk. It is 
+        removed once the output is written. Default = None
+        checkpoint_interval (float): Seconds between checkpoints. 
+        Default = 600
+        resume (bool): Continue from the checkpoint file if it exists. The 
+        output is the same as that of an uninterrupted run, given the same
+        arguments. If records spilled before the checkpoint are gone, the 
+        mapping starts over. Default = False
+        result_cache (SQLiteResultCache): Persistent cache that results are
+        looked up in before mapping, and new results are stored in. Only for
+        mappings that do not depend on the random state. Default = None
+        cache_config (str): Identifies the mapping in result_cache and in the
+        checkpoint, e.g. config_key("nussinov", base_pairing, min_loop_size,
+        ...). Required with result_cache or checkpoint, a checkpoint is only
+        resumed with the same cache_config. Default = None
 
     Returns:
         None
     
     """
-    ph_to_gt = {}
+    if batch_size is None and hasattr(mapping_function, "map_batch"):
+        batch_size = mapping_function.batch_size
+    if batch_size is None:
+        mapping = lambda genotype: [mapping_function(genotype)]
+    else:
+        mapping = lambda genotypes: [[phenotypes_] for phenotypes_ 
+                                     in mapping_function(genotypes)]
+    gp_mapper_multi(input=input, outputs=[output], mapping_function=mapping,
+                    batch_size=batch_size, workers=workers, 
+                    chunk_size=chunk_size, seed=seed, buffer_size=buffer_size,
+                    tmp_dir=tmp_dir, checkpoint=checkpoint, 
+                    checkpoint_interval=checkpoint_interval, resume=resume,
+                    result_cache=result_cache, cache_config=cache_config)
 
-    # Read genotypes and map to phenotypes
-    with open(input, "r") as file_in:
-        for i, sequence in enumerate(file_in):
-            seq = sequence.strip()
-            phenotypes_ = mapping_function(seq)
-            # add sequence ID to the phenotype that they map to
+
+def gp_mapper_multi(input: str, outputs: list, mapping_function: Callable,
+                    batch_size: int = None, workers: int = None,
+                    chunk_size: int = None, seed: int = None,
+                    buffer_size: int = None, tmp_dir: str = None,
+                    checkpoint: str = None, checkpoint_interval: float = 600,
+                    resume: bool = False, 
+                    result_cache: SQLiteResultCache = None,
+                    cache_config: str = None):
+    """Takes file with genotypes, maps them to phenotypes under several 
+    mappings (e.g. base-pairing rules) at once and saves one g-p map per 
+    mapping. The genotype file is read only once.
+
+    Args:
+        input (str): Path to input file.
+        outputs (list): Paths to output files, one per mapping.
+        mapping_function (function): A function takes a genotype (str) as 
+        single positional argument and returns one list of phenotypes (str)
+        per output. If batch_size is given, it takes a list of genotypes 
+        instead and returns the per-output lists for each genotype.
+        batch_size (int): Number of genotypes passed to mapping_function at
+        once. Default = None (one genotype at a time)
+        workers (int): see gp_mapper
+        chunk_size (int): see gp_mapper
+        seed (int): see gp_mapper
+        buffer_size (int): see gp_mapper, per output
+        tmp_dir (str): see gp_mapper
+        checkpoint (str): see gp_mapper
+        checkpoint_interval (float): see gp_mapper
+        resume (bool): see gp_mapper
+        result_cache (SQLiteResultCache): see gp_mapper
+        cache_config (str): see gp_mapper, must identify all mappings
+
+    Returns:
+        None
+
+    """
+    if (result_cache is not None or checkpoint is not None) \
+            and cache_config is None:
+        raise ValueError("Give a cache_config that identifies the mapping "
+                         "to use a result_cache or checkpoint")
+    cached = dict(result_cache=result_cache, cache_config=cache_config)
+    if checkpoint is not None and buffer_size is None:
+        buffer_size = 2**22
+    if buffer_size is not None:
+        chunk_size = _chunk_size(chunk_size, batch_size)
+        config = {"input": str(input), "outputs": list(map(str, outputs)),
+                  "batch_size": batch_size, "chunk_size": chunk_size, 
+                  "seed": seed, "mapping": cache_config}
+        start, state = 0, None
+        if resume and checkpoint is not None and os.path.exists(checkpoint):
+            state = _load_checkpoint(checkpoint, config)
+        if state is not None:
+            writers = [GPMapWriter.from_state(output=output, state=state_, 
+                                              buffer_size=buffer_size,
+                                              tmp_dir=tmp_dir) 
+                       for output, state_ in zip(outputs, state["writers"])]
+            start = state["start"]
+            np.random.set_state(state["np_random"])
+            random.setstate(state["random"])
+        else:
+            writers = [GPMapWriter(output=output, buffer_size=buffer_size, 
+                                   tmp_dir=tmp_dir) for output in outputs]
+
+        last_checkpoint = time.monotonic()
+        for i, phenotypes_per_output in map_genotypes(
+                input=input, mapping_function=mapping_function, 
+                batch_size=batch_size, workers=workers, 
+                chunk_size=chunk_size, seed=seed, start=start, **cached):
+            for writer, phenotypes_ in zip(writers, phenotypes_per_output):
+                writer.add(i, phenotypes_)
+            if checkpoint is not None and (i + 1) % chunk_size == 0 \
+                    and time.monotonic() - last_checkpoint >= checkpoint_interval:
+                _save_checkpoint(checkpoint, config, start=i + 1, 
+                                 writers=writers)
+                last_checkpoint = time.monotonic()
+        for writer in writers:
+            writer.write()
+        # the runs are only removed once no checkpoint refers to them
+        if checkpoint is not None and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        for writer in writers:
+            writer.discard()
+        return
+
+    ph_to_gt = [{} for _ in outputs]
+
+    def add_phenotypes(i, phenotypes_per_output):
+        # add sequence ID to the phenotype that they map to
+        for ph_to_gt_, phenotypes_ in zip(ph_to_gt, phenotypes_per_output):
             for ph in phenotypes_:
+                try:
+                    ph_to_gt_[ph].append(i)
+                except KeyError:
+                    ph_to_gt_[ph] = [i]
+
+    # Read genotypes and map to phenotypes
+    for i, phenotypes_per_output in map_genotypes(
+            input=input, mapping_function=mapping_function, 
+            batch_size=batch_size, workers=workers, chunk_size=chunk_size, 
+            seed=seed, **cached):
+        add_phenotypes(i, phenotypes_per_output)
+
+    # Write to output files (line example: "{ph} {gt_id} {gt_id} {gt_id}\n"
+    for output, ph_to_gt_ in zip(outputs, ph_to_gt):
+        dict_to_gpmap(ph_to_gt=ph_to_gt_, file=output)
+
+
+def map_genotypes(input: str, mapping_function: Callable, 
+                  batch_size: int = None, workers: int = None,
+                  chunk_size: int = None, seed: int = None, start: int = 0,
+                  result_cache: SQLiteResultCache = None, 
+                  cache_config: str = None):
+    """Read genotypes from file in chunks and map them, in a process pool if
+    workers is given. Results are yielded in input order.
+
+    Args:
+        input (str): Path to input file.
+        mapping_function (function): see gp_mapper
+        batch_size (int): see gp_mapper
+        workers (int): see gp_mapper
+        chunk_size (int): see gp_mapper
+        seed (int): see gp_mapper
+        start (int): Skip the genotypes before this ID, must be the start 
+        of a chunk. Default = 0
+        result_cache (SQLiteResultCache): see gp_mapper
+        cache_config (str): see gp_mapper
+
+    Yields:
+        (tuple): (genotype ID, result of mapping_function for the genotype)
+
+    """
+    chunk_size = _chunk_size(chunk_size, batch_size)
+
+    def chunks():
+        with open(input, "r") as file_in:
+            chunk = []
+            for i, sequence in enumerate(file_in):
+                if i < start:
+                    continue
+                chunk.append(sequence.strip())
+                if len(chunk) == chunk_size:
+                    yield i - chunk_size + 1, chunk, seed
+                    chunk = []
+            if chunk:
+                yield i - len(chunk) + 1, chunk, seed
+
+    tasks = chunks()
+    if result_cache is not None:
+        # only map the genotypes without cached result
+        pending = {}
+
+        def lookup(tasks):
+            for first, genotypes, seed_ in tasks:
+                cached = result_cache.get_many([cache_config + g 
+                                                for g in genotypes])
+                pending[first] = (genotypes, cached)
+                yield first, [g for g, result in zip(genotypes, cached)
+                              if result is None], seed_
+        tasks = lookup(tasks)
+
+    def merge(first, phenotypes):
+        if result_cache is None:
+            return phenotypes
+        genotypes, cached = pending.pop(first)
+        new = iter(phenotypes)
+        results = [next(new) if result is None else result 
+                   for result in cached]
+        result_cache.put_many([(cache_config + g, result) for g, result, c
+                               in zip(genotypes, results, cached) if c is None])
+        return results
+
+    if workers is None:
+        results = (_map_chunk(mapping_function, batch_size, chunk_size, task)
+                   for task in tasks)
+        for first, phenotypes in results:
+            yield from enumerate(merge(first, phenotypes), start=first)
+    else:
+        # fork passes the mapping function (and e.g. its BasePairing) to each
+        # worker once without pickling, so lambdas and closures work as well
+        context = multiprocessing.get_context(
+            "fork" if "fork" in multiprocessing.get_all_start_methods() 
+            else None)
+        with context.Pool(processes=workers, initializer=_init_worker,
+                          initargs=(mapping_function, batch_size, chunk_size)
+                          ) as pool:
+            # at most 2 chunks per worker in flight, unlike pool.imap which 
+            # reads the whole input ahead
+            in_flight = deque()
+            for task in itertools.chain(tasks, [None] * 2 * workers):
+                if task is not None:
+                    in_flight.append(pool.apply_async(_map_chunk_in_worker, 
+                                                      (task,)))
+                if in_flight and (task is None or len(in_flight) > 2 * workers):
+                    first, phenotypes = in_flight.popleft().get()
+                    yield from enumerate(merge(first, phenotypes), start=first)
+    if result_cache is not None:
+        result_cache.commit()
+
+
+def _chunk_size(chunk_size: int, batch_size: int) -> int:
+    """Default chunk size of 4096 genotypes, rounded to whole batches"""
+    if chunk_size is None:
+        chunk_size = 4096
+        if batch_size is not None:
+            chunk_size = -(-chunk_size // batch_size) * batch_size
+    return chunk_size
+
+
+def _save_checkpoint(path: str, config: dict, start: int, writers: list):
+    """Save the state after the first start genotypes, replacing the 
+    previous checkpoint only once the new one is complete"""
+    state = {"config": config, "start": start, 
+             "writers": [writer.state() for writer in writers],
+             "np_random": np.random.get_state(), "random": random.getstate()}
+    with open(path + ".tmp", "wb") as file_out:
+        pickle.dump(state, file_out)
+    os.replace(path + ".tmp", path)
+
+
+def _load_checkpoint(path: str, config: dict) -> dict:
+    """State saved by _save_checkpoint, or None if runs it refers to are
+    missing (the rest of them is removed, mapping then starts over)"""
+    with open(path, "rb") as file_in:
+        state = pickle.load(file_in)
+    if state["config"] != config:
+        raise ValueError(f"Checkpoint {path} was written for {state['config']}"
+                         f", can not resume with {config}")
+    if not all(os.path.exists(run) for writer in state["writers"]
+               for run in writer["runs"]):
+        for writer in state["writers"]:
+            if writer["run_dir"] is not None:
+                shutil.rmtree(writer["run_dir"], ignore_errors=True)
+        return None
+    return state
+
+
+_worker = None  # (mapping_function, batch_size, chunk_size) of a pool worker
+
+
+def _init_worker(mapping_function, batch_size, chunk_size):
+    global _worker
+    _worker = (mapping_function, batch_size, chunk_size)
+    # forked workers inherit numpy's random state of the parent and would all
+    # draw the same numbers, reseed from OS entropy (chunks of runs with a 
+    # seed are reseeded in _map_chunk)
+    np.random.seed()
+    random.seed()
+
+
+def _map_chunk_in_worker(task):
+    return _map_chunk(*_worker, task)
+
+
+def _map_chunk(mapping_function, batch_size, chunk_size, task):
+    """Map a chunk (first genotype ID, genotypes, seed) of genotypes"""
+    first, genotypes, seed = task
+    if seed is not None:
+        chunk_seed = (seed + first // chunk_size) % 2**32
+        np.random.seed(chunk_seed)
+        random.seed(chunk_seed)
+    if batch_size is None:
+        return first, [mapping_function(g) for g in genotypes]
+    phenotypes = []
+    for b in range(0, len(genotypes), batch_size):
+        phenotypes.extend(mapping_function(genotypes[b:b+batch_size]))
+    return first, phenotypes
+
+
+def gp_mapper_complete(l: int, alphabet: str, output: str,
+                       mapping_function: Callable, base_pairing: BasePairing,
+                       reverse: bool = False, input: str = None):
+    """Maps the combinatorically complete genotype space of length l (in the
+    order of combinatorically_complete_genotypes, i.e. the genotype IDs of
+    build_genotype_space.py) and saves it as gp_mapper does. Only one 
+    representative per symmetry orbit is folded: relabeling bases with an 
+    automorphism of the base-pairing graph does not change the pairing mask,
+    so all members of an orbit share the phenotypes of the representative.
+
+    The output is identical to gp_mapper if mapping_function only depends on
+    the pairing mask of the genotype (e.g. nussinov, nussinov_mfe), but not 
+    for energy models that distinguish bases (e.g. viennaRNA_mfe).
+
+    Args:
+        l (int): Sequence length.
+        alphabet (str): Alphabet as a continuous string, e.g. "AUGC".
+        output (str): Path to output file.
+        mapping_function (function): A function takes a genotype (str) as 
+        single positional argument and returns a list of phenotypes (str).
+        base_pairing (BasePairing): Base-pairing the automorphisms are taken
+        from.
+        reverse (bool): Also fold only one of a genotype and its reverse, the
+        phenotypes of the reverse are the mirrored structures. Only gives the
+        same set of phenotypes per genotype as gp_mapper, order and 
+        multiplicity of suboptimal structures and the structures picked by 
+        structures_max can differ. Default = False
+        input (str): Genotype file the map is made for. If given, it is 
+        checked to hold exactly the complete genotype space in the order of
+        the genotype IDs, raises ValueError otherwise. Default = None
+
+    Returns:
+        None
+
+    """
+    if input is not None:
+        _check_complete_genotype_space(input, l, alphabet)
+    ph_to_gt = {}
+    first = {}  # (first genotype ID, position in its list) for each phenotype
+
+    for representative, members in symmetry_orbits(
+            l, alphabet, base_pairing.automorphisms(), reverse):
+        phenotypes = mapping_function(representative)
+        mirrored = None
+        for i, reversed_ in members:
+            if reversed_:
+                if mirrored is None:
+                    mirrored = [mirror_dotbracket(ph) for ph in phenotypes]
+                phenotypes_ = mirrored
+            else:
+                phenotypes_ = phenotypes
+            for position, ph in enumerate(phenotypes_):
                 try:
                     ph_to_gt[ph].append(i)
                 except KeyError:
                     ph_to_gt[ph] = [i]
+                if ph not in first or (i, position) < first[ph]:
+                    first[ph] = (i, position)
 
-    # Write to output file (line example: "{ph} {gt_id} {gt_id} {gt_id}\n"
+    # restore the order in which gp_mapper encounters phenotypes and IDs
+    ph_to_gt = {ph: sorted(ph_to_gt[ph])
+                for ph in sorted(ph_to_gt, key=first.get)}
     dict_to_gpmap(ph_to_gt=ph_to_gt, file=output)
-    
+
+
+def _check_complete_genotype_space(input: str, l: int, alphabet: str):
+    """Raise ValueError unless input holds the genotypes of 
+    combinatorically_complete_genotypes(l, alphabet), in this order"""
+    expected = ("".join(g) for g in 
+                combinatorically_complete_genotypes(l, alphabet))
+    with open(input, "r") as file_in:
+        for i, (line, genotype) in enumerate(
+                itertools.zip_longest(file_in, expected), start=1):
+            found = line.strip() if line is not None else None
+            if found != genotype:
+                raise ValueError(
+                    f"{input} is not the complete genotype space of length {l}"
+                    f" over {alphabet} in genotype ID order: line {i} is "
+                    f"{found!r} instead of {genotype!r}")
+
 
 def nussinov(genotype: str, 
              base_pairing: BasePairing, 
              min_loop_size: int, 
              suboptimal: int, 
-             structures_max: int) -> list:
+             structures_max: int,
+             engine: str = "loop",
+             compact: bool = False,
+             max_span: int = None,
+             sample: bool = False,
+             seed: int = None,
+             cache: MaskResultCache = None) -> list:
     """Nussinov genotype-phenotype mapping wrapper
 
     Args:
@@ -57,25 +467,341 @@ def nussinov(genotype: str,
         min_loop_size (int): minimum size that RNA loops must have
         suboptimal (int): How many base-pairs off from optimum are allowed
         structures_max (int): How many structures to generate at most
+        engine (str): Engine used to fill the Nussinov matrix, "loop", 
+                      "vectorized" or "four_russians". Default = "loop"
+        compact (bool): Use compact storage for the Nussinov matrix, see 
+                        BasePairMatrixNussinov. Default = False
+        max_span (int): Maximum base-pair span for local folding, see
+                        BasePairMatrixNussinov.fill_matrix. Default = None
+        sample (bool): Instead of enumerating suboptimal structures until 
+                       structures_max is reached, draw structures_max 
+                       structures uniformly at random (with replacement) from
+                       all suboptimal structures and keep the distinct ones
+                       in the order they were drawn. Default = False
+        seed (int): Random seed for sampling. Default = None
+        cache (MaskResultCache): Serve genotypes with the pairing mask of an 
+                                 earlier genotype from this cache instead of
+                                 folding them. Default = None
 
     Returns:
         list: List of phenotypes that the genotypes maps to
 
     """
-    P = BasePairMatrixNussinov(n=len(genotype), base_pairing=base_pairing)
-    P.fill_matrix(seq=genotype, min_loop_size=min_loop_size)
-    strucs = P.traceback_subopt(seq=genotype, d=suboptimal,
-                                structures_max=structures_max)
-    # print(genotype)
-    # for s in strucs:
-    #     print(bp_to_dotbracket(s.B, l=len(genotype)))
-    #     for pair in s.B:
-    #         print(genotype[pair[0]-1], genotype[pair[1]-1])
-    phenotypes = [bp_to_dotbracket(s.B, l=len(genotype)) for s in strucs]
+    if cache is not None and not (sample and seed is None):
+        key = (mask_signature(genotype, base_pairing, min_loop_size, max_span),
+               min_loop_size, suboptimal, structures_max, max_span, sample, 
+               seed)
+        phenotypes = cache.get(key)
+        if phenotypes is None:
+            phenotypes = nussinov(genotype=genotype, base_pairing=base_pairing,
+                                  min_loop_size=min_loop_size, 
+                                  suboptimal=suboptimal, 
+                                  structures_max=structures_max, 
+                                  engine=engine, compact=compact, 
+                                  max_span=max_span, sample=sample, seed=seed)
+            cache.put(key, phenotypes)
+        return list(phenotypes)
+    return list(nussinov_iter(genotype=genotype, base_pairing=base_pairing,
+                              min_loop_size=min_loop_size, 
+                              suboptimal=suboptimal, 
+                              structures_max=structures_max, engine=engine,
+                              compact=compact, max_span=max_span,
+                              sample=sample, seed=seed))
+
+
+def nussinov_iter(genotype: str, 
+                  base_pairing: BasePairing, 
+                  min_loop_size: int, 
+                  suboptimal: int, 
+                  structures_max: int,
+                  engine: str = "loop",
+                  compact: bool = False,
+                  max_span: int = None,
+                  sample: bool = False,
+                  seed: int = None):
+    """Generator version of the Nussinov genotype-phenotype mapping wrapper.
+    Yields phenotypes one by one as the traceback finds them, so callers can
+    score and discard them without holding the whole suboptimal set.
+
+    Args:
+        see nussinov
+
+    Yields:
+        str: Phenotype in dot-bracket notation
+
+    """
+    P = BasePairMatrixNussinov(n=len(genotype), base_pairing=base_pairing, 
+                               compact=compact)
+    P.fill_matrix(seq=genotype, min_loop_size=min_loop_size, engine=engine,
+                  max_span=max_span)
+    if sample:
+        if structures_max is None:
+            raise ValueError("structures_max (sample size) is required when sampling")
+        strucs = P.sample_subopt(seq=genotype, d=suboptimal, k=structures_max, 
+                                 seed=seed)
+    else:
+        strucs = P.iter_traceback_subopt(seq=genotype, d=suboptimal,
+                                         structures_max=structures_max)
+    drawn = set()
+    try:
+        for s in strucs:
+            ph = bp_to_dotbracket(s.B, l=len(genotype))
+            if sample:  # drawn with replacement, list each phenotype once
+                if ph in drawn:
+                    continue
+                drawn.add(ph)
+            yield ph
+    finally:
+        P.release()
+
+
+def nussinov_bands(genotype: str, 
+                   base_pairing: BasePairing, 
+                   min_loop_size: int, 
+                   suboptimal: list, 
+                   structures_max: int,
+                   engine: str = "loop",
+                   compact: bool = False,
+                   max_span: int = None) -> list:
+    """Nussinov genotype-phenotype mapping for several suboptimal bands from
+    a single traceback of the widest band, see 
+    BasePairMatrixNussinov.traceback_subopt_bands. The phenotypes per band 
+    are the same as from nussinov with that suboptimal value.
+
+    Args:
+        genotype (str): genotype to be mapped
+        base_pairing (BasePairing): An BasePairing object defining pairing ules
+        min_loop_size (int): minimum size that RNA loops must have
+        suboptimal (list): How many base-pairs off from optimum are allowed,
+                           one value per band
+        structures_max (int): How many structures to generate at most per
+                              band
+        engine (str): Engine used to fill the Nussinov matrix. Default = "loop"
+        compact (bool): Use compact storage for the Nussinov matrix. 
+                        Default = False
+        max_span (int): Maximum base-pair span for local folding, see
+                        BasePairMatrixNussinov.fill_matrix. Default = None
+
+    Returns:
+        list: One list of phenotypes per band, in the order of suboptimal
+
+    """
+    P = BasePairMatrixNussinov(n=len(genotype), base_pairing=base_pairing, 
+                               compact=compact)
+    P.fill_matrix(seq=genotype, min_loop_size=min_loop_size, engine=engine,
+                  max_span=max_span)
+    if structures_max is None:
+        structures_max = np.inf
+    bands = P.traceback_subopt_bands(seq=genotype, ds=suboptimal, 
+                                     structures_max=structures_max)
+    P.release()
+    return [[bp_to_dotbracket(s.B, l=len(genotype)) for s in bands[d]] 
+            for d in suboptimal]
+
+
+def nussinov_multi(genotype: str, 
+                   base_pairings: list, 
+                   min_loop_size: int, 
+                   suboptimal: int, 
+                   structures_max: int,
+                   engine: str = "loop",
+                   max_span: int = None,
+                   cache: MaskResultCache = None) -> list:
+    """Nussinov genotype-phenotype mapping under several base-pairing rules.
+    The genotype is folded once per distinct pairing mask: rules that agree
+    on all pairs of bases present in the genotype give the same structures,
+    so they share the phenotypes of the first of them.
+
+    Args:
+        genotype (str): genotype to be mapped
+        base_pairings (list): BasePairing objects with the same bases
+        min_loop_size (int): minimum size that RNA loops must have
+        suboptimal (int): How many base-pairs off from optimum are allowed
+        structures_max (int): How many structures to generate at most
+        engine (str): Engine used to fill the Nussinov matrix. Default = "loop"
+        max_span (int): Maximum base-pair span for local folding, see
+                        BasePairMatrixNussinov.fill_matrix. Default = None
+        cache (MaskResultCache): see nussinov, shared by all base-pairing
+                                 rules. Default = None
+
+    Returns:
+        list: One list of phenotypes per base-pairing rule
+
+    """
+    ids = base_pairings[0].encode(genotype)
+    by_mask = {}  # pairing mask (bytes) -> phenotypes
+    phenotypes = []
+    for base_pairing in base_pairings:
+        mask = base_pairing.A[ids[:, None], ids[None, :]].astype(bool)
+        key = mask.tobytes()
+        if key not in by_mask:
+            by_mask[key] = nussinov(genotype=genotype, 
+                                    base_pairing=base_pairing,
+                                    min_loop_size=min_loop_size, 
+                                    suboptimal=suboptimal,
+                                    structures_max=structures_max, 
+                                    engine=engine, max_span=max_span,
+                                    cache=cache)
+        phenotypes.append(by_mask[key])
+    return phenotypes
+
+
+def nussinov_batch(genotypes: list,
+                   base_pairing: BasePairing,
+                   min_loop_size: int,
+                   suboptimal: int,
+                   structures_max: int) -> list:
+    """Batched Nussinov genotype-phenotype mapping wrapper. Genotypes of
+    equal length are folded together in one BatchBasePairMatrixNussinov.
+
+    Args:
+        genotypes (list): genotypes (str) to be mapped
+        base_pairing (BasePairing): An BasePairing object defining pairing ules
+        min_loop_size (int): minimum size that RNA loops must have
+        suboptimal (int): How many base-pairs off from optimum are allowed
+        structures_max (int): How many structures to generate at most
+
+    Returns:
+        list: One list of phenotypes per genotype, in input order
+
+    """
+    by_length = {}  # group genotype indices by sequence length
+    for k, genotype in enumerate(genotypes):
+        by_length.setdefault(len(genotype), []).append(k)
+
+    phenotypes = [None] * len(genotypes)
+    for n, ids in by_length.items():
+        P = BatchBasePairMatrixNussinov(n=n, base_pairing=base_pairing)
+        P.fill_matrix(seqs=[genotypes[k] for k in ids], 
+                      min_loop_size=min_loop_size)
+        strucs = P.traceback_subopt(d=suboptimal, structures_max=structures_max)
+        for k, strucs_ in zip(ids, strucs):
+            phenotypes[k] = [bp_to_dotbracket(s.B, l=n) for s in strucs_]
 
     return phenotypes
 
 
+def nussinov_prefix_sharing(genotypes: list,
+                            base_pairing: BasePairing,
+                            min_loop_size: int,
+                            suboptimal: int,
+                            structures_max: int,
+                            max_span: int = None) -> list:
+    """Batched Nussinov genotype-phenotype mapping wrapper for genotypes in
+    lexicographic order (e.g. from build_genotype_space.py). Consecutive 
+    genotypes of equal length reuse the matrix columns of their common 
+    prefix, see BasePairMatrixNussinov.refill_suffix.
+
+    Args:
+        genotypes (list): genotypes (str) to be mapped
+        base_pairing (BasePairing): An BasePairing object defining pairing ules
+        min_loop_size (int): minimum size that RNA loops must have
+        suboptimal (int): How many base-pairs off from optimum are allowed
+        structures_max (int): How many structures to generate at most
+        max_span (int): Maximum base-pair span for local folding, see
+                        BasePairMatrixNussinov.fill_matrix. Default = None
+
+    Returns:
+        list: One list of phenotypes per genotype, in input order
+
+    """
+    phenotypes = []
+    P, previous = None, None
+    for genotype in genotypes:
+        if P is None or len(genotype) != len(previous):
+            P = BasePairMatrixNussinov(n=len(genotype), 
+                                       base_pairing=base_pairing)
+            P.fill_matrix(seq=genotype, min_loop_size=min_loop_size, 
+                          max_span=max_span)
+        else:
+            prefix = 0
+            while prefix < len(genotype) and \
+                    genotype[prefix] == previous[prefix]:
+                prefix += 1
+            P.refill_suffix(seq=genotype, prefix=prefix)
+        strucs = P.iter_traceback_subopt(seq=genotype, d=suboptimal,
+                                         structures_max=structures_max)
+        phenotypes.append([bp_to_dotbracket(s.B, l=len(genotype)) 
+                           for s in strucs])
+        previous = genotype
+
+    return phenotypes
+
+
+def nussinov_best(genotype: str, 
+                  base_pairing: BasePairing, 
+                  min_loop_size: int, 
+                  suboptimal: int, 
+                  score: Callable,
+                  bound: Callable = None) -> list:
+    """Nussinov genotype-phenotype mapping to the suboptimal structure with 
+    the lowest score, found by branch and bound without keeping the 
+    suboptimal set, see BasePairMatrixNussinov.best_subopt.
+
+    Args:
+        genotype (str): genotype to be mapped
+        base_pairing (BasePairing): An BasePairing object defining pairing ules
+        min_loop_size (int): minimum size that RNA loops must have
+        suboptimal (int): How many base-pairs off from optimum are allowed
+        score (function): Takes a phenotype (str) and returns its score, 
+                          lower is better
+        bound (function): Takes the phenotype of a partial structure (str,
+                          unresolved sites are dots) and its list of open 
+                          segments and returns a lower bound on the score of 
+                          its completions. Default = None (no pruning)
+
+    Returns:
+        list: The best phenotype
+
+    """
+    l = len(genotype)
+    P = BasePairMatrixNussinov(n=l, base_pairing=base_pairing)
+    P.fill_matrix(seq=genotype, min_loop_size=min_loop_size)
+    bound_ = None
+    if bound is not None:
+        bound_ = lambda B, segments: bound(bp_to_dotbracket(B, l=l), segments)
+    s, _ = P.best_subopt(seq=genotype, d=suboptimal, 
+                         score=lambda B: score(bp_to_dotbracket(B, l=l)),
+                         bound=bound_)
+    return [bp_to_dotbracket(s.B, l=l)]
+
+
+def nussinov_ranked(genotype: str, 
+                    base_pairing: BasePairing, 
+                    min_loop_size: int, 
+                    suboptimal: int, 
+                    ranking: list) -> list:
+    """Nussinov genotype-phenotype mapping to the best ranked suboptimal
+    phenotype. Instead of tracing back the suboptimal set and looking up the
+    rank of every structure (as flatten_gp_map.py does afterwards), walks 
+    down the ranking and stops at the first phenotype in the suboptimal band
+    of the genotype, see BasePairMatrixNussinov.in_subopt_band. Same result 
+    as flattening a map created without structures_max.
+
+    Args:
+        genotype (str): genotype to be mapped
+        base_pairing (BasePairing): An BasePairing object defining pairing ules
+        min_loop_size (int): minimum size that RNA loops must have
+        suboptimal (int): How many base-pairs off from optimum are allowed
+        ranking (list): Phenotypes (str), best first
+
+    Returns:
+        list: The best ranked phenotype, or the first suboptimal structure if
+              no phenotype of the ranking is in the suboptimal band
+
+    """
+    P = BasePairMatrixNussinov(n=len(genotype), base_pairing=base_pairing)
+    P.fill_matrix(seq=genotype, min_loop_size=min_loop_size)
+    for ph in ranking:
+        if len(ph) != len(genotype):
+            continue
+        B = [(l + 1, j + 1) for l, j in dotbracket_to_bp(ph)]
+        if P.in_subopt_band(seq=genotype, B=B, d=suboptimal):
+            return [ph]
+    s = next(P.iter_traceback_subopt(seq=genotype, d=suboptimal))
+    return [bp_to_dotbracket(s.B, l=len(genotype))]
+
+
 def nussinov_mfe(genotype: str, 
                  base_pairing: BasePairing, 
                  min_loop_size: int, 
@@ -83,7 +809,11 @@ def nussinov_mfe(genotype: str,
                  structures_max: int,
                  seed: int,
                  base_pair: str = "GC",
-                 deterministic: bool = False)-> list:
+                 deterministic: bool = False,
+                 sample: bool = False,
+                 energy_cache: PhenotypeEnergyCache = None,
+                 backend: ViennaRNABackend = None,
+                 prefilter: int = None)-> list:
     """Nussinov + mfe ranking genotype-phenotype mapping wrapper.
     Candidate phenotypes are generated using Nussinov's algorithm which are
     then mapped to a canonical genotype and scored using viennaRNA package
@@ -98,30 +828,68 @@ def nussinov_mfe(genotype: str,
         seed (int): Random seed to use for generation of canonical genotype
         deterministic (bool): If True, always use G to for unpaired sites, else
         randomly pick G or C, if "GC" is given as base-pair
+        sample (bool): Score structures_max candidates drawn uniformly from
+        all suboptimal structures instead of the first structures_max found
+        energy_cache (PhenotypeEnergyCache): Look up energies of phenotypes
+        seen before instead of recomputing them, created with the same 
+        base_pair, deterministic and seed. Default = None
+        backend (ViennaRNABackend): Backend used to evaluate energies. 
+        Default = None (module-level ViennaRNA functions)
+        prefilter (int): Only evaluate the prefilter candidates with lowest
+        approximate energy (see energy_model.stacking_energies) with 
+        ViennaRNA. Default = None (evaluate all candidates)
 
     Returns:
         list: List of phenotypes that the genotypes maps to
         
     """
-    phenotypes = nussinov(genotype=genotype, base_pairing=base_pairing, 
-                            min_loop_size=min_loop_size, suboptimal=suboptimal, 
-                            structures_max=structures_max)
+    phenotypes = nussinov_iter(genotype=genotype, base_pairing=base_pairing, 
+                               min_loop_size=min_loop_size, 
+                               suboptimal=suboptimal, 
+                               structures_max=structures_max,
+                               sample=sample, seed=seed)
     
-    g_fe_map = []
+    if energy_cache is not None and \
+            not energy_cache.matches(base_pair, deterministic, seed):
+        raise ValueError("energy_cache was created for different base_pair, "
+                         "deterministic or seed")
 
-    for ph in phenotypes:
-        # turn into a canonical alphabet
-        seq_canon = dotbracket_to_genotype(dotbracket=ph,
-                                            base_pair=base_pair,
-                                            random=deterministic,
-                                            seed=seed)
-        g_fe_map.append(RNA.eval_structure_simple(seq_canon, ph))
-    
-    mfe_ph_id = np.argmin(g_fe_map)  # get index of mfe phenotype
-    if g_fe_map[mfe_ph_id] >= 0:  # if energy is above 0
-        mfe_ph = "."*len(phenotypes[mfe_ph_id])  # phenotype is unf.
+    # turn into a canonical alphabet
+    if energy_cache is not None:
+        canonical = energy_cache.genotype
     else:
-        mfe_ph = phenotypes[mfe_ph_id]  # get mfe phenotype
+        canonical = lambda ph: dotbracket_to_genotype(dotbracket=ph,
+                                                      base_pair=base_pair,
+                                                      random=deterministic,
+                                                      seed=seed)
+
+    if prefilter is not None:
+        phenotypes = list(phenotypes)
+        seqs_canon = [canonical(ph) for ph in phenotypes]
+        approx = stacking_energies(seqs_canon, phenotypes)
+        # keep candidates in traceback order for ties of the exact energies
+        keep = np.sort(np.argsort(approx, kind="stable")[:prefilter])
+        phenotypes = [(phenotypes[k], seqs_canon[k]) for k in keep]
+    else:
+        phenotypes = ((ph, None) for ph in phenotypes)
+
+    mfe_ph, mfe = None, None
+
+    for ph, seq_canon in phenotypes:
+        if energy_cache is not None:
+            fe = energy_cache.energy(ph, seq_canon=seq_canon)
+        else:
+            if seq_canon is None:
+                seq_canon = canonical(ph)
+            if backend is not None:
+                fe = backend.eval_structure(seq_canon, ph)
+            else:
+                fe = RNA.eval_structure_simple(seq_canon, ph)
+        if mfe is None or fe < mfe:  # keep first phenotype with lowest energy
+            mfe_ph, mfe = ph, fe
+    
+    if mfe >= 0:  # if energy is above 0
+        mfe_ph = "."*len(mfe_ph)  # phenotype is unf.
     
     return [mfe_ph]
 
@@ -133,7 +901,8 @@ def debug_nussinov_mfe(genotype: str,
                  structures_max: int,
                  seed: int,
                  base_pair: str = "GC",
-                 deterministic: bool = False) -> list:
+                 deterministic: bool = False,
+                 energy_cache: PhenotypeEnergyCache = None) -> list:
     """Nussinov + mfe ranking genotype-phenotype mapping wrapper.
     Candidate phenotypes are generated using Nussinov's algorithm which are
     then mapped to a canonical genotype and scored using viennaRNA package
@@ -148,6 +917,12 @@ def debug_nussinov_mfe(genotype: str,
         seed (int): Random seed to use for generation of canonical genotype
         deterministic (bool): If True, always use G to for unpaired sites, else
         randomly pick G or C, if "GC" is given as base-pair
+        energy_cache (PhenotypeEnergyCache): Take energies from the cache 
+        instead of evaluating a new random canonical genotype for every 
+        phenotype, created with the same base_pair, deterministic and seed.
+        The energies are then those of the canonical genotypes of 
+        nussinov_mfe (one base pair, see dotbracket_to_genotype) rather than
+        of dotbracket_to_genotype_random. Default = None
 
     Returns:
         list: List of phenotypes that the genotypes maps to
@@ -157,9 +932,17 @@ def debug_nussinov_mfe(genotype: str,
                           min_loop_size=min_loop_size, suboptimal=suboptimal,
                           structures_max=structures_max)
 
+    if energy_cache is not None and \
+            not energy_cache.matches(base_pair, deterministic, seed):
+        raise ValueError("energy_cache was created for different base_pair, "
+                         "deterministic or seed")
+
     g_fe_map = []
 
     for ph in phenotypes:
+        if energy_cache is not None:
+            g_fe_map.append(energy_cache.energy(ph))
+            continue
         # turn into a canonical alphabet
         seq_canon = dotbracket_to_genotype_random(dotbracket=ph)
         g_fe_map.append(RNA.eval_structure_simple(seq_canon, ph))
@@ -172,25 +955,50 @@ def debug_nussinov_mfe(genotype: str,
     return [mfe_ph], phenotypes, g_fe_map
 
 
-def viennaRNA_mfe(genotype: str) -> list:
+def viennaRNA_mfe(genotype: str, backend: ViennaRNABackend = None) -> list:
     """Predict RNA secondary structure using default ViennaRNA mfe function.
     Args:
         genotype (str): Input genotype
+        backend (ViennaRNABackend): Backend used to fold, e.g. with changed 
+        model details. Default = None (RNA.fold)
 
     Returns:
         list: List of phenotype the genotype maps to.
         
     """
-    mfe_ph, mfe = RNA.fold(genotype)
+    if backend is not None:
+        mfe_ph, mfe = backend.fold(genotype)
+    else:
+        mfe_ph, mfe = RNA.fold(genotype)
 
     return [mfe_ph]
 
 
+def viennaRNA_mfe_batch(genotypes: list, 
+                        backend: ViennaRNABackend = None) -> list:
+    """Batched version of viennaRNA_mfe, see ViennaRNABackend.fold_many
+
+    Args:
+        genotypes (list): Input genotypes (str)
+        backend (ViennaRNABackend): Backend used to fold. Default = None 
+        (backend with ViennaRNA default model details)
+
+    Returns:
+        list: One list of phenotypes per genotype, in input order
+
+    """
+    if backend is None:
+        backend = ViennaRNABackend()
+    return [[mfe_ph] for mfe_ph, mfe in backend.fold_many(genotypes)]
+
+
 def nussinov_canonical_fe(genotype: str, 
                  base_pairing: BasePairing, 
                  min_loop_size: int, 
                  suboptimal: int, 
-                 structures_max: int) -> list:
+                 structures_max: int,
+                 backend: ViennaRNABackend = None,
+                 prefilter: int = None) -> list:
     """Nussinov + free energy calc genotype-phenotype mapping wrapper.
     Candidate phenotypes are generated using Nussinov's algorithm which are
     then mapped to a canonical genotype and scored using viennaRNA package.
@@ -202,6 +1010,12 @@ def nussinov_canonical_fe(genotype: str,
         min_loop_size (int): minimum size that RNA loops must have
         suboptimal (int): How many base-pairs off from optimum are allowed
         structures_max (int): How many structures to generate at most
+        backend (ViennaRNABackend): Backend used to evaluate all phenotypes 
+        on one fold compound of the genotype. Default = None (new backend 
+        with ViennaRNA default model details)
+        prefilter (int): Only evaluate and report the prefilter phenotypes 
+        with lowest approximate energy (see energy_model.stacking_energies).
+        Default = None (all phenotypes)
 
     Returns:
         list: (List of phenotypes where phenotype is a comma-separated string 
@@ -210,14 +1024,16 @@ def nussinov_canonical_fe(genotype: str,
                 list is sorted by free energy, low to high
         
     """
+    if backend is None:
+        backend = ViennaRNABackend()
     phenotypes = nussinov(genotype=genotype, base_pairing=base_pairing, 
-                            min_loop_size=min_loop_size, suboptimal=suboptimal, 
-                            structures_max=structures_max)
-
-    energies = []
-    for ph in phenotypes:
-        # turn into a canonical alphabet
-        energies.append(RNA.eval_structure_simple(genotype, ph))
+                          min_loop_size=min_loop_size, suboptimal=suboptimal, 
+                          structures_max=structures_max)
+    if prefilter is not None:
+        approx = stacking_energies(genotype, phenotypes)
+        keep = np.sort(np.argsort(approx, kind="stable")[:prefilter])
+        phenotypes = [phenotypes[k] for k in keep]
+    energies = backend.eval_structures(genotype, phenotypes)
     
     # sort both lists based energy values (low to high)
     sorted_gf_map = [p+","+str(np.round(e, 2)) for e, p in sorted(zip(energies, phenotypes), key=lambda pair: pair[0])]
@@ -5,32 +5,232 @@ GitHub: lgolbach
 
 """
 import numpy as np
+import random
+from bisect import bisect_left
+from functools import lru_cache
+from rna_folding.dp_matrix import BandedMatrix, TriangularMatrix
 from rna_folding.secondary_structure import SecondaryStructure
 from rna_folding.base_pairing import BasePairing
 
 
+def _cell_indices(b: np.ndarray, i: np.ndarray, k: int, n: int, min_loop_size: int, layout: str = "dense",
+                  max_span: int = None) -> tuple:
+    """Flat indices needed to compute cells [i, i+k] of the b-th matrix in a stack of (n+1)x(n+1) matrices with a
+    matching stack of nxn pairing masks: the indices of [i, j], [i, j-1] and, for all candidates l in
+    range(max(i, j-max_span), j-min_loop_size), of [i, l-1], [l+1, j-1] and the pairing mask entry of (l, j). The
+    last three are None if no base-pair fits into segments of size k. For layout "triangular" or "banded", indices
+    point into the flat array of a single TriangularMatrix or BandedMatrix instead of a stack of dense matrices.
+
+    """
+    if layout == "triangular":
+        index, offset = (lambda i_, j_: TriangularMatrix.flat_index(i_, j_, n)), np.zeros_like(b)
+    elif layout == "banded":
+        index, offset = (lambda i_, j_: BandedMatrix.flat_index(i_, j_, n, max_span)), np.zeros_like(b)
+    else:
+        index, offset = (lambda i_, j_: i_*(n+1) + j_), b * (n+1)**2
+    j = i + k
+    ij, ij_unpaired = offset + index(i, j), offset + index(i, j-1)
+    if max_span is not None and k > max_span:  # only base-pairs (l, j) with j - l <= max_span
+        first, n_candidates = j - max_span, max_span - min_loop_size
+    else:
+        first, n_candidates = i, k - min_loop_size
+    if n_candidates <= 0:
+        return ij, ij_unpaired, None, None, None
+    I, J, offset = i[:, None], j[:, None], offset[:, None]
+    L = first[:, None] + np.arange(n_candidates)[None, :]
+    return (ij, ij_unpaired, offset + index(I, L-1), offset + index(L+1, J-1),
+            b[:, None]*n*n + (L-1)*n + J-1)
+
+
+@lru_cache(maxsize=32)
+def _diagonal_indices(n: int, min_loop_size: int, layout: str = "dense", max_span: int = None) -> tuple:
+    """Flat indices into a (n+1)x(n+1) matrix and a nxn pairing mask needed to fill the matrix one diagonal at a
+    time, see _cell_indices. With max_span only row 1 is computed for diagonals k > max_span.
+
+    Args:
+        n (int): Sequence length.
+        min_loop_size (int): Minimum loop length.
+        layout (str): Index into a dense matrix ("dense") or the flat array of a TriangularMatrix ("triangular")
+                      or BandedMatrix ("banded").
+        max_span (int): Maximum base-pair span. Default = None (no maximum)
+
+    Returns:
+        (tuple): One tuple (ij, ij_unpaired, left, right, lj) per diagonal k = 1, ..., n-1
+
+    """
+    diagonals = []
+    for k in range(1, n):
+        i = np.arange(1, n - k + 1) if max_span is None or k <= max_span else np.array([1])
+        diagonals.append(_cell_indices(np.zeros_like(i), i, k, n, min_loop_size, layout, max_span))
+    return tuple(diagonals)
+
+
+@lru_cache(maxsize=32)
+def _batch_diagonal_indices(n: int, min_loop_size: int, batch_size: int) -> tuple:
+    """Like _diagonal_indices but for a stack of batch_size matrices.
+
+    """
+    diagonals = []
+    for k in range(1, n):
+        b, i = np.repeat(np.arange(batch_size), n - k), np.tile(np.arange(1, n - k + 1), batch_size)
+        diagonals.append(_cell_indices(b, i, k, n, min_loop_size))
+    return tuple(diagonals)
+
+
+@lru_cache(maxsize=32)
+def _neighbor_diagonal_indices(n: int, min_loop_size: int, a: int) -> tuple:
+    """Like _diagonal_indices but for a stack of the n*(a-1) single-point mutants of a sequence, ordered by mutated
+    position. Only holds the cells [i, j] with i <= p <= j for mutated position p, all other cells are the same as
+    in the matrix of the unmutated sequence.
+
+    Args:
+        n (int): Sequence length.
+        min_loop_size (int): Minimum loop length.
+        a (int): Alphabet size.
+
+    Returns:
+        (tuple): One tuple (ij, ij_unpaired, left, right, lj) per diagonal k = 1, ..., n-1
+
+    """
+    diagonals = []
+    for k in range(1, n):
+        b, i = [], []
+        for p in range(1, n+1):
+            rows = np.arange(max(1, p - k), min(p, n - k) + 1)
+            for c in range(a - 1):
+                b.append(np.full_like(rows, (p-1)*(a-1) + c))
+                i.append(rows)
+        diagonals.append(_cell_indices(np.concatenate(b), np.concatenate(i), k, n, min_loop_size))
+    return tuple(diagonals)
+
+
+def pairing_candidates(seq: str, base_pairing: BasePairing, min_loop_size: int, max_span: int = None) -> list:
+    """For each position j of the sequence, list the positions l < j that can pair with j, i.e. that pair according
+    to base_pairing and leave a loop of at least min_loop_size between them.
+
+    Args:
+        seq (str): The RNA sequence.
+        base_pairing (BasePairing): Instance of a BasePairing object.
+        min_loop_size (int): Minimum loop length.
+        max_span (int): Maximum base-pair span j - l. Default = None (no maximum)
+
+    Returns:
+        (list): Entry j (1-based, entry 0 is empty) is the ascending list of 1-based positions l that can pair with j
+
+    """
+    n = len(seq)
+    # transposed mask restricted to l < j - min_loop_size, row j-1 holds the candidates l-1 of j
+    mask = np.tril(base_pairing.pairing_mask(seq).T, k=-min_loop_size-1)
+    if max_span is not None:
+        mask = np.triu(mask, k=-max_span)
+    j, l = np.nonzero(mask)  # sorted by j, then l
+    candidates = [[] for _ in range(n+1)]
+    for j_, l_ in zip((j + 1).tolist(), (l + 1).tolist()):
+        candidates[j_].append(l_)
+    return candidates
+
+
+def _block_tables(V: np.ndarray) -> np.ndarray:
+    """Four-Russians tables of blocks of q candidates, T[b, code] = max_t S[code, t] + V[b, t], where S[code, t] is
+    the number of set bits of code below bit t. Built from the last candidate backwards with
+    T_k[code] = max(V[b, k], (code & 1) + T_k+1[code >> 1]), which takes O(1) per code.
+
+    Args:
+        V (np.ndarray): n_blocks x q candidate values.
+
+    Returns:
+        np.ndarray: n_blocks x 2^(q-1) tables
+
+    """
+    q = V.shape[1]
+    T = V[:, q-1:]
+    for k in range(q-2, -1, -1):
+        code = np.arange(1 << (q-1-k))
+        T = np.maximum(V[:, k:k+1], (code & 1)[None, :] + T[:, code >> 1])
+    return T
+
+
+def _fill_diagonals(P: np.ndarray, mask: np.ndarray, diagonals: tuple):
+    """Fill cells of one or more flattened Nussinov matrices in place, one diagonal at a time.
+
+    Args:
+        P (np.ndarray): Flat view on one or a stack of (n+1)x(n+1) matrices.
+        mask (np.ndarray): Flat view on the matching nxn pairing mask(s).
+        diagonals (tuple): Cell indices per diagonal, see _cell_indices.
+
+    """
+    for ij, ij_unpaired, left, right, lj in diagonals:
+        if lj is None:  # segment too small for any base-pair
+            P[ij] = P[ij_unpaired]
+            continue
+        # non-pairing candidates contribute 0 which never beats j unpaired
+        l_j_paired = np.where(mask[lj], P[left] + P[right] + 1, 0)
+        P[ij] = np.maximum(P[ij_unpaired], l_j_paired.max(axis=1))
+
+
 class BasePairMatrixNussinov:
     """A matrix that hold the maximum number of possible base-pairs for a RNA sequence of length l, where position
     i+1, j+1 of the matrix holds the maximum number of base pairs for segment [i,j] of the RNA sequence.
 
     """
-    def __init__(self, n: int, base_pairing: BasePairing):
+    def __init__(self, n: int, base_pairing: BasePairing, compact: bool = False):
         """Initialize a (L+1)x(L+1) matrix with zeros on diagonal and the diagonal below.
 
         Args:
             l (int): Sequence length.
             base_pairing (BasePairing): Instance of a BasePairing object.
+            compact (bool): Store only the upper triangle with the smallest sufficient unsigned dtype in a buffer
+                            taken from a pool (see TriangularMatrix). Call release() when done with the matrix to
+                            return the buffer to the pool. Fills with max_span store a band instead, which is packed
+                            with the smallest dtype as well (see BandedMatrix). Default = False
 
         """
         self.base_pairing = base_pairing
-        self._P = np.zeros((n+1, n+1), dtype=int)
-        self._min_loop_size = None
+        self._compact = compact
         self._n = n
+        self._P = self._full_storage()
+        self._min_loop_size = None
+        self._max_span = None
+        self._candidates = None  # (seq, min_loop_size, max_span, pairing candidates), see _pairing_candidates
+        self._counts = None  # (seq, d, structure counts), see _structure_counts
+
+    @classmethod
+    def from_filled(cls, P: np.ndarray, base_pairing: BasePairing, min_loop_size: int):
+        """Wrap an already filled (L+1)x(L+1) matrix, e.g. a slice of a BatchBasePairMatrixNussinov, without copying.
+
+        Args:
+            P (np.ndarray): Filled Nussinov matrix.
+            base_pairing (BasePairing): Instance of a BasePairing object the matrix was filled with.
+            min_loop_size (int): Minimum loop length the matrix was filled with.
+
+        Returns:
+            BasePairMatrixNussinov: Class instance
+
+        """
+        matrix = cls(n=0, base_pairing=base_pairing)
+        matrix._P = P
+        matrix._n = P.shape[0] - 1
+        matrix._min_loop_size = min_loop_size
+        return matrix
+
+    def _full_storage(self):
+        """Zeroed storage of the complete matrix, compact or dense as chosen in __init__"""
+        return TriangularMatrix(self._n) if self._compact else np.zeros((self._n+1, self._n+1), dtype=int)
 
     @property
     def P(self):
         return self._P
 
+    @property
+    def compact(self):
+        return isinstance(self._P, TriangularMatrix)
+
+    def release(self):
+        """Return the buffer of a compact matrix to the pool. The matrix can not be used afterwards."""
+        if self.compact:
+            self._P.release()
+        self._P = None
+
     @property
     def min_loop_size(self):
         return self._min_loop_size
@@ -40,32 +240,225 @@ class BasePairMatrixNussinov:
         raise AttributeError("Cannot change attribute min_loop_size directly. Can only be set via fill_matrix method."
                              "If matrix was already filled in, create new matrix with different min_loop_size")
 
-    def fill_matrix(self, seq: str, min_loop_size: int = 1):
+    @property
+    def max_span(self):
+        return self._max_span
+
+    @property
+    def banded(self):
+        return isinstance(self._P, BandedMatrix)
+
+    def fill_matrix(self, seq: str, min_loop_size: int = 1, engine: str = "loop", max_span: int = None):
         """Main step of Nussinov's algorithm, i.e. filling the P matrix to find maximum base-pairing for all seqments
         subject only to minimum loop size constraint.
 
         Args:
             seq (string): The RNA sequence comprised of the letters A, U, G or C.
             min_loop_size (int): Minimum loop length. Default = 1
+            engine (str): How to fill the matrix. "loop" fills cell by cell in pure Python, "vectorized" precomputes
+                          the pairing mask of the sequence and fills each diagonal with NumPy array operations,
+                          "four_russians" fills column by column in O(L^3/log L) using the Four-Russians speedup.
+                          All produce the same matrix. Compact matrices are filled by "vectorized" instead of
+                          "loop", as cell by cell access to packed cells is slow. Default = "loop"
+            max_span (int): Maximum base-pair span W (as RNAplfold -L), only base-pairs (l, j) with j - l <= W are
+                            formed. If W < L-1, only cells [i, j] with j - i <= W and the cells [1, j] (needed for
+                            the whole sequence) are computed and stored in a BandedMatrix, which takes O(L*W^2) time
+                            and O(L*W) memory. Tracebacks use the same maximum span. Later fills without (or with a
+                            wider) max_span switch back to the storage chosen in __init__. Not supported by the
+                            "four_russians" engine. Default = None (no maximum)
 
         Returns:
             None
 
         """
         self._min_loop_size = min_loop_size
+        self._max_span = max_span
+        self._counts = None
+
+        if max_span is not None and max_span < self._n - 1:
+            if engine == "four_russians":
+                raise ValueError("max_span is not supported by the four_russians engine")
+            self.release()
+            self._P = BandedMatrix(self._n, max_span)
+        elif self.banded:  # band of an earlier fill
+            self.release()
+            self._P = self._full_storage()
+
+        if engine == "loop" and self.compact:
+            engine = "vectorized"
+
+        if engine == "loop":
+            self._fill_loop(seq)
+        elif engine == "vectorized":
+            self._fill_vectorized(seq)
+        elif engine == "four_russians":
+            self._fill_four_russians(seq)
+        else:
+            raise ValueError(f"Unknown engine {engine}, choose from 'loop', 'vectorized' or 'four_russians'")
+
+    def _pairing_candidates(self, seq: str) -> list:
+        """Pairing candidates of the sequence (see pairing_candidates), computed once per sequence and shared by the
+        fill and traceback steps"""
+        if self._candidates is None or self._candidates[:3] != (seq, self._min_loop_size, self._max_span):
+            self._candidates = (seq, self._min_loop_size, self._max_span,
+                                pairing_candidates(seq, self.base_pairing, self._min_loop_size, self._max_span))
+        return self._candidates[3]
+
+    def _suffix_pairing_candidates(self, seq: str, prefix: int) -> list:
+        """Pairing candidates of seq, reusing the candidates of positions j <= prefix from the previous sequence"""
+        if self._candidates is None or self._candidates[1:3] != (self._min_loop_size, self._max_span):
+            return self._pairing_candidates(seq)
+        A, ids = self.base_pairing.A, self.base_pairing.encode(seq).tolist()
+        m, W = self._min_loop_size, self._max_span
+        candidates = self._candidates[3][:prefix+1]
+        for j in range(prefix + 1, self._n + 1):
+            row = A[ids[j-1]].tolist()
+            first = 1 if W is None else max(1, j - W)
+            candidates.append([l for l in range(first, j - m) if row[ids[l-1]]])
+        self._candidates = (seq, m, W, candidates)
+        return candidates
 
+    def _fill_loop(self, seq: str):
+        candidates = self._pairing_candidates(seq)
         for k in range(1, self._n):  # loop over segment sizes
-            for i in range(1, self._n - k + 1):  # loop over starting index of segment
+            # beyond max_span only segment [1, j] is needed, all others are wider than any base-pair
+            rows = range(1, self._n - k + 1) if self._max_span is None or k <= self._max_span else range(1, 2)
+            for i in rows:  # loop over starting index of segment
                 j = i + k
                 j_unpaired = self._P[i, j-1]
-                l_j_paired = [self._P[i, l-1] + self._P[l+1, j-1] + 1 for l in range(i, j-self._min_loop_size)
-                              if self.base_pairing.pairs(seq[l-1], seq[j-1])]
+                l_j = candidates[j]  # l in range(i, j-min_loop_size) that pair with j
+                l_j_paired = [self._P[i, l-1] + self._P[l+1, j-1] + 1 for l in l_j[bisect_left(l_j, i):]]
+
+                if l_j_paired:
+                    self._P[i, j] = max(j_unpaired, *l_j_paired)
+                else:
+                    self._P[i, j] = j_unpaired
+
+    def refill_suffix(self, seq: str, prefix: int):
+        """Refill the matrix for a new sequence of the same length that shares its first prefix bases with the
+        sequence the matrix was last filled with. Cell [i, j] only depends on the segment [i, j], so all columns
+        j <= prefix are kept and only the columns of the changed suffix are recomputed, column by column. Walking
+        through genotypes in lexicographic order (e.g. as written by build_genotype_space.py) mostly changes the
+        last base only, which turns an O(L^3) fill into an O(L^2) one.
+
+        Args:
+            seq (string): The new sequence.
+            prefix (int): Number of leading bases seq shares with the previous sequence, 0 refills everything.
+
+        Returns:
+            None
+
+        """
+        if self._min_loop_size is None:
+            raise ValueError("Matrix has to be filled with fill_matrix before refilling a suffix")
+        self._counts = None
+        candidates = self._suffix_pairing_candidates(seq, prefix)
+        for j in range(max(prefix, 1) + 1, self._n + 1):  # loop over changed columns
+            # as in _fill_loop, beyond max_span only segment [1, j] is needed
+            first = 1 if self._max_span is None else max(1, j - self._max_span)
+            rows = range(first, j) if first == 1 else [1, *range(first, j)]
+            for i in rows:
+                j_unpaired = self._P[i, j-1]
+                l_j = candidates[j]
+                l_j_paired = [self._P[i, l-1] + self._P[l+1, j-1] + 1 for l in l_j[bisect_left(l_j, i):]]
 
                 if l_j_paired:
                     self._P[i, j] = max(j_unpaired, *l_j_paired)
                 else:
                     self._P[i, j] = j_unpaired
 
+    def _fill_vectorized(self, seq: str):
+        mask = self.base_pairing.pairing_mask(seq)  # mask[l-1, j-1] is True if l and j can pair
+        if self.banded:
+            _fill_diagonals(self._P.data, mask.reshape(-1),
+                            _diagonal_indices(self._n, self._min_loop_size, "banded", self._max_span))
+        elif self.compact:
+            _fill_diagonals(self._P.data, mask.reshape(-1),
+                            _diagonal_indices(self._n, self._min_loop_size, "triangular", self._max_span))
+        else:
+            _fill_diagonals(self._P.reshape(-1), mask.reshape(-1),
+                            _diagonal_indices(self._n, self._min_loop_size, "dense", self._max_span))
+
+    def _fill_four_russians(self, seq: str):
+        """Four-Russians speedup of Nussinov's algorithm (Frid & Gusfield 2010). Rows of P are non-decreasing in steps
+        of 0 or 1, so q consecutive cells P[i, s-1], ..., P[i, s+q-2] are fully described by P[i, s-1] and a (q-1)-bit
+        code of their differences. For column j and each block of q candidates l = s, ..., s+q-1, the best
+        P[i, l-1] + P[l+1, j-1] + 1 is tabulated for all 2^(q-1) codes (in O(1) per code, see _block_tables) and then
+        looked up for every row. With q ~ log(L) both take O(L^2/log L) per column, so O(L^3/log L) in total instead
+        of O(L^3). Fills the compact matrix in place if the matrix is compact.
+
+        """
+        n, m = self._n, self._min_loop_size
+        mask = self.base_pairing.pairing_mask(seq)
+        q = max(2, int(np.log2(max(n, 2))) - 1)  # block size
+        neg = -(n + 1)  # stands in for minus infinity, lower than any sum of P values
+
+        P = self._P
+        if self.compact:
+            P.data[:] = 0
+            get = lambda i, j: P[i, j].astype(int)  # unsigned cells
+        else:
+            P[:, :] = 0
+            get = lambda i, j: P[i, j]
+        weights = 1 << np.arange(q-1)
+        block_starts = 1 + q*np.arange(n // q + 1)
+        codes = np.zeros((n+1, n // q + 1), dtype=int)  # codes[i, b] encodes row i of block b, see above
+        rows = np.arange(n+1)
+        t = np.arange(q)
+        for j in range(2, n+1):  # all rows of column j only depend on columns < j
+            i = np.arange(1, j)
+            V = np.full(j, neg)  # V[l] = P[l+1, j-1] + 1 if l can pair with j
+            l = np.arange(1, j - m)
+            V[l] = np.where(mask[l-1, j-1], get(l+1, j-1) + 1, neg)
+            best = get(i, j-1)  # j unpaired
+
+            n_blocks = (j-1) // q  # blocks with all candidates l < j
+            if n_blocks and (j-1) % q == 0:  # block n_blocks-1 just became complete, encode its rows
+                s = block_starts[n_blocks-1]
+                codes[:, n_blocks-1] = np.diff(get(rows[:, None], s-1 + t[None, :]), axis=1) @ weights
+            first_block = -(-(i-1) // q)  # first block starting at or after i
+            if n_blocks:
+                T = _block_tables(V[1:n_blocks*q+1].reshape(n_blocks, q))
+                b = np.arange(n_blocks)[None, :]
+                blocks = get(i[:, None], block_starts[None, :n_blocks] - 1) + T[b, codes[i, :n_blocks]]
+                best = np.maximum(best, np.where(b >= first_block[:, None], blocks, neg).max(axis=1))
+
+            # candidates not covered by blocks: l in [i, start of first block) and after the last complete block
+            L = np.hstack([i[:, None] + t[None, :], np.broadcast_to(n_blocks*q + 1 + t, (j-1, q))])
+            valid = np.hstack([i[:, None] + t[None, :] <= (first_block*q)[:, None],
+                               n_blocks*q + 1 + t[None, :] >= i[:, None]]) & (L <= j-1)
+            L = np.minimum(L, j-1)
+            rest = np.where(valid, get(i[:, None], L-1) + V[L], neg)
+            P[i, j] = np.maximum(best, rest.max(axis=1))
+
+    def fold_neighbors(self, genotype: str) -> dict:
+        """Fill the matrices of all single-point mutants of the genotype this matrix was filled with. Cells [i, j]
+        whose segment does not contain the mutated site are copied from this matrix, only the others are recomputed.
+
+        Args:
+            genotype (str): The genotype this matrix was filled with.
+
+        Returns:
+            (dict): Maps each mutant (str) to its filled BasePairMatrixNussinov, ordered by mutated position and
+                    then by order of the bases in base_pairing.bases
+
+        """
+        if self._min_loop_size is None:
+            raise ValueError("Matrix has to be filled with fill_matrix before folding neighbors")
+        if self._max_span is not None:
+            raise ValueError("fold_neighbors does not support max_span")
+        n, bases = self._n, self.base_pairing.bases
+        mutants = [genotype[:p] + b + genotype[p+1:] for p in range(n) for b in bases if b != genotype[p]]
+
+        P = np.repeat(np.asarray(self._P, dtype=int)[None, :, :], len(mutants), axis=0)
+        ids = np.array([self.base_pairing.encode(mutant) for mutant in mutants], dtype=int).reshape(len(mutants), n)
+        masks = self.base_pairing.A[ids[:, :, None], ids[:, None, :]].astype(bool)
+        _fill_diagonals(P.reshape(-1), masks.reshape(-1),
+                        _neighbor_diagonal_indices(n, self._min_loop_size, len(bases)))
+
+        return {mutant: BasePairMatrixNussinov.from_filled(P=P[b], base_pairing=self.base_pairing,
+                                                           min_loop_size=self._min_loop_size)
+                for b, mutant in enumerate(mutants)}
 
     def traceback(self, seq: str):
         """Find a base-pairs of an optimal secondary structure, i.e. a structure with maximum number of base-pairs
@@ -81,6 +474,7 @@ class BasePairMatrixNussinov:
 
         """
         s = SecondaryStructure(sigma=[(1, self._n)], B=[])  # initiate first suboptimal structure
+        candidates = self._pairing_candidates(seq)
 
         while s.sigma:
             i, j = s.sigma.pop()
@@ -89,15 +483,15 @@ class BasePairMatrixNussinov:
             if self._P[i, j] == self._P[i, j-1]:
                 s.sigma.append((i, j-1))
             else:
-                for l in range(i, j):
-                    if self.base_pairing.pairs(seq[l-1], seq[j-1]):
-                        if self._P[i, j] == self._P[i, l-1] + self._P[l+1, j-1] + 1:
-                            s.B.append((l, j))
-                            s.sigma.extend([(i, l-1), (l+1, j-1)])
-                            break
+                l_j = candidates[j]
+                for l in l_j[bisect_left(l_j, i):]:
+                    if self._P[i, j] == self._P[i, l-1] + self._P[l+1, j-1] + 1:
+                        s.B.append((l, j))
+                        s.sigma.extend([(i, l-1), (l+1, j-1)])
+                        break
         return s
 
-    def traceback_subopt(self, seq: str, d: int = 0, structures_max = np.inf):
+    def traceback_subopt(self, seq: str, d: int = 0, structures_max = np.inf, pair_tables: bool = False):
         """Find all suboptimal structures within a certain number of base-pairs from the maximum according to the
         Wuchty1999 algorithm.
 
@@ -105,44 +499,421 @@ class BasePairMatrixNussinov:
             seq (string): The RNA sequence comprised of the letters A, U, G or C.
             d (int): allowed difference in number of base-pairs between optimal and suboptimal structures. Default d = 0
                          generates all possible optimal structures.
+            structures_max (int): How many structures to generate at most. Default = np.inf
+            pair_tables (bool): Return pair tables instead of SecondaryStructure objects. Default = False
 
         Returns:
-            B (list): List of base pairs in tuple format
+            (list): SecondaryStructure or pair table per suboptimal structure, see iter_traceback_subopt
 
         """
-        s_init = SecondaryStructure(sigma=[(1, self._n)], B=[])  # initiate first suboptimal structure
-        R = [s_init]  # initiate stack of suboptimal structures
-        final_structures = []  # where we collect suboptimal structures
-        p_max = self._P[1, -1]  # maximum possible number of base-pairs
+        return list(self.iter_traceback_subopt(seq=seq, d=d, structures_max=structures_max, pair_tables=pair_tables))
 
-        if p_max == 0:
-            s_init.pop()
-            final_structures.append(s_init)
-            return final_structures
+    def iter_traceback_subopt(self, seq: str, d: int = 0, structures_max = np.inf, pair_tables: bool = False):
+        """Generator version of traceback_subopt that yields suboptimal structures as soon as they are found, in the
+        same order as traceback_subopt lists them.
+
+        Partial structures share their segment stack and base-pairs with the structure they branched off from
+        (persistent linked stacks), and their maximum possible number of base-pairs is updated incrementally
+        instead of being re-summed over all segments.
+
+        Args:
+            seq (string): The RNA sequence comprised of the letters A, U, G or C.
+            d (int): allowed difference in number of base-pairs between optimal and suboptimal structures. Default d = 0
+                         generates all possible optimal structures.
+            structures_max (int): How many structures to generate at most. Default = np.inf
+            pair_tables (bool): Return pair tables instead of SecondaryStructure objects. Default = False
+
+        Yields:
+            SecondaryStructure per suboptimal structure or, if pair_tables, pair table per structure in ViennaRNA
+            convention, i.e. integer array pt with pt[0] = L and pt[i] = j if i and j are paired and 0 if i is
+            unpaired.
+
+        """
+        n_structures = 0  # how many structures have been yielded
+        output = self._pair_table if pair_tables else (lambda B: SecondaryStructure(sigma=[], B=self._base_pairs(B)))
+        for B, _ in self._traceback_subopt(seq, [d]):
+            yield output(B)
+            n_structures += 1
+            if n_structures == structures_max:
+                return
+
+    def traceback_subopt_bands(self, seq: str, ds: list, structures_max = np.inf, pair_tables: bool = False) -> dict:
+        """Suboptimal structures for several values of d from a single traceback of the widest band. The traceback for
+        a smaller d visits exactly those partial structures of the traceback for a larger d that can still reach the
+        smaller band, so the structures for each d are the same and in the same order as from
+        traceback_subopt(seq, d, structures_max). Once the structures_max structures of the widest bands are found,
+        the traceback is narrowed to the band of the widest d that still needs structures.
+
+        Args:
+            seq (string): The RNA sequence comprised of the letters A, U, G or C.
+            ds (list): Allowed differences d in number of base-pairs between optimal and suboptimal structures.
+            structures_max (int): How many structures to generate at most per d. Default = np.inf
+            pair_tables (bool): Return pair tables instead of SecondaryStructure objects. Default = False
+
+        Returns:
+            (dict): Maps each d to its list of structures, see traceback_subopt
+
+        """
+        output = self._pair_table if pair_tables else (lambda B: SecondaryStructure(sigma=[], B=self._base_pairs(B)))
+        p_max = np.asarray(self._P[1, self._n]).item()
+        bands = {d: [] for d in ds}
+        open_ds = sorted(bands)  # bands that still need structures, in increasing order of d
+        d_max = [open_ds[-1]]  # widest open band, read by _traceback_subopt after each structure
+        for B, n_bp in self._traceback_subopt(seq, d_max):
+            s = output(B)
+            for d in open_ds:
+                if p_max - n_bp <= d:
+                    bands[d].append(s)
+            open_ds = [d for d in open_ds if len(bands[d]) < structures_max]
+            if not open_ds:
+                break
+            d_max[0] = open_ds[-1]
+        return bands
+
+    def best_subopt(self, seq: str, d: int = 0, score = None, bound = None) -> tuple:
+        """Suboptimal structure with the lowest score, e.g. free energy or rank of the phenotype, without keeping the
+        suboptimal set. Runs the traceback of traceback_subopt as depth-first branch and bound: partial structures
+        whose lower bound is not below the best score found so far are dropped, since none of their completions can
+        replace it. Ties are broken as when scoring all structures in the order of traceback_subopt and keeping the
+        first lowest score. Without bound, every structure is scored once but none are stored.
+
+        Args:
+            seq (string): The RNA sequence comprised of the letters A, U, G or C.
+            d (int): allowed difference in number of base-pairs between optimal and suboptimal structures. Default = 0
+            score (function): Takes the list of base-pairs of a structure and returns its score (lower is better).
+            bound (function): Takes the list of base-pairs and the list of open segments [i, j] of a partial structure
+                              and returns a lower bound on the score of all structures that complete it, segments can
+                              take up to P[i, j] more base-pairs. Default = None (no pruning)
+
+        Returns:
+            (tuple): (SecondaryStructure, score) of the best structure, or (None, None) if there are no structures
+
+        """
+        if score is None:
+            raise ValueError("A score function is required")
+        best = [None, None]  # best base-pairs and score so far
+
+        def prune(B, segments):
+            return best[1] is not None and bound(self._base_pairs(B), segments) >= best[1]
+
+        for B, _ in self._traceback_subopt(seq, [d], prune if bound is not None else None):
+            pairs = self._base_pairs(B)
+            score_ = score(pairs)
+            if best[1] is None or score_ < best[1]:
+                best = [pairs, score_]
+        if best[0] is None:
+            return None, None
+        return SecondaryStructure(sigma=[], B=best[0]), best[1]
+
+    def in_subopt_band(self, seq: str, B: list, d: int = 0) -> bool:
+        """Check whether a structure is one of the suboptimal structures of traceback_subopt(seq, d) without running
+        the traceback, i.e. whether all its base-pairs can form and it has at least P[1, L] - d base-pairs.
+
+        Args:
+            seq (string): The RNA sequence comprised of the letters A, U, G or C.
+            B (list): Base-pairs (l, j) with l < j (1-based) of a nested structure.
+            d (int): allowed difference in number of base-pairs between optimal and suboptimal structures. Default = 0
+
+        Returns:
+            (bool): True if the structure is in the suboptimal band
+
+        """
+        if len(B) < self._P[1, self._n] - d:
+            return False
+        candidates = self._pairing_candidates(seq)
+        for l, j in B:
+            l_j = candidates[j]
+            k = bisect_left(l_j, l)
+            if k == len(l_j) or l_j[k] != l:
+                return False
+        return True
+
+    def _traceback_subopt(self, seq: str, d: list, prune = None):
+        """Traceback shared by iter_traceback_subopt, traceback_subopt_bands and best_subopt, see
+        iter_traceback_subopt. d is a one-element list that may be decreased by the caller whenever a structure has
+        been yielded. prune(B, segments) is called for each popped partial structure with its linked list of
+        base-pairs and list of open segments, the partial structure is dropped if it returns True.
+
+        Yields:
+            (tuple): (B, n_bp) per suboptimal structure, where B is the linked list of base-pairs and n_bp their
+                     number
+
+        """
+        P = self._P.tolist()  # nested lists (or BandedRows) for fast scalar access
+        m = self._min_loop_size
+        candidates = self._pairing_candidates(seq)
+        p_max = P[1][self._n]  # maximum possible number of base-pairs
+        threshold = p_max - d[0]
+
+        # A partial structure is a tuple (sigma, size, sigma_bp, B, n_bp). The segment stack sigma is a linked list
+        # (segment, next) from the bottom of the stack upwards of which only the first size nodes belong to the
+        # structure, sigma_bp the sum of P over these segments. The base-pairs B are a linked list (pair, next) from
+        # the last added pair backwards with n_bp nodes.
+        R = [(((1, self._n), None), 1, p_max, None, 0)] if p_max > 0 else []  # initiate stack of structures
 
         while R:
             added_to_R = False  # track whether something has been put on R stack since popping s
-            s = R.pop()
-            if s.is_folded():
-                final_structures.append(s)
-                if len(final_structures) == structures_max:
-                    break
+            sigma, size, sigma_bp, B, n_bp = R.pop()
+            if n_bp + sigma_bp < threshold:  # band has been narrowed since s was put on R
                 continue
 
-            while not s.is_folded():
-                i, j = s.pop()
-                if j-i > self._min_loop_size:
-                    s_ = SecondaryStructure(sigma=[(i, j-1), *s.sigma], B=s.B)
-                    if s_.maximum_bp(self._P) >= p_max - d:
-                        R.append(s_)
+            segments = []
+            node = sigma
+            for _ in range(size):
+                segments.append(node[0])
+                node = node[1]
+            if prune is not None and prune(B, segments):
+                continue
+
+            if size == 0:  # structure is folded
+                yield B, n_bp
+                threshold = p_max - d[0]
+                continue
+
+            for top in range(size-1, -1, -1):  # pop segments from the top of the stack
+                i, j = segments[top]
+                sigma_bp -= P[i][j]  # sigma_bp of the remaining segments below top
+                if j-i > m:
+                    max_bp = n_bp + sigma_bp + P[i][j-1]
+                    if max_bp >= threshold:
+                        if i < j-1:
+                            R.append((((i, j-1), sigma), top+1, sigma_bp + P[i][j-1], B, n_bp))
+                        else:
+                            R.append((sigma, top, sigma_bp, B, n_bp))
                         added_to_R = True
-                    for l in range(i, j):
-                        if self.base_pairing.pairs(seq[l - 1], seq[j - 1]) and j-l > self._min_loop_size:
-                            s_ = SecondaryStructure(sigma=[(i, l-1), (l+1, j-1), *s.sigma], B=[*s.B, (l, j)])
-                            if s_.maximum_bp(self._P) >= p_max - d:
-                                R.append(s_)
-                                added_to_R = True
-            if not added_to_R:  # nothing has been put on stack since popping s
-                R.append(s)  # continue with s next iteration (no infinite loop because each iteration we pop from s.sigma)
-        return final_structures
+                    l_j = candidates[j]
+                    for l in l_j[bisect_left(l_j, i):]:
+                        max_bp = n_bp + 1 + sigma_bp + P[i][l-1] + P[l+1][j-1]
+                        if max_bp >= threshold:
+                            sigma_, size_ = sigma, top
+                            if l+1 < j-1:
+                                sigma_, size_ = ((l+1, j-1), sigma_), size_+1
+                            if i < l-1:
+                                sigma_, size_ = ((i, l-1), sigma_), size_+1
+                            R.append((sigma_, size_, sigma_bp + P[i][l-1] + P[l+1][j-1], ((l, j), B), n_bp+1))
+                            added_to_R = True
+            if not added_to_R:  # nothing has been put on stack since popping s, i.e. s is folded now
+                yield B, n_bp
+                threshold = p_max - d[0]
+
+        if p_max == 0:
+            yield None, 0  # unfolded structure
+
+    def count_structures(self, seq: str, d: int = 0) -> list:
+        """Count the suboptimal structures within d base-pairs of the maximum without enumerating them, i.e. the
+        number of distinct structures traceback_subopt finds for the same d, in O(L^3 * d^2).
+
+        For every segment [i, j], N[i, j][k] counts the structures with P[i, j] - k base-pairs, k = 0, ..., d. Each
+        structure either leaves j unpaired (a structure of [i, j-1]) or pairs j with exactly one l (structures of
+        [i, l-1] and [l+1, j-1]), so the counts of both cases simply add up.
+
+        Args:
+            seq (string): The RNA sequence the matrix was filled with.
+            d (int): allowed difference in number of base-pairs between optimal and suboptimal structures.
+
+        Returns:
+            (list): Entry k is the number of structures with P_max - k base-pairs, k = 0, ..., d
+
+        """
+        N = self._structure_counts(seq, d)
+        return list(N[1, self._n]) if self._n > 1 else [1] + [0]*d
+
+    def sample_subopt(self, seq: str, d: int = 0, k: int = 1, seed: int = None) -> list:
+        """Draw k structures uniformly at random (with replacement) from all structures within d base-pairs of the
+        maximum, i.e. from the set traceback_subopt enumerates. Uses the structure counts of count_structures to
+        pick each step of a stochastic traceback with probability proportional to the number of structures it
+        leads to, which takes O(k * L^2 * d) after counting once.
+
+        Args:
+            seq (string): The RNA sequence the matrix was filled with.
+            d (int): allowed difference in number of base-pairs between optimal and suboptimal structures.
+            k (int): Number of structures to draw.
+            seed (int): Random seed. Counts can exceed 64 bit integers, so python's random module is used.
+
+        Returns:
+            (list): k SecondaryStructures
+
+        """
+        rng = random.Random(seed)
+        N = self._structure_counts(seq, d)
+        P = self._P.tolist()
+        candidates = self._pairing_candidates(seq)
+        empty = (1,) + (0,)*d
+        total = self.count_structures(seq, d)
+
+        structures = []
+        for _ in range(k):
+            r = rng.randrange(sum(total))
+            delta = 0
+            while r >= total[delta]:  # pick deficit of the whole structure
+                r -= total[delta]
+                delta += 1
+            B = []
+            sigma = [(1, self._n, delta)]
+            while sigma:
+                i, j, delta = sigma.pop()
+                if i >= j:
+                    continue
+                r = rng.randrange(N[i, j][delta])
+                gap = P[i][j] - P[i][j-1]
+                if delta >= gap:  # j unpaired
+                    r -= N.get((i, j-1), empty)[delta - gap]
+                    if r < 0:
+                        sigma.append((i, j-1, delta - gap))
+                        continue
+                l_j = candidates[j]
+                for l in l_j[bisect_left(l_j, i):]:  # j paired with l
+                    gap = P[i][j] - P[i][l-1] - P[l+1][j-1] - 1
+                    left, right = N.get((i, l-1), empty), N.get((l+1, j-1), empty)
+                    for d_left in range(delta - gap + 1):
+                        r -= left[d_left] * right[delta - gap - d_left]
+                        if r < 0:
+                            break
+                    if r < 0:
+                        B.append((l, j))
+                        sigma.extend([(i, l-1, d_left), (l+1, j-1, delta - gap - d_left)])
+                        break
+            structures.append(SecondaryStructure(sigma=[], B=B))
+        return structures
+
+    def _structure_counts(self, seq: str, d: int) -> dict:
+        """Counts of structures per segment and base-pair deficit, see count_structures. Computed once per sequence
+        and d, segments with i >= j are not stored, they hold only the empty structure.
+
+        Returns:
+            (dict): Maps segment (i, j) to tuple of d+1 counts (python int)
 
+        """
+        if self._counts is not None and self._counts[:2] == (seq, d):
+            return self._counts[2]
+        P = self._P.tolist()
+        candidates = self._pairing_candidates(seq)
+        empty = (1,) + (0,)*d  # segments too small for any base-pair only have the empty structure
+        N = {}
+        for k in range(1, self._n):
+            rows = range(1, self._n - k + 1) if self._max_span is None or k <= self._max_span else range(1, 2)
+            for i in rows:
+                j = i + k
+                counts = [0]*(d+1)
+                gap = P[i][j] - P[i][j-1]  # base-pairs lost by leaving j unpaired
+                unpaired = N.get((i, j-1), empty)
+                for delta in range(gap, d+1):
+                    counts[delta] += unpaired[delta - gap]
+                l_j = candidates[j]
+                for l in l_j[bisect_left(l_j, i):]:
+                    gap = P[i][j] - P[i][l-1] - P[l+1][j-1] - 1
+                    if gap > d:
+                        continue
+                    left, right = N.get((i, l-1), empty), N.get((l+1, j-1), empty)
+                    for d_left in range(d+1 - gap):
+                        if left[d_left]:
+                            for d_right in range(d+1 - gap - d_left):
+                                counts[gap + d_left + d_right] += left[d_left] * right[d_right]
+                N[i, j] = tuple(counts)
+        self._counts = (seq, d, N)
+        return N
+
+    @staticmethod
+    def _base_pairs(B: tuple) -> list:
+        """Linked list of base-pairs (pair, next) to list in the order they were added"""
+        pairs = []
+        while B is not None:
+            pairs.append(B[0])
+            B = B[1]
+        return pairs[::-1]
+
+    def _pair_table(self, B: tuple) -> np.ndarray:
+        """Linked list of base-pairs (pair, next) to pair table"""
+        pt = np.zeros(self._n + 1, dtype=int)
+        pt[0] = self._n
+        while B is not None:
+            (l, j), B = B
+            pt[l], pt[j] = j, l
+        return pt
+
+
+class BatchBasePairMatrixNussinov:
+    """A stack of Nussinov matrices for B sequences of equal length l, i.e. a (B, l+1, l+1) tensor where [b, i, j]
+    holds the maximum number of base pairs for segment [i, j] of the b-th sequence. All B matrices are filled at once
+    to pay the interpreter overhead once per batch instead of once per sequence.
+
+    """
+    def __init__(self, n: int, base_pairing: BasePairing):
+        """Initialize the batch, the (B, L+1, L+1) tensor is only allocated once the sequences are known.
+
+        Args:
+            n (int): Sequence length shared by all sequences of the batch.
+            base_pairing (BasePairing): Instance of a BasePairing object.
+
+        """
+        self.base_pairing = base_pairing
+        self._P = None
+        self._seqs = None
+        self._min_loop_size = None
+        self._n = n
+
+    @property
+    def P(self):
+        return self._P
+
+    @property
+    def min_loop_size(self):
+        return self._min_loop_size
+
+    @property
+    def maximum_bp(self) -> np.ndarray:
+        """Maximum number of base-pairs of each sequence of the batch"""
+        return self._P[:, 1, self._n]
+
+    def __len__(self):
+        return 0 if self._seqs is None else len(self._seqs)
+
+    def __getitem__(self, b: int) -> BasePairMatrixNussinov:
+        """Matrix of the b-th sequence as BasePairMatrixNussinov, sharing memory with the batch tensor"""
+        return BasePairMatrixNussinov.from_filled(P=self._P[b], base_pairing=self.base_pairing,
+                                                  min_loop_size=self._min_loop_size)
+
+    def fill_matrix(self, seqs: list, min_loop_size: int = 1):
+        """Fill the Nussinov matrices of all sequences, one diagonal at a time for the whole batch.
+
+        Args:
+            seqs (list): RNA sequences (str), all of length n.
+            min_loop_size (int): Minimum loop length. Default = 1
+
+        Returns:
+            None
+
+        """
+        if any(len(seq) != self._n for seq in seqs):
+            raise ValueError(f"All sequences of a batch must have length {self._n}")
+        self._seqs = list(seqs)
+        self._min_loop_size = min_loop_size
+        self._P = np.zeros((len(seqs), self._n+1, self._n+1), dtype=int)
+
+        ids = np.array([self.base_pairing.encode(seq) for seq in seqs], dtype=int).reshape(len(seqs), self._n)
+        masks = self.base_pairing.A[ids[:, :, None], ids[:, None, :]].astype(bool)
+        _fill_diagonals(self._P.reshape(-1), masks.reshape(-1),
+                        _batch_diagonal_indices(self._n, self._min_loop_size, len(seqs)))
+
+    def traceback(self) -> list:
+        """One optimal structure per sequence, see BasePairMatrixNussinov.traceback
+
+        Returns:
+            (list): One SecondaryStructure per sequence of the batch
+
+        """
+        return [self[b].traceback(seq) for b, seq in enumerate(self._seqs)]
+
+    def traceback_subopt(self, d: int = 0, structures_max = np.inf) -> list:
+        """All suboptimal structures per sequence, see BasePairMatrixNussinov.traceback_subopt
+
+        Args:
+            d (int): allowed difference in number of base-pairs between optimal and suboptimal structures.
+            structures_max (int): How many structures to generate at most per sequence
+
+        Returns:
+            (list): One list of SecondaryStructures per sequence of the batch
+
+        """
+        return [self[b].traceback_subopt(seq, d=d, structures_max=structures_max)
+                for b, seq in enumerate(self._seqs)]
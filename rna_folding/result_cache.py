@@ -0,0 +1,238 @@
+"""Cache of Nussinov mapping results keyed by pairing mask. Nussinov's
+algorithm only sees which positions of a genotype can pair, not the bases
+themselves, so all genotypes with the same pairing mask (e.g. the many
+genotypes of sparse base-pairing graphs) map to the same phenotypes.
+SQLiteResultCache keeps results on disk, so that runs with a configuration
+that was seen before (e.g. the same map rebuilt in another experiment
+directory) only read them instead of folding again.
+
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from rna_folding.base_pairing import BasePairing
+
+
+def mask_signature(genotype: str, base_pairing: BasePairing,
+                   min_loop_size: int, max_span: int = None) -> bytes:
+    """Compact signature of the part of the pairing mask that Nussinov's
+    algorithm uses, i.e. of the pairs (l, j) with min_loop_size < j - l
+    (<= max_span). Genotypes with equal signatures have the same Nussinov
+    structures.
+
+    Args:
+        genotype (str): The genotype
+        base_pairing (BasePairing): Instance of a BasePairing object
+        min_loop_size (int): Minimum loop length
+        max_span (int): Maximum base-pair span. Default = None (no maximum)
+
+    Returns:
+        bytes: Bit-packed pairing mask, prefixed by the genotype length
+
+    """
+    L = len(genotype)
+    l, j = _pair_indices(L, min_loop_size, max_span)
+    ids = base_pairing.encode(genotype)
+    bits = base_pairing.A[ids[l], ids[j]].astype(bool)
+    return L.to_bytes(4, "little") + np.packbits(bits).tobytes()
+
+
+_pair_index_cache = {}
+
+
+def _pair_indices(L: int, min_loop_size: int, max_span: int = None) -> tuple:
+    key = (L, min_loop_size, max_span)
+    if key not in _pair_index_cache:
+        l, j = np.triu_indices(L, min_loop_size + 1)
+        if max_span is not None:
+            l, j = l[j - l <= max_span], j[j - l <= max_span]
+        _pair_index_cache[key] = (l, j)
+    return _pair_index_cache[key]
+
+
+class MaskResultCache:
+    """Least recently used cache of phenotype lists keyed by pairing mask
+    signature (see mask_signature) and mapping parameters
+
+    """
+    def __init__(self, maxsize: int = 2**16):
+        """Initialize an empty cache
+
+        Args:
+            maxsize (int): Maximum number of cached results.
+                           Default = 65536
+
+        """
+        self.maxsize = maxsize
+        self._results = OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    def get(self, key):
+        """Cached result for key or None, counts hits and misses"""
+        result = self._results.get(key)
+        if result is None:
+            self.misses += 1
+            return None
+        self._results.move_to_end(key)
+        self.hits += 1
+        return result
+
+    def put(self, key, result):
+        """Cache result for key, evicting the least recently used result"""
+        self._results[key] = result
+        self._results.move_to_end(key)
+        if len(self._results) > self.maxsize:
+            self._results.popitem(last=False)
+
+    def __len__(self):
+        return len(self._results)
+
+
+def config_key(*config) -> str:
+    """Content hash of a mapper configuration, e.g. of the mapping function
+    name and its arguments. Base-pairings are hashed by their bases and 
+    adjacency matrix, not by their id, and dicts by their sorted items.
+
+    Args:
+        *config: Mapper configuration (str, numbers, lists, tuples, dicts,
+                 np.ndarray, BasePairing)
+
+    Returns:
+        str: Hex digest identifying the configuration
+
+    """
+    return hashlib.sha256(repr(_canonical(config)).encode()).hexdigest()
+
+
+def _canonical(obj):
+    if isinstance(obj, BasePairing):
+        return ("BasePairing", obj.bases, np.asarray(obj.A).tolist())
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, dict):
+        return tuple((k, _canonical(v)) for k, v in sorted(obj.items()))
+    if isinstance(obj, (list, tuple)):
+        return tuple(_canonical(o) for o in obj)
+    return obj
+
+
+class SQLiteResultCache:
+    """Persistent cache of mapping results (lists of phenotypes) in an
+    SQLite file, keyed by a hash of the key (e.g. mapper configuration and 
+    genotype). Has the get/put interface of MaskResultCache, so it can be 
+    passed to nussinov as well. Holds at most max_entries results, evicting 
+    the least recently used ones. The connection may be shared between the
+    threads of one process but not between processes.
+
+    """
+    def __init__(self, path: str, max_entries: int = None,
+                 commit_every: int = 4096):
+        """Open (or create) a cache file
+
+        Args:
+            path (str): Path to the SQLite file
+            max_entries (int): Maximum number of results kept on disk.
+                               Default = None (unbounded)
+            commit_every (int): Number of puts between commits, results not
+                                yet committed are lost if the process is 
+                                killed. Default = 4096
+
+        """
+        self.path = str(path)
+        self.max_entries = max_entries
+        self.commit_every = commit_every
+        self.hits, self.misses = 0, 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS results (key BLOB "
+                         "PRIMARY KEY, result TEXT, last_used INTEGER) "
+                         "WITHOUT ROWID")
+        self._db.execute("CREATE INDEX IF NOT EXISTS lru ON results "
+                         "(last_used)")
+        self._clock = self._db.execute(
+            "SELECT COALESCE(MAX(last_used), 0) FROM results").fetchone()[0]
+        self._count = self._db.execute(
+            "SELECT COUNT(*) FROM results").fetchone()[0]
+        self._uncommitted = 0
+
+    @staticmethod
+    def _digest(key) -> bytes:
+        if isinstance(key, str):  # fast path for many keys, e.g. genotypes
+            return hashlib.sha256(key.encode()).digest()
+        return hashlib.sha256(repr(_canonical(key)).encode()).digest()
+
+    def get(self, key):
+        """Cached result for key or None, counts hits and misses"""
+        return self.get_many([key])[0]
+
+    def get_many(self, keys: list) -> list:
+        """Cached result (or None) for each key, looked up in one query"""
+        digests = [self._digest(key) for key in keys]
+        results = {}
+        with self._lock:
+            for k in range(0, len(digests), 512):  # SQLite variable limit
+                batch = digests[k:k + 512]
+                results.update(self._db.execute(
+                    "SELECT key, result FROM results WHERE key IN "
+                    f"({','.join('?' * len(batch))})", batch).fetchall())
+            if results:
+                self._clock += 1
+                self._db.executemany(
+                    "UPDATE results SET last_used = ? WHERE key = ?",
+                    [(self._clock, d) for d in results])
+        self.hits += sum(d in results for d in digests)
+        self.misses += sum(d not in results for d in digests)
+        return [json.loads(results[d]) if d in results else None 
+                for d in digests]
+
+    def put(self, key, result):
+        """Store result (JSON serializable) for key"""
+        self.put_many([(key, result)])
+
+    def put_many(self, items: list):
+        """Store several (key, result) pairs"""
+        with self._lock:
+            self._clock += 1
+            before = self._db.total_changes
+            self._db.executemany(
+                "INSERT OR IGNORE INTO results VALUES (?, ?, ?)",
+                [(self._digest(key), json.dumps(result), self._clock) 
+                 for key, result in items])
+            self._count += self._db.total_changes - before
+            if self.max_entries is not None \
+                    and self._count > self.max_entries:
+                self._db.execute(
+                    "DELETE FROM results WHERE key IN (SELECT key FROM "
+                    "results ORDER BY last_used LIMIT ?)", 
+                    (self._count - self.max_entries,))
+                self._count = self.max_entries
+            self._uncommitted += len(items)
+            if self._uncommitted >= self.commit_every:
+                self._db.commit()
+                self._uncommitted = 0
+
+    def commit(self):
+        """Write all results to disk"""
+        with self._lock:
+            self._db.commit()
+            self._uncommitted = 0
+
+    def close(self):
+        """Commit and close the cache file"""
+        self.commit()
+        self._db.close()
+
+    def __len__(self):
+        return self._count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
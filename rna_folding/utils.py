@@ -177,6 +177,54 @@ def combinatorically_complete_genotypes(l, a):
     return g
 
 
+def symmetry_orbits(l, a, automorphisms, reverse=False):
+    """Split the combinatorically complete genotype space into orbits under
+    relabeling of bases with automorphisms of the base-pairing graph and 
+    (optionally) reversal of the sequence. Genotype IDs follow the order of
+    combinatorically_complete_genotypes.
+
+    Args:
+        l (int): Sequence length.
+        a (str): Alphabet as a continuous string, e.g. "AUGC".
+        automorphisms (list): Permutations of base ids (tuples), e.g. from
+                              BasePairing.automorphisms. Must form a group.
+        reverse (bool): Also treat reversed genotypes as symmetric.
+
+    Yields:
+        (tuple): (representative, members) per orbit, where representative
+                 is the genotype (str) with the lowest ID and members a list
+                 of (genotype ID, reversed) tuples, reversed is True if the
+                 member is only reached from the representative by reversal.
+
+    """
+    powers = [len(a)**(l-1-p) for p in range(l)]
+    for ids in product(range(len(a)), repeat=l):
+        members = {}
+        for perm in automorphisms:
+            image = tuple(perm[b] for b in ids)
+            members[image] = False
+            if reverse:
+                members.setdefault(image[::-1], True)
+        if min(members) != ids:  # not the representative of its orbit
+            continue
+        yield ("".join(a[b] for b in ids), 
+               [(sum(b*p for b, p in zip(member, powers)), rev) 
+                for member, rev in members.items()])
+
+
+def mirror_dotbracket(db: str) -> str:
+    """Structure of the reversed sequence, e.g. "((..).)" -> "(.(..))"
+
+    Args:
+        db (str): dot-bracket string
+
+    Returns:
+        str: mirrored dot-bracket string
+
+    """
+    return db[::-1].translate(str.maketrans("()", ")("))
+
+
 def dotbracket_to_genotype(dotbracket: str, 
                            base_pair: str = "GC",
                            random: bool = True,
@@ -200,7 +248,7 @@ def dotbracket_to_genotype(dotbracket: str,
         str: Genotype that is consistent with the base-pairing.
     
     """
-    if seed:
+    if seed is not None:
         np.random.seed(seed)
     stack = []
     genotype = []
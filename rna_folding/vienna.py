@@ -0,0 +1,103 @@
+"""ViennaRNA backend that sets up model details once and reuses the fold
+compound of a sequence for all structures evaluated on it, instead of
+rebuilding both in every call of the module-level RNA.fold and
+RNA.eval_structure_simple.
+
+"""
+from collections import OrderedDict
+
+import RNA
+
+
+class ViennaRNABackend:
+    """Folds sequences and evaluates structures with ViennaRNA. Fold
+    compounds (sequence dependent energy parameters) are kept for the
+    maxsize most recently used sequences.
+
+    """
+    def __init__(self, md: RNA.md = None, maxsize: int = 16):
+        """Initialize backend
+
+        Args:
+            md (RNA.md): ViennaRNA model details, e.g. to change the
+                         temperature. Default = None (ViennaRNA defaults)
+            maxsize (int): Number of fold compounds kept. Default = 16
+
+        """
+        self._default_md = md is None
+        self.md = RNA.md() if md is None else md
+        self.maxsize = maxsize
+        self._compounds = OrderedDict()
+
+    def fold_compound(self, seq: str) -> RNA.fold_compound:
+        """Fold compound of a sequence, created once and reused
+
+        Args:
+            seq (str): The RNA sequence
+
+        Returns:
+            RNA.fold_compound: fold compound with the backend's model details
+
+        """
+        fc = self._compounds.get(seq)
+        if fc is None:
+            fc = RNA.fold_compound(seq, self.md)
+            self._compounds[seq] = fc
+            if len(self._compounds) > self.maxsize:
+                self._compounds.popitem(last=False)  # least recently used
+        else:
+            self._compounds.move_to_end(seq)
+        return fc
+
+    def fold(self, seq: str) -> tuple:
+        """Minimum free energy structure of a sequence
+
+        Args:
+            seq (str): The RNA sequence
+
+        Returns:
+            (tuple): (structure in dot-bracket notation, mfe)
+
+        """
+        if self._default_md:  # a new fold compound costs more than RNA.fold
+            return RNA.fold(seq)
+        return self.fold_compound(seq).mfe()
+
+    def fold_many(self, genotypes: list) -> list:
+        """Minimum free energy structures of several sequences, each distinct
+        sequence is folded once
+
+        Args:
+            genotypes (list): The RNA sequences (str)
+
+        Returns:
+            (list): (structure, mfe) per sequence, in input order
+
+        """
+        folded = {}
+        for seq in genotypes:
+            if seq not in folded:
+                folded[seq] = self.fold(seq)
+        return [folded[seq] for seq in genotypes]
+
+    def eval_structures(self, seq: str, structures: list) -> list:
+        """Free energies of several structures on the same sequence, using
+        one fold compound
+
+        Args:
+            seq (str): The RNA sequence
+            structures (list): Structures in dot-bracket notation (str)
+
+        Returns:
+            (list): Free energy (float) per structure
+
+        """
+        if len(structures) == 1 and self._default_md \
+                and seq not in self._compounds:  # not worth a fold compound
+            return [RNA.eval_structure_simple(seq, structures[0])]
+        fc = self.fold_compound(seq)
+        return [fc.eval_structure(s) for s in structures]
+
+    def eval_structure(self, seq: str, structure: str) -> float:
+        """Free energy of a structure on a sequence, see eval_structures"""
+        return self.eval_structures(seq, [structure])[0]
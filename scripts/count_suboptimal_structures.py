@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+"""Count the suboptimal Nussinov structures of each genotype without
+enumerating them. Writes one line per genotype with the genotype ID followed
+by the number of structures with P_max - k base-pairs for k = 0, ..., s.
+
+e.g. for -s 2:
+0 1 4 12
+1 2 9 40
+...
+
+Genotypes with more than -z structures in total can additionally be written
+to a separate file, to spot genotypes whose suboptimal sets explode before
+mapping them.
+
+"""
+import argparse
+
+from rna_folding.base_pairing import BasePairing
+from rna_folding.nussinov import BasePairMatrixNussinov
+
+
+if __name__ ==  "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", help="Input file with genotypes")
+    parser.add_argument("-o", "--output", help="Output file for structure counts")
+    parser.add_argument("-m", "--min_loop_size", required=True, type=int, default=1, help="Minimum size for loop")
+    parser.add_argument("-s", "--suboptimal", type=int, required=True,
+                        help="Count all suboptimal structures with number of base-pairs in the range"
+                             "of max - s, where s is an integer.")
+    parser.add_argument("-z", "--structures_max", required=False, type=int, 
+                        help="Genotypes with more structures than this are written to --flagged")
+    parser.add_argument("-f", "--flagged", required=False, type=str,
+                        help="Output file for IDs of genotypes with more than -z structures")
+    parser.add_argument("-p", "--base_pairing", required=False, type=int, default=-1, help="Which base-pairing to choose. I.e. from the base-pairing simple graphs, which one to pick "
+                        "e.g. for 4 bases there are 11 possible base-pairings, so possible input is any number between 1 and 11, If given -1 then it uses canonical base-pairing and AUGC bases")
+    parser.add_argument("-a", "--alphabet", required=False, type=str, default="AUGC", help="Which bases do the genotypes contain, e.g. 'AUGC' for canonical RNA")
+    parser.add_argument("-g", "--graph_path", required=False, type=str,
+                        help="Path to folder containing the base-pairing "
+                        "graphs files, e.g. graph4.adj. Check base_pairing.py "
+                        "for info on where these graphs come from.")
+
+    args = parser.parse_args()
+
+    pairing = BasePairing(bases=args.alphabet,
+                          graph_path=args.graph_path, 
+                          id=args.base_pairing)
+
+    flagged = []
+    with open(args.input, "r") as file_in, open(args.output, "w") as file_out:
+        for i, sequence in enumerate(file_in):
+            seq = sequence.strip()
+            P = BasePairMatrixNussinov(n=len(seq), base_pairing=pairing)
+            P.fill_matrix(seq=seq, min_loop_size=args.min_loop_size, engine="vectorized")
+            counts = P.count_structures(seq=seq, d=args.suboptimal)
+            file_out.write(str(i) + " " + " ".join(map(str, counts)) + "\n")
+            if args.structures_max is not None and sum(counts) > args.structures_max:
+                flagged.append(i)
+
+    if args.flagged:
+        with open(args.flagged, "w") as file_out:
+            for i in flagged:
+                file_out.write(str(i) + "\n")
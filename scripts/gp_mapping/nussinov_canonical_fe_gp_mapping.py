@@ -28,8 +28,13 @@ LLKKMMMOO (((...)))
 """
 import argparse
 
+import RNA
+
+from rna_folding.backends import get_backend
 from rna_folding.base_pairing import BasePairing
+from rna_folding.cli import add_mapping_arguments, mapping_kwargs, open_result_cache
 from rna_folding.mapping_functions import gp_mapper, nussinov_canonical_fe
+from rna_folding.result_cache import config_key
 
 
 if __name__ ==  "__main__":
@@ -42,7 +47,13 @@ if __name__ ==  "__main__":
                              "of max - s, where s is an integer. Without the flag, only one structure "
                              "is computed.")
     parser.add_argument("-z", "--structures_max", required=False, type=int, help="Limit on how many suboptimal structures to generate")
+    parser.add_argument("-f", "--prefilter", type=int, default=None,
+                        help="Only evaluate and report the phenotypes with the lowest approximate (stacking) energy")
     parser.add_argument("-a", "--alphabet", required=False, type=str, default="AUGC", help="Which bases do the genotypes contain, e.g. 'AUGC' for canonical RNA")
+    parser.add_argument("-b", "--batch_size", type=int, default=None,
+                        help="Map this many genotypes at once with one batch backend (see backends.py), sharing "
+                             "one ViennaRNA backend")
+    add_mapping_arguments(parser)
 
     args = parser.parse_args()
     
@@ -55,9 +66,25 @@ if __name__ ==  "__main__":
                                    base_pairing=pairing, 
                                    min_loop_size=args.min_loop_size, 
                                    suboptimal=args.suboptimal, 
-                                   structures_max=args.structures_max)
+                                   structures_max=args.structures_max,
+                                   prefilter=args.prefilter)
+
+    if args.batch_size:
+        mapping = get_backend("nussinov_canonical_fe",
+                              base_pairing=pairing,
+                              min_loop_size=args.min_loop_size,
+                              suboptimal=args.suboptimal,
+                              structures_max=args.structures_max,
+                              prefilter=args.prefilter,
+                              batch_size=args.batch_size)
+
+    result_cache = open_result_cache(args)
+    cache_config = config_key("nussinov_canonical_fe", RNA.__version__, pairing, args.min_loop_size, args.suboptimal,
+                              args.structures_max, args.prefilter)
 
     # generate g-p map and save to output file
     gp_mapper(input=args.input, output=args.output, 
-              mapping_function=mapping)
-
+              mapping_function=mapping, batch_size=args.batch_size,
+              result_cache=result_cache, cache_config=cache_config, **mapping_kwargs(args, args.output))
+    if result_cache is not None:
+        result_cache.close()
@@ -3,7 +3,10 @@
 import argparse
 
 from rna_folding.base_pairing import BasePairing
-from rna_folding.mapping_functions import gp_mapper, nussinov
+from rna_folding.cli import add_mapping_arguments, mapping_kwargs, open_result_cache, uses_checkpoint
+from rna_folding.result_cache import MaskResultCache, config_key
+from rna_folding.mapping_functions import gp_mapper, gp_mapper_complete, gp_mapper_multi, nussinov, \
+    nussinov_bands, nussinov_batch, nussinov_multi, nussinov_prefix_sharing
 
 
 if __name__ ==  "__main__":
@@ -11,31 +14,160 @@ if __name__ ==  "__main__":
     parser.add_argument("-i", "--input", help="Input file with genotypes")
     parser.add_argument("-o", "--output", help="File output for phenotypes")
     parser.add_argument("-m", "--min_loop_size", required=True, type=int, default=1, help="Minimum size for loop")
-    parser.add_argument("-s", "--suboptimal", type=int, required=True,
+    parser.add_argument("-s", "--suboptimal", type=int, nargs="+", required=True,
                         help="Create all suboptimal structures with number of base-pairs in the range"
                              "of max - s, where s is an integer. Without the flag, only one structure "
-                             "is computed.")
+                             "is computed. If several are given, one traceback of the widest band creates "
+                             "the maps of all of them, -o must then contain '{suboptimal}'")
     parser.add_argument("-z", "--structures_max", required=False, type=int, help="Limit on how many suboptimal structures to generate")
-    parser.add_argument("-p", "--base_pairing", required=False, type=int, default=-1, help="Which base-pairing to choose. I.e. from the base-pairing simple graphs, which one to pick "
-                        "e.g. for 4 bases there are 11 possible base-pairings, so possible input is any number between 1 and 11, If given -1 then it uses canonical base-pairing and AUGC bases")
+    parser.add_argument("-p", "--base_pairing", required=False, type=int, nargs="+", default=[-1], help="Which base-pairing to choose. I.e. from the base-pairing simple graphs, which one to pick "
+                        "e.g. for 4 bases there are 11 possible base-pairings, so possible input is any number between 1 and 11, If given -1 then it uses canonical base-pairing and AUGC bases. "
+                        "If several are given, the genotypes are read once and mapped under all of them, -o must then contain "
+                        "'{base_pairing}', e.g. 'bp_graph{base_pairing}/gp_map.txt'")
     parser.add_argument("-a", "--alphabet", required=False, type=str, default="AUGC", help="Which bases do the genotypes contain, e.g. 'AUGC' for canonical RNA")
     parser.add_argument("-g", "--graph_path", required=True, type=str,
                         help="Path to folder containing the base-pairing "
                         "graphs files, e.g. graph4.adj. Check base_pairing.py "
                         "for info on where these graphs come from.")
+    parser.add_argument("-e", "--engine", required=False, type=str, default="loop",
+                        choices=["loop", "vectorized", "four_russians"],
+                        help="How to fill the Nussinov matrix. 'vectorized' fills it with NumPy array operations, "
+                             "'four_russians' uses the sub-cubic Four-Russians speedup (for long sequences)")
+    parser.add_argument("-c", "--compact", action="store_true",
+                        help="Store the Nussinov matrix as packed upper triangle with the smallest sufficient dtype")
+    parser.add_argument("-w", "--max_span", required=False, type=int, default=None,
+                        help="Maximum base-pair span for local folding (as RNAplfold -L)")
+    parser.add_argument("-b", "--batch_size", required=False, type=int, default=None,
+                        help="Fold this many genotypes at once in a batch of Nussinov matrices")
+    parser.add_argument("-u", "--sample", action="store_true",
+                        help="Draw -z structures uniformly at random from all suboptimal structures instead of "
+                             "enumerating the first -z")
+    parser.add_argument("-r", "--seed", type=int, help="Random seed for --sample")
+    parser.add_argument("-x", "--prefix_sharing", action="store_true",
+                        help="Reuse the Nussinov matrix columns of the prefix shared with the previous genotype, "
+                             "fastest for genotypes in lexicographic order (as from build_genotype_space.py). "
+                             "Prefixes are shared within batches of -b genotypes (default 4096)")
+    parser.add_argument("-k", "--cache_size", type=int, default=None,
+                        help="Keep the phenotypes of this many pairing masks and reuse them for genotypes with the "
+                             "same pairing mask instead of folding them again")
+    parser.add_argument("-y", "--symmetry", action="store_true",
+                        help="Input is the complete genotype space (as from build_genotype_space.py), fold only one "
+                             "genotype per orbit under automorphisms of the base-pairing graph")
+    parser.add_argument("--reverse", action="store_true",
+                        help="With --symmetry, also fold only one of each genotype and its reverse (same genotype "
+                             "sets per phenotype, but order/multiplicity of suboptimal structures can differ)")
+    add_mapping_arguments(parser)
 
     args = parser.parse_args()
     
+    if len(args.base_pairing) > 1:
+        if args.batch_size or args.prefix_sharing or args.symmetry or args.sample or args.compact:
+            parser.error("several base-pairings can not be combined with -b, -x, -y, -u or -c")
+        if "{base_pairing}" not in args.output:
+            parser.error("with several base-pairings -o must contain '{base_pairing}'")
+    if len(args.suboptimal) > 1:
+        if len(args.base_pairing) > 1 or args.batch_size or args.prefix_sharing or args.symmetry or args.sample:
+            parser.error("several suboptimal values can not be combined with several -p, -b, -x, -y or -u")
+        if "{suboptimal}" not in args.output:
+            parser.error("with several suboptimal values -o must contain '{suboptimal}'")
+    if args.cache_size and (args.batch_size or args.prefix_sharing or len(args.suboptimal) > 1):
+        parser.error("-k can not be combined with -b, -x or several suboptimal values")
+    # the batched mappings only support some options of nussinov
+    if args.prefix_sharing and (args.sample or args.engine != "loop" or args.compact):
+        parser.error("-x can not be combined with -u, -e or -c")
+    if args.batch_size and not args.prefix_sharing and \
+            (args.sample or args.max_span is not None or args.engine != "loop" or args.compact):
+        parser.error("-b without -x can not be combined with -u, -w, -e or -c")
+    if args.symmetry and (args.sample or args.batch_size or args.prefix_sharing):
+        parser.error("--symmetry can not be combined with -u, -b or -x")
+    if args.symmetry and (args.workers or args.chunk_size or args.buffer_size or args.tmp_dir):
+        parser.error("--symmetry can not be combined with -j, --chunk_size, --buffer_size or --tmp_dir")
+    if args.symmetry and (uses_checkpoint(args) or args.result_cache):
+        parser.error("--symmetry can not be combined with --checkpoint_interval, --resume or --result_cache")
+    if args.sample and args.seed is None and args.result_cache:
+        parser.error("--result_cache needs a --seed with --sample")
+    if len(args.base_pairing) == 1 and "{base_pairing}" in args.output:
+        args.output = args.output.replace("{base_pairing}", str(args.base_pairing[0]))
+    if len(args.suboptimal) == 1 and "{suboptimal}" in args.output:
+        args.output = args.output.replace("{suboptimal}", str(args.suboptimal[0]))
+
     pairing = BasePairing(bases=args.alphabet,
                           graph_path=args.graph_path, 
-                          id=args.base_pairing)
+                          id=args.base_pairing[0])
     
+    cache = MaskResultCache(maxsize=args.cache_size) if args.cache_size else None
     mapping = lambda seq: nussinov(seq, 
                                    base_pairing=pairing, 
                                    min_loop_size=args.min_loop_size, 
-                                   suboptimal=args.suboptimal,
-                                   structures_max=args.structures_max)
+                                   suboptimal=args.suboptimal[0],
+                                   structures_max=args.structures_max,
+                                   engine=args.engine,
+                                   compact=args.compact,
+                                   max_span=args.max_span,
+                                   sample=args.sample,
+                                   seed=args.seed,
+                                   cache=cache)
+
+    if args.batch_size:
+        mapping = lambda seqs: nussinov_batch(seqs,
+                                              base_pairing=pairing,
+                                              min_loop_size=args.min_loop_size,
+                                              suboptimal=args.suboptimal[0],
+                                              structures_max=args.structures_max)
+
+    if args.prefix_sharing:
+        args.batch_size = args.batch_size if args.batch_size else 4096
+        mapping = lambda seqs: nussinov_prefix_sharing(seqs,
+                                                       base_pairing=pairing,
+                                                       min_loop_size=args.min_loop_size,
+                                                       suboptimal=args.suboptimal[0],
+                                                       structures_max=args.structures_max,
+                                                       max_span=args.max_span)
+
+    pairings = [BasePairing(bases=args.alphabet, graph_path=args.graph_path, id=id_)
+                for id_ in args.base_pairing]
+    result_cache = open_result_cache(args)
+    cache_config = config_key("nussinov", pairings, args.min_loop_size, args.suboptimal, args.structures_max,
+                              args.max_span, args.sample, args.seed)
 
     # generate g-p map and save to output file
-    gp_mapper(input=args.input, output=args.output, 
-              mapping_function=mapping)
+    if len(args.base_pairing) > 1:
+        # read genotypes once and write one g-p map per base-pairing
+        mapping = lambda seq: nussinov_multi(seq,
+                                             base_pairings=pairings,
+                                             min_loop_size=args.min_loop_size,
+                                             suboptimal=args.suboptimal[0],
+                                             structures_max=args.structures_max,
+                                             engine=args.engine,
+                                             max_span=args.max_span,
+                                             cache=cache)
+        outputs = [args.output.replace("{base_pairing}", str(id_)) for id_ in args.base_pairing]
+        gp_mapper_multi(input=args.input, outputs=outputs,
+                        mapping_function=mapping,
+                        result_cache=result_cache, cache_config=cache_config, **mapping_kwargs(args, outputs[0]))
+    elif len(args.suboptimal) > 1:
+        # one traceback of the widest band per genotype, one g-p map per band
+        mapping = lambda seq: nussinov_bands(seq,
+                                             base_pairing=pairing,
+                                             min_loop_size=args.min_loop_size,
+                                             suboptimal=args.suboptimal,
+                                             structures_max=args.structures_max,
+                                             engine=args.engine,
+                                             compact=args.compact,
+                                             max_span=args.max_span)
+        outputs = [args.output.replace("{suboptimal}", str(d)) for d in args.suboptimal]
+        gp_mapper_multi(input=args.input, outputs=outputs,
+                        mapping_function=mapping,
+                        result_cache=result_cache, cache_config=cache_config, **mapping_kwargs(args, outputs[0]))
+    elif args.symmetry:
+        with open(args.input, "r") as file_in:
+            l = len(file_in.readline().strip())
+        # the input has to be the complete genotype space in genotype ID order, which is checked while mapping
+        gp_mapper_complete(l=l, alphabet=args.alphabet, output=args.output, mapping_function=mapping,
+                           base_pairing=pairing, reverse=args.reverse, input=args.input)
+    else:
+        gp_mapper(input=args.input, output=args.output, 
+                  mapping_function=mapping, batch_size=args.batch_size,
+                  result_cache=result_cache, cache_config=cache_config, **mapping_kwargs(args, args.output))
+    if result_cache is not None:
+        result_cache.close()
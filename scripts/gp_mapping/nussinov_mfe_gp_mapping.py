@@ -27,9 +27,17 @@ LLKKMMMOO (((...)))
 
 """
 import argparse
+import multiprocessing
+import os
 
+import RNA
+
+from rna_folding.backends import get_backend
 from rna_folding.base_pairing import BasePairing
+from rna_folding.cli import add_mapping_arguments, mapping_kwargs, open_result_cache
+from rna_folding.energy_cache import PhenotypeEnergyCache
 from rna_folding.mapping_functions import gp_mapper, nussinov_mfe
+from rna_folding.result_cache import config_key
 
 
 if __name__ ==  "__main__":
@@ -57,6 +65,21 @@ if __name__ ==  "__main__":
                         help="Do not assign bases randomly.")
     parser.add_argument("-r", "--seed", type=int,
                         help="Random seed in case -d is True")
+    parser.add_argument("-u", "--sample", action="store_true",
+                        help="Draw -z structures uniformly at random from all suboptimal structures instead of "
+                             "enumerating the first -z")
+    parser.add_argument("-c", "--energy_cache", type=str,
+                        help="File with energies of phenotypes, loaded if it exists and updated after mapping. "
+                             "Energies of phenotypes are computed once instead of once per genotype")
+    parser.add_argument("--cache_size", type=int, default=None,
+                        help="Maximum number of phenotype energies kept in memory")
+    parser.add_argument("-f", "--prefilter", type=int, default=None,
+                        help="Only evaluate the candidates with the lowest approximate (stacking) energy with "
+                             "ViennaRNA")
+    parser.add_argument("--batch_size", type=int, default=None,
+                        help="Map this many genotypes at once with one batch backend (see backends.py), sharing "
+                             "one ViennaRNA backend and phenotype energy cache")
+    add_mapping_arguments(parser, chunk_seed=True)
 
     args = parser.parse_args()
     
@@ -64,6 +87,13 @@ if __name__ ==  "__main__":
                           graph_path=args.graph_path, 
                           id=args.base_pairing)
     
+    energy_cache = None
+    if args.energy_cache or args.cache_size:
+        path = args.energy_cache if args.energy_cache and os.path.exists(args.energy_cache) else None
+        energy_cache = PhenotypeEnergyCache(base_pair=args.basepair, deterministic=args.deterministic,
+                                            seed=args.seed, maxsize=args.cache_size, path=path,
+                                            store=multiprocessing.Manager().dict() if args.workers else None)
+
     mapping = lambda seq: nussinov_mfe(seq, 
                                    base_pairing=pairing, 
                                    min_loop_size=args.min_loop_size, 
@@ -71,9 +101,37 @@ if __name__ ==  "__main__":
                                    structures_max=args.structures_max,
                                    seed=args.seed,
                                    deterministic=args.deterministic,
-                                   base_pair=args.basepair)
+                                   base_pair=args.basepair,
+                                   sample=args.sample,
+                                   energy_cache=energy_cache,
+                                   prefilter=args.prefilter)
+
+    if args.batch_size:
+        mapping = get_backend("nussinov_mfe",
+                              base_pairing=pairing,
+                              min_loop_size=args.min_loop_size,
+                              suboptimal=args.suboptimal,
+                              structures_max=args.structures_max,
+                              seed=args.seed,
+                              deterministic=args.deterministic,
+                              base_pair=args.basepair,
+                              sample=args.sample,
+                              energy_cache=energy_cache,
+                              prefilter=args.prefilter,
+                              batch_size=args.batch_size)
+
+    if args.result_cache and (args.sample or args.deterministic) and args.seed is None:
+        parser.error("--result_cache needs a --seed with --sample or --deterministic")
+    result_cache = open_result_cache(args)
+    cache_config = config_key("nussinov_mfe", RNA.__version__, pairing, args.min_loop_size, args.suboptimal,
+                              args.structures_max, args.seed, args.deterministic, args.basepair, args.sample,
+                              args.prefilter)
 
     # generate g-p map and save to output file
     gp_mapper(input=args.input, output=args.output, 
-              mapping_function=mapping)
-
+              mapping_function=mapping, batch_size=args.batch_size,
+              result_cache=result_cache, cache_config=cache_config, **mapping_kwargs(args, args.output))
+    if args.energy_cache:
+        energy_cache.save(args.energy_cache)
+    if result_cache is not None:
+        result_cache.close()
@@ -2,16 +2,31 @@
 
 import argparse
 
+import RNA
+
+from rna_folding.backends import get_backend
+from rna_folding.cli import add_mapping_arguments, mapping_kwargs, open_result_cache
 from rna_folding.mapping_functions import gp_mapper, viennaRNA_mfe
+from rna_folding.result_cache import config_key
 
 
 if __name__ ==  "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--input", help="Input file with genotypes")
     parser.add_argument("-o", "--output", help="File output for phenotypes")
+    parser.add_argument("-b", "--batch_size", required=False, type=int, default=None,
+                        help="Fold this many genotypes at once with one batch backend (see backends.py)")
+    add_mapping_arguments(parser)
 
     args = parser.parse_args()
 
+    result_cache = open_result_cache(args)
+    cache_config = config_key("viennaRNA_mfe", RNA.__version__)
+
     # generate g-p map and save to output file
     gp_mapper(input=args.input, output=args.output, 
-              mapping_function=viennaRNA_mfe)
+              mapping_function=get_backend("viennaRNA_mfe") if args.batch_size else viennaRNA_mfe,
+              batch_size=args.batch_size,
+              result_cache=result_cache, cache_config=cache_config, **mapping_kwargs(args, args.output))
+    if result_cache is not None:
+        result_cache.close()
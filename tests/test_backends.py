@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from rna_folding.backends import LegacyMappingBackend, MappingBackend, get_backend
+from rna_folding.base_pairing import BasePairing
+from rna_folding.mapping_functions import gp_mapper, nussinov, nussinov_canonical_fe, nussinov_mfe, viennaRNA_mfe
+from rna_folding.utils import combinatorically_complete_genotypes
+
+
+def test_backends():
+    pairing = BasePairing(bases="AUGC", graph_path=None, id=-1)
+    params = dict(base_pairing=pairing, min_loop_size=1, suboptimal=2, structures_max=None)
+    genotypes = ["".join(g) for g in combinatorically_complete_genotypes(7, "AUGC")]
+    ids = np.arange(0, len(genotypes), 37)
+    for name, kwargs, mapping in [
+            ("nussinov", dict(params), lambda g: nussinov(g, **params)),
+            ("nussinov", dict(params, max_span=4), lambda g: nussinov(g, **params, max_span=4)),
+            ("nussinov", dict(params, engine="vectorized"), lambda g: nussinov(g, **params)),
+            ("nussinov_mfe", dict(params), lambda g: nussinov_mfe(g, **params, seed=None)),
+            ("nussinov_canonical_fe", dict(params), lambda g: nussinov_canonical_fe(g, **params)),
+            ("viennaRNA_mfe", {}, viennaRNA_mfe)]:
+        backend = get_backend(name, alphabet="AUGC", length=7, **kwargs)
+        expected = [mapping(genotypes[i]) for i in ids]
+        ph_ids, offsets = backend.map_batch(ids)
+        assert len(offsets) == len(ids) + 1 and len(ph_ids) == offsets[-1]
+        assert backend.unpack(ph_ids, offsets) == expected
+        assert backend([genotypes[i] for i in ids]) == expected
+
+    with pytest.raises(ValueError):
+        get_backend("unknown")
+    with pytest.raises(ValueError):  # IDs without alphabet and length
+        get_backend("viennaRNA_mfe").map_batch([0, 1])
+    with pytest.raises(TypeError):  # map_sequences is abstract
+        MappingBackend()
+    # energies with a seed (also 0) are reproducible and shared by default
+    backend = get_backend("nussinov_mfe", **params, seed=0, deterministic=True)
+    assert backend.params["energy_cache"] is not None
+    assert backend(genotypes[::37]) == [nussinov_mfe(g, **params, seed=0, deterministic=True) for g in genotypes[::37]]
+
+
+def test_gp_mapper_backend(tmp_path):
+    genotypes = tmp_path / "genotypes.txt"
+    genotypes.write_text("".join("".join(g) + "\n" for g in combinatorically_complete_genotypes(5, "AUGC")))
+    pairing = BasePairing(bases="AUGC", graph_path=None, id=-1)
+    mapping = lambda seq: nussinov(seq, base_pairing=pairing, min_loop_size=1, suboptimal=1, structures_max=None)
+
+    gp_mapper(input=genotypes, output=tmp_path / "ref.txt", mapping_function=mapping)
+    for name, backend in [("legacy", LegacyMappingBackend(mapping, batch_size=100)),
+                          ("nussinov", get_backend("nussinov", base_pairing=pairing, min_loop_size=1, suboptimal=1,
+                                                   structures_max=None, batch_size=300))]:
+        gp_mapper(input=genotypes, output=tmp_path / f"{name}.txt", mapping_function=backend)
+        assert (tmp_path / f"{name}.txt").read_text() == (tmp_path / "ref.txt").read_text()
@@ -0,0 +1,22 @@
+import argparse
+
+from rna_folding.cli import add_mapping_arguments, mapping_kwargs, open_result_cache
+
+
+def test_mapping_kwargs(tmp_path):
+    parser = argparse.ArgumentParser()
+    add_mapping_arguments(parser, chunk_seed=True)
+    args = parser.parse_args(["-j", "2", "--chunk_seed", "5", "--resume"])
+    assert mapping_kwargs(args, "map.txt") == dict(workers=2, chunk_size=None, seed=5, buffer_size=None,
+                                                   tmp_dir=None, checkpoint="map.txt.checkpoint",
+                                                   checkpoint_interval=600, resume=True)
+    assert open_result_cache(args) is None
+
+    parser = argparse.ArgumentParser()
+    add_mapping_arguments(parser)
+    args = parser.parse_args(["--result_cache", str(tmp_path / "cache.sqlite")])
+    kwargs = mapping_kwargs(args, "map.txt")
+    assert kwargs["checkpoint"] is None and kwargs["seed"] is None
+    result_cache = open_result_cache(args)
+    assert len(result_cache) == 0
+    result_cache.close()
@@ -0,0 +1,13 @@
+from rna_folding.dp_matrix import TriangularMatrix
+
+
+def test_triangular_matrix_pool():
+    M = TriangularMatrix(n=6)
+    M[1, 6] = 3
+    assert M[1, 6] == M[1, -1] == 3
+    assert M[4, 2] == 0
+    data = M.data
+    M.release()
+    M_ = TriangularMatrix(n=6)
+    assert M_.data is data  # buffer is reused
+    assert M_[1, 6] == 0  # and zeroed
@@ -0,0 +1,47 @@
+import pytest
+
+from rna_folding.base_pairing import BasePairing
+from rna_folding.energy_cache import PhenotypeEnergyCache
+from rna_folding.mapping_functions import debug_nussinov_mfe, nussinov_mfe
+from rna_folding.utils import combinatorically_complete_genotypes
+
+
+@pytest.mark.parametrize("deterministic, seed", [(False, None), (True, 3), (True, 0)])
+def test_nussinov_mfe_energy_cache(tmp_path, deterministic, seed):
+    pairing = BasePairing(bases="AUGC", graph_path=None, id=-1)
+    genotypes = ["".join(g) for g in combinatorically_complete_genotypes(7, "AUGC")][::37]
+    params = dict(base_pairing=pairing, min_loop_size=1, suboptimal=2, structures_max=None, seed=seed,
+                  deterministic=deterministic)
+    cache = PhenotypeEnergyCache(deterministic=deterministic, seed=seed, maxsize=20)
+
+    ref = [nussinov_mfe(g, **params) for g in genotypes]
+    assert [nussinov_mfe(g, energy_cache=cache, **params) for g in genotypes] == ref
+    assert len(cache) == 20 and cache.hits > 0
+
+    cache.save(tmp_path / "energies.txt")
+    loaded = PhenotypeEnergyCache(deterministic=deterministic, seed=seed, path=tmp_path / "energies.txt")
+    assert all(ph in loaded for ph in cache._energies)
+    assert [nussinov_mfe(g, energy_cache=loaded, **params) for g in genotypes] == ref
+
+
+def test_energy_cache_arguments():
+    with pytest.raises(ValueError):
+        PhenotypeEnergyCache(deterministic=True, seed=None)
+    pairing = BasePairing(bases="AUGC", graph_path=None, id=-1)
+    with pytest.raises(ValueError):
+        nussinov_mfe("GGGAAACCC", pairing, 1, 0, None, seed=None, base_pair="AU",
+                     energy_cache=PhenotypeEnergyCache(base_pair="GC"))
+
+
+def test_debug_nussinov_mfe_energy_cache():
+    pairing = BasePairing(bases="AUGC", graph_path=None, id=-1)
+    params = dict(base_pairing=pairing, min_loop_size=1, suboptimal=2, structures_max=None, seed=3,
+                  deterministic=True)
+    cache = PhenotypeEnergyCache(deterministic=True, seed=3)
+    for genotype in ["GGGAAACCC", "GCAUGCAUGC", "AUGGCAUCCGA"]:
+        mfe_ph, phenotypes, energies = debug_nussinov_mfe(genotype, energy_cache=cache, **params)
+        # energies on the canonical genotypes of nussinov_mfe
+        assert energies == [PhenotypeEnergyCache(deterministic=True, seed=3).energy(ph) for ph in phenotypes]
+        assert mfe_ph == nussinov_mfe(genotype, **params)
+    with pytest.raises(ValueError):
+        debug_nussinov_mfe("GGGAAACCC", energy_cache=PhenotypeEnergyCache(base_pair="AU"), **params)
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+import RNA
+
+from rna_folding.base_pairing import BasePairing
+from rna_folding.energy_cache import PhenotypeEnergyCache
+from rna_folding.energy_model import pair_tables, stacking_energies
+from rna_folding.mapping_functions import nussinov_mfe
+
+
+def test_pair_tables():
+    structures = ["((..))..", "(.)(..).", "........"]
+    pt = pair_tables(structures)
+    assert pt.shape == (3, 9)
+    for db, pt_ in zip(structures, pt):
+        assert list(pt_) == list(RNA.ptable(db))
+
+
+def test_stacked_helices_match_viennarna():
+    # closed helices with a triloop have no dangles, mismatches or other loops
+    seqs = ["GGGAAACCC", "GGAAACC", "GAGAAACUC", "GUGAAACAC"]
+    structures = ["(((...)))", "((...))", "(((...)))", "(((...)))"]
+    for seq, db in zip(seqs, structures):
+        assert stacking_energies(seq, [db])[0] == pytest.approx(RNA.eval_structure_simple(seq, db), abs=1e-6)
+    # one sequence per structure gives the same as one call per structure
+    energies = stacking_energies(["GGGAAACCC", "GAGAAACUC"], ["(((...)))", ".((...)).",])
+    assert list(energies) == [stacking_energies("GGGAAACCC", ["(((...)))"])[0],
+                              stacking_energies("GAGAAACUC", [".((...))."])[0]]
+
+
+def test_prefilter_keeps_all_candidates():
+    pairing = BasePairing(bases="AUGC", graph_path=None, id=-1)
+    rng = np.random.default_rng(2)
+    for _ in range(20):
+        genotype = "".join(rng.choice(list("AUGC"), size=12))
+        params = dict(base_pairing=pairing, min_loop_size=3, suboptimal=2, structures_max=None, seed=None)
+        assert nussinov_mfe(genotype, prefilter=10**6, **params) == nussinov_mfe(genotype, **params)
+        params.update(seed=3, deterministic=True)
+        cache = PhenotypeEnergyCache(deterministic=True, seed=3)
+        assert nussinov_mfe(genotype, prefilter=10**6, energy_cache=cache, **params) == \
+            nussinov_mfe(genotype, **params)
@@ -0,0 +1,21 @@
+import numpy as np
+
+from rna_folding.gpmap_writer import GPMapWriter
+from rna_folding.utils import dict_to_gpmap
+
+
+def test_gpmap_writer(tmp_path):
+    rng = np.random.default_rng(0)
+    phenotypes = ["." * 5 + str(k) for k in range(20)]
+    ph_to_gt = {}
+    with GPMapWriter(tmp_path / "streamed.txt", buffer_size=7) as writer:
+        for i in range(300):
+            phs = [phenotypes[k] for k in rng.integers(0, 20, size=rng.integers(0, 4))]
+            writer.add(i, phs)
+            for ph in phs:
+                ph_to_gt.setdefault(ph, []).append(i)
+        assert len(writer.runs) > 1
+    dict_to_gpmap(ph_to_gt, tmp_path / "ref.txt")
+
+    assert (tmp_path / "streamed.txt").read_text() == (tmp_path / "ref.txt").read_text()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["ref.txt", "streamed.txt"]
@@ -0,0 +1,226 @@
+import os
+from functools import partial
+
+import numpy as np
+import pytest
+
+from rna_folding.base_pairing import BasePairing
+from rna_folding.mapping_functions import gp_mapper, gp_mapper_complete, gp_mapper_multi, nussinov, \
+    nussinov_batch, nussinov_mfe, nussinov_multi, nussinov_ranked
+from rna_folding.result_cache import MaskResultCache
+from rna_folding.utils import combinatorically_complete_genotypes
+
+
+def write_genotypes(path, l=6, a="AUGC"):
+    with open(path, "w") as f:
+        for g in combinatorically_complete_genotypes(l, a):
+            f.write("".join(g) + "\n")
+
+
+def test_batched_gp_mapper(tmp_path):
+    genotypes = tmp_path / "genotypes.txt"
+    write_genotypes(genotypes)
+    pairing = BasePairing(bases="AUGC", graph_path=None, id=-1)
+    params = dict(base_pairing=pairing, min_loop_size=1, suboptimal=1, 
+                  structures_max=None)
+
+    gp_mapper(input=genotypes, output=tmp_path / "ref.txt", 
+              mapping_function=partial(nussinov, **params))
+    gp_mapper(input=genotypes, output=tmp_path / "batch.txt", 
+              mapping_function=partial(nussinov_batch, **params), 
+              batch_size=300)
+
+    assert (tmp_path / "ref.txt").read_text() == (tmp_path / "batch.txt").read_text()
+
+    gp_mapper(input=genotypes, output=tmp_path / "streamed.txt", 
+              mapping_function=partial(nussinov_batch, **params), 
+              batch_size=300, buffer_size=1000)
+    assert (tmp_path / "ref.txt").read_text() == (tmp_path / "streamed.txt").read_text()
+
+
+def test_parallel_gp_mapper(tmp_path):
+    genotypes = tmp_path / "genotypes.txt"
+    write_genotypes(genotypes, l=5)
+    pairing = BasePairing(bases="AUGC", graph_path=None, id=-1)
+    mapping = lambda seq: nussinov(seq, base_pairing=pairing, min_loop_size=1,
+                                   suboptimal=1, structures_max=None)
+
+    gp_mapper(input=genotypes, output=tmp_path / "ref.txt", 
+              mapping_function=mapping)
+    gp_mapper(input=genotypes, output=tmp_path / "parallel.txt", 
+              mapping_function=mapping, workers=2, chunk_size=100)
+    assert (tmp_path / "ref.txt").read_text() == (tmp_path / "parallel.txt").read_text()
+
+    # random mappings give the same map for any number of workers with a seed
+    write_genotypes(genotypes, l=4)
+    mapping = partial(nussinov_mfe, base_pairing=pairing, min_loop_size=1,
+                      suboptimal=1, structures_max=None, seed=None)
+    for workers in [None, 2]:
+        gp_mapper(input=genotypes, output=tmp_path / f"mfe_{workers}.txt", 
+                  mapping_function=mapping, workers=workers, chunk_size=50,
+                  seed=1)
+    assert (tmp_path / "mfe_None.txt").read_text() == (tmp_path / "mfe_2.txt").read_text()
+
+
+def test_parallel_workers_draw_independently(tmp_path):
+    genotypes = tmp_path / "genotypes.txt"
+    write_genotypes(genotypes, l=4)
+    mapping = lambda seq: [str(np.random.randint(2**30))]
+    np.random.seed(0)  # e.g. by dotbracket_to_genotype, workers are forked with this state
+    gp_mapper(input=genotypes, output=tmp_path / "gp_map.txt", mapping_function=mapping, workers=2, chunk_size=16)
+    draws = {int(gt_id): ph for ph, gt_ids in read_gpmap(tmp_path / "gp_map.txt").items() for gt_id in gt_ids}
+    chunks = [[draws[i] for i in range(first, first + 16)] for first in range(0, 256, 16)]
+    assert len({tuple(chunk) for chunk in chunks}) == len(chunks)
+
+
+def test_gp_mapper_resume(tmp_path):
+    genotypes = tmp_path / "genotypes.txt"
+    write_genotypes(genotypes, l=5)
+    pairing = BasePairing(bases="AUGC", graph_path=None, id=-1)
+    # random mapping, to check that the random state is resumed as well
+    mapping = lambda seq: [np.random.choice(nussinov(
+        seq, base_pairing=pairing, min_loop_size=1, suboptimal=2, 
+        structures_max=None))]
+    params = dict(input=genotypes, output=tmp_path / "gp_map.txt", 
+                  chunk_size=50, buffer_size=100, 
+                  checkpoint=str(tmp_path / "checkpoint"), 
+                  checkpoint_interval=0, cache_config="random nussinov")
+
+    def interrupted(seq, calls=[]):
+        calls.append(seq)
+        if len(calls) > 420:
+            raise KeyboardInterrupt
+        return mapping(seq)
+
+    np.random.seed(0)
+    gp_mapper(input=genotypes, output=tmp_path / "ref.txt", 
+              mapping_function=mapping)
+    np.random.seed(0)
+    try:
+        gp_mapper(mapping_function=interrupted, **params)
+    except KeyboardInterrupt:
+        pass
+    assert not (tmp_path / "gp_map.txt").exists()
+    # the checkpoint is only resumed by the same mapping
+    with pytest.raises(ValueError):
+        gp_mapper(mapping_function=mapping, resume=True, **dict(params, cache_config="other mapping"))
+    with pytest.raises(ValueError):
+        gp_mapper(mapping_function=mapping, resume=True, **dict(params, cache_config=None))
+    np.random.seed(1)  # the random state is restored from the checkpoint
+    gp_mapper(mapping_function=mapping, resume=True, **params)
+
+    assert (tmp_path / "ref.txt").read_text() == (tmp_path / "gp_map.txt").read_text()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["genotypes.txt", "gp_map.txt", "ref.txt"]
+
+
+def test_gp_mapper_resume_missing_runs(tmp_path):
+    genotypes = tmp_path / "genotypes.txt"
+    write_genotypes(genotypes, l=5)
+    pairing = BasePairing(bases="AUGC", graph_path=None, id=-1)
+    mapping = partial(nussinov, base_pairing=pairing, min_loop_size=1, suboptimal=1, structures_max=None)
+    params = dict(input=genotypes, output=tmp_path / "gp_map.txt", chunk_size=50, buffer_size=100,
+                  checkpoint=str(tmp_path / "checkpoint"), checkpoint_interval=0, cache_config="nussinov")
+
+    def interrupted(seq, calls=[]):
+        calls.append(seq)
+        if len(calls) > 420:
+            raise KeyboardInterrupt
+        return mapping(seq)
+
+    gp_mapper(input=genotypes, output=tmp_path / "ref.txt", mapping_function=mapping)
+    try:
+        gp_mapper(mapping_function=interrupted, **params)
+    except KeyboardInterrupt:
+        pass
+    # e.g. a crash after the runs were removed, but before the checkpoint was
+    (run_dir,) = tmp_path.glob("gpmap_runs_*")
+    os.remove(next(run_dir.iterdir()))
+    gp_mapper(mapping_function=mapping, resume=True, **params)
+
+    assert (tmp_path / "ref.txt").read_text() == (tmp_path / "gp_map.txt").read_text()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["genotypes.txt", "gp_map.txt", "ref.txt"]
+
+
+def test_nussinov_sample_distinct():
+    pairing = BasePairing(bases="AUGC", graph_path=None, id=-1)
+    for genotype in ["GCGCGCAAGCGCGC", "GGGGAAACCCC"]:
+        r = nussinov(genotype, base_pairing=pairing, min_loop_size=1, suboptimal=2,
+                     structures_max=20, sample=True, seed=3)
+        assert len(set(r)) == len(r)
+        assert set(r) <= set(nussinov(genotype, base_pairing=pairing, min_loop_size=1, 
+                                      suboptimal=2, structures_max=None))
+
+
+def read_gpmap(path):
+    ph_to_gt = {}
+    for line in path.read_text().splitlines():
+        ph, *ids = line.split()
+        ph_to_gt[ph] = ids
+    return ph_to_gt
+
+
+def test_gp_mapper_complete(tmp_path):
+    genotypes = tmp_path / "genotypes.txt"
+    write_genotypes(genotypes)
+    pairing = BasePairing(bases="AUGC", graph_path=None, id=-1)
+    mapping = partial(nussinov, base_pairing=pairing, min_loop_size=1, 
+                      suboptimal=1, structures_max=None)
+
+    gp_mapper(input=genotypes, output=tmp_path / "ref.txt", 
+              mapping_function=mapping)
+    gp_mapper_complete(6, "AUGC", tmp_path / "sym.txt", mapping, pairing, input=genotypes)
+    assert (tmp_path / "ref.txt").read_text() == (tmp_path / "sym.txt").read_text()
+
+    # the input has to be the complete space in genotype ID order
+    lines = genotypes.read_text().splitlines()
+    for wrong in [lines[1:] + lines[:1], lines[:-1], lines + ["AAAAAA"], [g.replace("G", "T") for g in lines]]:
+        (tmp_path / "wrong.txt").write_text("\n".join(wrong) + "\n")
+        with pytest.raises(ValueError):
+            gp_mapper_complete(6, "AUGC", tmp_path / "x.txt", mapping, pairing, input=tmp_path / "wrong.txt")
+
+    # with reversal only the set of genotypes per phenotype is identical
+    gp_mapper_complete(6, "AUGC", tmp_path / "rev.txt", mapping, pairing, 
+                       reverse=True)
+    ref, rev = read_gpmap(tmp_path / "ref.txt"), read_gpmap(tmp_path / "rev.txt")
+    assert ref.keys() == rev.keys()
+    assert all(set(ref[ph]) == set(rev[ph]) for ph in ref)
+
+
+def test_gp_mapper_multi(tmp_path):
+    genotypes = tmp_path / "genotypes.txt"
+    write_genotypes(genotypes, l=5)
+    canonical = BasePairing(bases="AUGC", graph_path=None, id=-1)
+    gc_only = BasePairing(bases="AUGC", graph_path=None, id=-1)
+    gc_only.A = np.zeros_like(canonical.A)
+    gc_only.A[2, 3] = gc_only.A[3, 2] = 1
+    params = dict(min_loop_size=1, suboptimal=1, structures_max=None)
+
+    for name, pairing in [("canonical", canonical), ("gc_only", gc_only)]:
+        gp_mapper(input=genotypes, output=tmp_path / f"{name}_ref.txt",
+                  mapping_function=partial(nussinov, base_pairing=pairing, 
+                                           **params))
+    for cache in [None, MaskResultCache(maxsize=64)]:
+        gp_mapper_multi(input=genotypes, 
+                        outputs=[tmp_path / "canonical.txt", tmp_path / "gc_only.txt"],
+                        mapping_function=partial(nussinov_multi, 
+                                                 base_pairings=[canonical, gc_only],
+                                                 cache=cache, **params))
+
+        for name in ["canonical", "gc_only"]:
+            assert (tmp_path / f"{name}_ref.txt").read_text() == (tmp_path / f"{name}.txt").read_text()
+
+
+def test_nussinov_ranked():
+    pairing = BasePairing(bases="AUGC", graph_path=None, id=-1)
+    rng = np.random.default_rng(11)
+    for g in combinatorically_complete_genotypes(7, "AUGC"):
+        if rng.random() > 0.05:
+            continue
+        genotype = "".join(g)
+        phenotypes = nussinov(genotype, base_pairing=pairing, min_loop_size=1,
+                              suboptimal=2, structures_max=None)
+        ranking = sorted(set(phenotypes))
+        rng.shuffle(ranking)
+        best = min(phenotypes, key=ranking.index)
+        assert nussinov_ranked(genotype, base_pairing=pairing, min_loop_size=1,
+                               suboptimal=2, ranking=ranking) == [best]
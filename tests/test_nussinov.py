@@ -0,0 +1,223 @@
+import numpy as np
+import pytest
+
+from rna_folding.base_pairing import BasePairing
+from rna_folding.dp_matrix import TriangularMatrix
+from rna_folding.mapping_functions import nussinov
+from rna_folding.nussinov import BasePairMatrixNussinov, BatchBasePairMatrixNussinov, pairing_candidates, _block_tables
+
+
+def random_genotypes(number, length, alphabet="AUGC", seed=1996):
+    rng = np.random.default_rng(seed)
+    return ["".join(rng.choice(list(alphabet), size=length)) 
+            for _ in range(number)]
+
+
+def filled_matrix(seq, min_loop_size, **kwargs):
+    pairing = BasePairing(bases="AUGC", graph_path=None, id=-1)
+    P = BasePairMatrixNussinov(n=len(seq), base_pairing=pairing)
+    P.fill_matrix(seq=seq, min_loop_size=min_loop_size, **kwargs)
+    return P
+
+
+@pytest.mark.parametrize("engine", ["vectorized", "four_russians"])
+@pytest.mark.parametrize("min_loop_size", [0, 1, 3])
+def test_fill_engines_match_loop(engine, min_loop_size):
+    for length in [1, 2, 14, 33]:
+        for seq in random_genotypes(number=20, length=length):
+            P_ref = filled_matrix(seq, min_loop_size, engine="loop")
+            P = filled_matrix(seq, min_loop_size, engine=engine)
+            assert np.array_equal(P.P, P_ref.P)
+
+
+def test_four_russians_compact_and_tables():
+    for seq in random_genotypes(number=5, length=40):
+        P_ref = filled_matrix(seq, 1, engine="loop")
+        P = BasePairMatrixNussinov(n=len(seq), base_pairing=P_ref.base_pairing, compact=True)
+        P.fill_matrix(seq=seq, min_loop_size=1, engine="four_russians")
+        i, j = np.triu_indices(len(seq) + 1)
+        assert np.array_equal(P.P[i, j], P_ref.P[i, j])
+
+    # tables match the direct maximum over the cumulated code bits
+    q = 5
+    V = np.random.default_rng(0).integers(-3, 4, size=(3, q))
+    codes = np.arange(1 << (q-1))
+    S = np.hstack([np.zeros((len(codes), 1), dtype=int),
+                   np.cumsum((codes[:, None] >> np.arange(q-1)[None, :]) & 1, axis=1)])
+    assert np.array_equal(_block_tables(V), (S[None, :, :] + V[:, None, :]).max(axis=2))
+
+
+def test_batch_matches_single():
+    pairing = BasePairing(bases="AUGC", graph_path=None, id=-1)
+    seqs = random_genotypes(number=20, length=10)
+    batch = BatchBasePairMatrixNussinov(n=10, base_pairing=pairing)
+    batch.fill_matrix(seqs=seqs, min_loop_size=1)
+    strucs = batch.traceback_subopt(d=1)
+
+    for b, seq in enumerate(seqs):
+        P_ref = filled_matrix(seq, min_loop_size=1)
+        assert np.array_equal(batch.P[b], P_ref.P)
+        assert batch.maximum_bp[b] == P_ref.P[1, -1]
+        assert [s.B for s in strucs[b]] == [s.B for s in P_ref.traceback_subopt(seq, d=1)]
+
+
+@pytest.mark.parametrize("min_loop_size", [0, 3])
+def test_fold_neighbors_matches_refolding(min_loop_size):
+    for seq in random_genotypes(number=5, length=12):
+        neighbors = filled_matrix(seq, min_loop_size).fold_neighbors(seq)
+        assert len(neighbors) == 12 * 3
+        for mutant, P in neighbors.items():
+            assert np.array_equal(P.P, filled_matrix(mutant, min_loop_size).P)
+
+
+@pytest.mark.parametrize("engine", ["loop", "vectorized"])
+def test_compact_matches_dense(engine):
+    for seq in random_genotypes(number=20, length=13):
+        P_ref = filled_matrix(seq, min_loop_size=1)
+        P = filled_matrix(seq, min_loop_size=1, engine=engine)
+        P_compact = BasePairMatrixNussinov(n=13, base_pairing=P_ref.base_pairing, compact=True)
+        P_compact.fill_matrix(seq=seq, min_loop_size=1, engine=engine)
+        assert P_compact.P.data.dtype == np.uint8
+        assert np.array_equal(np.asarray(P_compact.P), P_ref.P)
+        assert ([s.B for s in P_compact.traceback_subopt(seq, d=2)] 
+                == [s.B for s in P_ref.traceback_subopt(seq, d=2)])
+        P_compact.release()
+
+
+def test_compact_nussinov_reuses_pool(monkeypatch):
+    pairing = BasePairing(bases="AUGC", graph_path=None, id=-1)
+    seqs = random_genotypes(number=5, length=11)
+    expected = [nussinov(seq, pairing, 1, 2, None) for seq in seqs]
+
+    def no_dense_copy(*args, **kwargs):
+        raise AssertionError("compact matrix copied to a dense array")
+
+    monkeypatch.setattr(TriangularMatrix, "__array__", no_dense_copy)
+    TriangularMatrix._pool.pop((11, np.uint8), None)
+    assert nussinov(seqs[0], pairing, 1, 2, None, compact=True) == expected[0]
+    (buffer,) = TriangularMatrix._pool[(11, np.uint8)]
+    for seq, phenotypes in zip(seqs, expected):  # fill, traceback, count and sample all use the pooled buffer
+        assert nussinov(seq, pairing, 1, 2, None, compact=True) == phenotypes
+        assert set(nussinov(seq, pairing, 1, 2, 5, compact=True, sample=True, seed=1)) <= set(phenotypes)
+        assert len(TriangularMatrix._pool[(11, np.uint8)]) == 1
+        assert TriangularMatrix._pool[(11, np.uint8)][0] is buffer
+
+
+def test_traceback_subopt_pair_tables():
+    for seq in random_genotypes(number=10, length=12):
+        P = filled_matrix(seq, min_loop_size=1)
+        strucs = P.traceback_subopt(seq, d=2)
+        pts = P.traceback_subopt(seq, d=2, pair_tables=True)
+        assert len(pts) == len(strucs)
+        for s, pt in zip(strucs, pts):
+            assert pt[0] == 12
+            assert sorted((l, j) for l, j in enumerate(pt) if 0 < l < j) == sorted(s.B)
+
+
+def test_iter_traceback_subopt_stops_early():
+    seq = random_genotypes(number=1, length=14)[0]
+    P = filled_matrix(seq, min_loop_size=1)
+    strucs = P.traceback_subopt(seq, d=2)
+    first = [s.B for _, s in zip(range(3), P.iter_traceback_subopt(seq, d=2))]
+    assert first == [s.B for s in strucs[:3]]
+
+
+@pytest.mark.parametrize("min_loop_size", [0, 3])
+def test_pairing_candidates(min_loop_size):
+    pairing = BasePairing(bases="AUGC", graph_path=None, id=-1)
+    for seq in random_genotypes(number=10, length=12):
+        candidates = pairing_candidates(seq, pairing, min_loop_size)
+        for j in range(1, 13):
+            assert candidates[j] == [l for l in range(1, j - min_loop_size) 
+                                     if pairing.pairs(seq[l-1], seq[j-1])]
+
+
+@pytest.mark.parametrize("engine", ["loop", "vectorized"])
+def test_max_span(engine):
+    for seq in random_genotypes(number=20, length=14):
+        P_ref = filled_matrix(seq, min_loop_size=1)
+        P = filled_matrix(seq, min_loop_size=1, engine=engine, max_span=5)
+        P_ref_structures = [s.B for s in P_ref.traceback_subopt(seq, d=2)]
+        local = {tuple(sorted(B)) for B in P_ref_structures 
+                 if all(j - l <= 5 for l, j in B)}
+        strucs = P.traceback_subopt(seq, d=2)
+        assert P.banded
+        assert all(j - l <= 5 for s in strucs for l, j in s.B)
+        # same optimum: local band are the structures of the full band with only short base-pairs
+        if P.P[1, -1] == P_ref.P[1, -1]:
+            assert {tuple(sorted(s.B)) for s in strucs} == local
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_refill_with_and_without_max_span(compact):
+    pairing = BasePairing(bases="AUGC", graph_path=None, id=-1)
+    seq = random_genotypes(number=1, length=12)[0]
+    P = BasePairMatrixNussinov(n=12, base_pairing=pairing, compact=compact)
+    for max_span in [4, None, 4, 11, 6]:
+        P.fill_matrix(seq, 1, max_span=max_span)
+        P_ref = filled_matrix(seq, min_loop_size=1, max_span=max_span)
+        assert P.banded == P_ref.banded == (max_span in [4, 6])
+        assert P.compact == (compact and not P.banded)
+        assert np.array_equal(np.asarray(P.P), np.asarray(P_ref.P))
+        assert [s.B for s in P.traceback_subopt(seq, d=2)] == [s.B for s in P_ref.traceback_subopt(seq, d=2)]
+    P.release()
+
+
+@pytest.mark.parametrize("structures_max", [np.inf, 3])
+def test_traceback_subopt_bands(structures_max):
+    for seq in random_genotypes(number=20, length=13):
+        P = filled_matrix(seq, min_loop_size=1)
+        bands = P.traceback_subopt_bands(seq, ds=[0, 2, 3], structures_max=structures_max)
+        for d, strucs in bands.items():
+            assert [s.B for s in strucs] == [s.B for s in P.traceback_subopt(seq, d=d, structures_max=structures_max)]
+
+
+def test_best_subopt():
+    rng = np.random.default_rng(7)
+    for seq in random_genotypes(number=20, length=12):
+        P = filled_matrix(seq, min_loop_size=1)
+        weights = {}
+        score = lambda B: sum(weights.setdefault(pair, rng.random()) for pair in B)
+        strucs = P.traceback_subopt(seq, d=2)
+        best = min(strucs, key=lambda s: score(s.B))  # first structure with lowest score
+        assert P.best_subopt(seq, d=2, score=score)[0].B == best.B
+        # weights are non-negative, so the weights of the decided base-pairs are a lower bound
+        bound = lambda B, segments: sum(weights[pair] for pair in B)
+        assert P.best_subopt(seq, d=2, score=score, bound=bound)[0].B == best.B
+        assert all(P.in_subopt_band(seq, s.B, d=2) for s in strucs)
+        assert not any(P.in_subopt_band(seq, s.B, d=0) for s in strucs if len(s.B) < P.P[1, -1])
+
+
+@pytest.mark.parametrize("max_span", [None, 4])
+def test_refill_suffix(max_span):
+    seqs = random_genotypes(number=30, length=12)
+    P = filled_matrix(seqs[0], min_loop_size=1, max_span=max_span)
+    previous = seqs[0]
+    for p, seq in enumerate(seqs[1:]):
+        seq = previous[:p % 12] + seq[p % 12:]  # share a prefix of varying length
+        P.refill_suffix(seq, prefix=p % 12)
+        P_ref = filled_matrix(seq, min_loop_size=1, max_span=max_span)
+        assert np.array_equal(np.asarray(P.P), np.asarray(P_ref.P))
+        assert [s.B for s in P.traceback_subopt(seq, d=1)] == [s.B for s in P_ref.traceback_subopt(seq, d=1)]
+        previous = seq
+
+
+@pytest.mark.parametrize("min_loop_size", [0, 3])
+def test_count_structures(min_loop_size):
+    for seq in random_genotypes(number=20, length=12):
+        P = filled_matrix(seq, min_loop_size)
+        counts = P.count_structures(seq, d=2)
+        strucs = {tuple(sorted(s.B)) for s in P.traceback_subopt(seq, d=2)}
+        for k in range(3):
+            assert counts[k] == len([B for B in strucs if len(B) == P.P[1, -1] - k])
+
+
+def test_sample_subopt():
+    seq = random_genotypes(number=1, length=14)[0]
+    P = filled_matrix(seq, min_loop_size=1)
+    strucs = {tuple(sorted(s.B)) for s in P.traceback_subopt(seq, d=2)}
+    samples = P.sample_subopt(seq, d=2, k=2000, seed=1996)
+    drawn = [tuple(sorted(s.B)) for s in samples]
+    assert set(drawn) <= strucs
+    assert len(set(drawn)) > len(strucs) // 2  # spread over the whole set
+    assert drawn == [tuple(sorted(s.B)) for s in P.sample_subopt(seq, d=2, k=2000, seed=1996)]
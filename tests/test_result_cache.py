@@ -0,0 +1,57 @@
+import numpy as np
+
+from rna_folding.base_pairing import BasePairing
+from rna_folding.mapping_functions import gp_mapper, nussinov
+from rna_folding.result_cache import MaskResultCache, SQLiteResultCache, config_key, mask_signature
+from rna_folding.utils import combinatorically_complete_genotypes
+
+
+def test_mask_signature():
+    pairing = BasePairing(bases="AUGC", graph_path=None, id=-1)
+    # A-U and G-C pairs give the same mask, pairs closer than min_loop_size don't count
+    assert mask_signature("AAUU", pairing, 1) == mask_signature("GGCC", pairing, 1)
+    assert mask_signature("AUAA", pairing, 2) == mask_signature("AAAA", pairing, 2)
+    assert mask_signature("AUAA", pairing, 1) != mask_signature("AAAA", pairing, 1)
+    assert mask_signature("GAAAC", pairing, 1, max_span=3) == mask_signature("AAAAA", pairing, 1, max_span=3)
+
+
+def test_nussinov_cache():
+    pairing = BasePairing(bases="AUGC", graph_path=None, id=-1)
+    cache = MaskResultCache(maxsize=50)
+    params = dict(base_pairing=pairing, min_loop_size=1, suboptimal=1, structures_max=5)
+    for g in list(combinatorically_complete_genotypes(6, "AUGC"))[::7]:
+        genotype = "".join(g)
+        assert nussinov(genotype, cache=cache, **params) == nussinov(genotype, **params)
+    assert len(cache) == 50 and cache.hits > 0
+
+
+def test_sqlite_result_cache(tmp_path):
+    with SQLiteResultCache(tmp_path / "cache.db", max_entries=3) as cache:
+        for k in range(3):
+            cache.put(("config", str(k)), ["." * k])
+        assert cache.get(("config", "0")) == [""]  # now most recently used
+        cache.put(("config", "3"), ["..."])
+        assert len(cache) == 3
+
+    with SQLiteResultCache(tmp_path / "cache.db") as cache:  # reopened
+        assert cache.get_many([("config", str(k)) for k in range(4)]) == [[""], None, [".."], ["..."]]
+        assert cache.get(("other config", "0")) is None
+
+
+def test_gp_mapper_result_cache(tmp_path):
+    genotypes = tmp_path / "genotypes.txt"
+    genotypes.write_text("".join("".join(g) + "\n" for g in combinatorically_complete_genotypes(5, "AUGC")))
+    pairing = BasePairing(bases="AUGC", graph_path=None, id=-1)
+    mapping = lambda seq: nussinov(seq, base_pairing=pairing, min_loop_size=1, suboptimal=1, structures_max=None)
+    config = config_key("nussinov", pairing, 1, 1, None)
+
+    def failing(seq):
+        raise AssertionError("cached genotypes are not mapped again")
+
+    gp_mapper(input=genotypes, output=tmp_path / "ref.txt", mapping_function=mapping)
+    for output, mapping_ in [("first.txt", mapping), ("second.txt", failing)]:
+        with SQLiteResultCache(tmp_path / "cache.db") as cache:
+            gp_mapper(input=genotypes, output=tmp_path / output, mapping_function=mapping_, chunk_size=100,
+                      result_cache=cache, cache_config=config)
+        assert (tmp_path / output).read_text() == (tmp_path / "ref.txt").read_text()
+    assert cache.hits == 4**5
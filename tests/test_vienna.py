@@ -0,0 +1,25 @@
+import numpy as np
+import RNA
+
+from rna_folding.vienna import ViennaRNABackend
+
+
+def test_backend_matches_module_functions():
+    backend = ViennaRNABackend(maxsize=2)
+    rng = np.random.default_rng(5)
+    genotypes = ["".join(rng.choice(list("AUGC"), size=15)) for _ in range(10)]
+    folded = backend.fold_many(genotypes + genotypes[:3])
+    assert folded == [RNA.fold(g) for g in genotypes + genotypes[:3]]
+
+    structures = [s for s, _ in folded]
+    for g in genotypes:
+        assert backend.eval_structures(g, structures) == [RNA.eval_structure_simple(g, s) for s in structures]
+    assert len(backend._compounds) == 2
+
+
+def test_backend_model_details():
+    md = RNA.md()
+    md.temperature = 50
+    backend = ViennaRNABackend(md=md)
+    seq = "GGGGAAAACCCCAUAUGC"
+    assert backend.fold(seq)[1] > RNA.fold(seq)[1]